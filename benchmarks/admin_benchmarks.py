@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the admin views and the SQLAlchemy datastore.
+
+Seeds SQLite databases of the models in example/declarative/simple.py
+with a number of rows per model, then times the list, edit, add and
+delete views through the Flask test client, along with direct calls
+to the SQLAlchemyDatastore methods that back them. For each benchmark
+it reports latency percentiles, the number of SQL statements per call
+and the peak memory use so far. Each size is seeded and benchmarked
+in a process of its own, so the peak memory use of one size doesn't
+carry over to the next.
+
+Run it from the root of the repository:
+
+    python benchmarks/admin_benchmarks.py --sizes 10000,100000 \\
+        --save baseline.json
+
+and compare a later run against the saved baseline with:
+
+    python benchmarks/admin_benchmarks.py --sizes 10000,100000 \\
+        --compare baseline.json
+
+When comparing, benchmarks whose median latency got more than
+`--threshold` percent slower are reported as regressions, and the
+script exits with a status of 1.
+"""
+import itertools
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask.ext.admin.datastore.sqlalchemy import SQLAlchemyDatastore
+from example.declarative import simple
+
+
+DEFAULT_SIZES = '10000,100000,1000000'
+SEED_CHUNK_SIZE = 10000
+RANDOM_SEED = 1
+
+
+def seed(engine, size):
+    """Fills the database with `size` students and courses, a teacher
+    for every 100 courses and two distinct students per course. The
+    students are picked with a fixed random seed, so every run uses
+    the same data.
+    """
+    simple.Base.metadata.create_all(bind=engine)
+    teachers = max(size // 100, 1)
+    rng = random.Random(RANDOM_SEED)
+    tables = [
+        (simple.Teacher.__table__,
+         ({'id': i, 'name': u'teacher %d' % i}
+          for i in xrange(1, teachers + 1))),
+        (simple.Student.__table__,
+         ({'id': i, 'name': u'student %d' % i}
+          for i in xrange(1, size + 1))),
+        (simple.Course.__table__,
+         ({'id': i, 'subject': u'course %d' % i,
+           'teacher_id': i % teachers + 1}
+          for i in xrange(1, size + 1))),
+        (simple.course_student_association_table,
+         ({'course_id': i, 'student_id': student_id}
+          for i in xrange(1, size + 1)
+          for student_id in rng.sample(xrange(1, size + 1), min(size, 2)))),
+    ]
+    with engine.begin() as connection:
+        for table, rows in tables:
+            while True:
+                chunk = list(itertools.islice(rows, SEED_CHUNK_SIZE))
+                if not chunk:
+                    break
+                connection.execute(table.insert(), chunk)
+
+
+def percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class Benchmark(object):
+    """Runs the benchmarks against one seeded database."""
+    def __init__(self, database_uri, size, iterations):
+        self.size = size
+        self.iterations = iterations
+        self.app = simple.create_app(database_uri)
+        self.app.teardown_request(
+            lambda exception: self.app.db_session.remove())
+        self.client = self.app.test_client()
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            self.app.db_session)
+        self.statements = 0
+        sa.event.listen(self.app.db_session.get_bind(),
+                        'before_cursor_execute', self._count_statement)
+
+    def _count_statement(self, *args):
+        self.statements += 1
+
+    def measure(self, name, func):
+        """Calls `func` with the iteration number `iterations` times
+        and returns a dict of its latency percentiles (in
+        milliseconds), statements per call and the peak memory use of
+        the process afterwards (in kilobytes).
+        """
+        timings = []
+        statements = self.statements
+        for i in xrange(self.iterations):
+            start = time.time()
+            func(i)
+            timings.append((time.time() - start) * 1000)
+            self.app.db_session.remove()
+        timings.sort()
+        return {
+            'p50': percentile(timings, 0.5),
+            'p90': percentile(timings, 0.9),
+            'p99': percentile(timings, 0.99),
+            'max': timings[-1],
+            'statements': float(self.statements - statements) /
+                          self.iterations,
+            'peak_memory_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+    def get(self, url):
+        rv = self.client.get(url)
+        rv.data
+        assert rv.status_code in (200, 302), (url, rv.status_code)
+
+    def post(self, url, data):
+        rv = self.client.post(url, data=data)
+        assert rv.status_code == 302, (url, rv.status_code, rv.data)
+
+    def course_id(self, i):
+        """Returns a course id spread over the whole table."""
+        return (i * 7919) % self.size + 1
+
+    def run(self):
+        size = self.size
+        last_page = (size + 24) // 25
+        datastore = self.datastore
+        benchmarks = [
+            ('view.list.first_page', lambda i: self.get(
+                '/admin/list/Course/')),
+            ('view.list.middle_page', lambda i: self.get(
+                '/admin/list/Course/?page=%d' % (last_page // 2))),
+            ('view.list.last_page', lambda i: self.get(
+                '/admin/list/Course/?page=%d' % last_page)),
+            ('view.edit.get', lambda i: self.get(
+                '/admin/edit/Course/%d/' % self.course_id(i))),
+            ('view.edit.post', lambda i: self.post(
+                '/admin/edit/Course/%d/' % self.course_id(i),
+                {'subject': u'edited %d' % i, 'teacher': u'1'})),
+            ('view.add.post', lambda i: self.post(
+                '/admin/add/Course/',
+                {'subject': u'added %d' % i, 'teacher': u'1'})),
+            ('view.delete', lambda i: self.get(
+                '/admin/delete/Course/%d/' % (size - i))),
+            ('datastore.create_model_pagination', lambda i:
+                datastore.create_model_pagination(
+                    'Course', last_page // 2).items),
+            ('datastore.find_model_instance', lambda i:
+                datastore.find_model_instance(
+                    'Course', [unicode(self.course_id(i))])),
+            ('datastore.search_model_instances', lambda i:
+                datastore.search_model_instances('Student', u'student 1')),
+            ('datastore.delete_model_instance', lambda i:
+                datastore.delete_model_instance(
+                    'Student', [unicode(size - i)])),
+        ]
+        return dict([(name, self.measure(name, func))
+                     for name, func in benchmarks])
+
+
+def run_size(tempdir, size, iterations):
+    """Seeds a database of `size` rows in `tempdir` and returns the
+    results of the benchmarks against it. It is run in a new process
+    for every size, since the peak memory use that the kernel reports
+    (ru_maxrss) is the highest one over the life of the process.
+    """
+    database = os.path.join(tempdir, 'bench-%d.db' % size)
+    engine = sa.create_engine('sqlite:///' + database)
+    start = time.time()
+    seed(engine, size)
+    engine.dispose()
+    print >> sys.stderr, 'seeded %d rows in %.1fs' % (
+        size, time.time() - start)
+    return Benchmark('sqlite:///' + database, size, iterations).run()
+
+
+def compare(results, baseline, threshold):
+    """Prints the change in median latency of each benchmark against
+    the baseline, and returns the names of the ones that got more
+    than `threshold` percent slower.
+    """
+    regressions = []
+    for size in sorted(results, key=int):
+        for name in sorted(results[size]):
+            try:
+                before = baseline[size][name]['p50']
+            except KeyError:
+                continue
+            after = results[size][name]['p50']
+            change = (after - before) / before * 100 if before else 0.0
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append('%s/%s' % (size, name))
+            print '%8s %-38s %9.2fms -> %9.2fms %+7.1f%%%s' % (
+                size, name, before, after, change, flag)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default=DEFAULT_SIZES,
+                      help='comma separated numbers of rows to seed '
+                      '(default: %default)')
+    parser.add_option('--iterations', type='int', default=20,
+                      help='calls per benchmark (default: %default)')
+    parser.add_option('--save', metavar='FILE',
+                      help='save the results as a JSON baseline')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the results with a JSON baseline')
+    parser.add_option('--threshold', type='float', default=20.0,
+                      help='percent slowdown of the median latency that '
+                      'counts as a regression (default: %default)')
+    options, args = parser.parse_args()
+
+    results = {}
+    tempdir = tempfile.mkdtemp()
+    try:
+        for size in [int(size) for size in options.sizes.split(',')]:
+            # a new process for every size (see run_size)
+            pool = multiprocessing.Pool(processes=1)
+            try:
+                results[str(size)] = pool.apply(
+                    run_size, (tempdir, size, options.iterations))
+            finally:
+                pool.terminate()
+            for name, result in sorted(results[str(size)].items()):
+                print '%8d %-38s p50 %9.2fms  p90 %9.2fms  p99 %9.2fms' \
+                      '  %6.1f statements  %8d kB' % (
+                          size, name, result['p50'], result['p90'],
+                          result['p99'], result['statements'],
+                          result['peak_memory_kb'])
+    finally:
+        shutil.rmtree(tempdir)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        print
+        regressions = compare(results, baseline, options.threshold)
+        if regressions:
+            print >> sys.stderr, '%d regressions: %s' % (
+                len(regressions), ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,15 @@ import flask
 from flask import flash, render_template, redirect, request, url_for
 
 from flask.ext.admin.wtforms import has_file_field
-from flask.ext.admin.datastore import AdminDatastore
+from flask.ext.admin.datastore import AdminDatastore, BatchInsertError
+from flask.ext.admin.datastore.instrumented import InstrumentedDatastore, \
+     format_server_timing
+from flask.ext.admin import metrics as admin_metrics
+from flask.ext.admin import signals, util
+
+
+# number of template statements per chunk of a streamed response
+_STREAM_BUFFER_SIZE = 50
 
 
 def create_admin_blueprint(*args, **kwargs):
@@ -65,6 +73,29 @@ def create_admin_blueprint(*args, **kwargs):
     The `list_view_pagination` parameter sets the number of items that
     will be listed per page in the list view.
 
+    The `import_batch_size` parameter sets the number of rows that the
+    import view writes to the datastore at a time.
+
+    If `stream_list_view` is set to True, the list view is streamed to
+    the browser as it is rendered, and the datastore is asked for the
+    items of the page as an iterator, so rows are sent as they are
+    fetched. This improves the time to first byte and keeps memory use
+    down for large `list_view_pagination` values.
+
+    The list view lets a selection of model instances be deleted at
+    once. Other actions on a selection can be added with
+    `bulk_actions`, a dict mapping model names to dicts of action
+    names and the attribute values to set on the selected model
+    instances, e.g. ``{'User': {'deactivate': {'is_active': False}}}``.
+
+    If a :class:`~flask.ext.admin.metrics.Metrics` object is given as
+    `metrics`, the blueprint records the latency of each view, the
+    latency of each datastore call (by wrapping the datastore in an
+    :class:`InstrumentedDatastore`, unless it already is one), form
+    validation failures and the number of rows on each list page, and
+    serves all the collected metrics at ``/metrics`` in the Prometheus
+    text exposition format.
+
     Finally, the `empty_sequence` keyword can be used to designate a
     sequence of characters that can be used as a substitute for cases
     where part of the key url may be empty.  This should be a rare
@@ -101,7 +132,8 @@ def create_admin_blueprint_deprecated(
 
 def create_admin_blueprint_new(
     datastore, name='admin', list_view_pagination=25, view_decorator=None,
-    empty_sequence=u'\x1a', **kwargs):
+    empty_sequence=u'\x1a', stream_list_view=False, import_batch_size=500,
+    bulk_actions=None, metrics=None, **kwargs):
 
     admin_blueprint = flask.Blueprint(
         name, 'flask.ext.admin',
@@ -109,6 +141,15 @@ def create_admin_blueprint_new(
         template_folder=os.path.join(_get_admin_extension_dir(), 'templates'),
         **kwargs)
 
+    if bulk_actions is None:
+        bulk_actions = {}
+
+    if metrics is not None:
+        if not isinstance(datastore, InstrumentedDatastore):
+            datastore = InstrumentedDatastore(datastore, metrics=metrics)
+        elif datastore.metrics is None:
+            datastore.metrics = metrics
+
     # if no view decorator was assigned, let view_decorator be a dummy
     # decorator that doesn't really do anything
     if not view_decorator:
@@ -126,14 +167,120 @@ def create_admin_blueprint_new(
         return '/'.join([unicode(value) if value else empty_sequence
                          for value in values])
 
+    def model_url_builder(endpoint, model_name):
+        """Returns a function that takes a model url key (see
+        get_model_url_key) and returns the url of `endpoint` (e.g.
+        '.edit' or '.delete') for that model instance of
+        `model_name`. The url is only built with url_for once, so this
+        is meant for templates that link to many model instances, like
+        the list view.
+        """
+        return util.URLTemplate(endpoint, 'model_url_key',
+                                model_name=model_name)
+
+    # an InstrumentedDatastore (possibly wrapped in another datastore)
+    # provides the timings of the datastore calls for each request
+    get_request_stats = getattr(datastore, 'get_request_stats', None)
+    if get_request_stats is not None:
+        @admin_blueprint.after_request
+        def add_server_timing(response):
+            stats = get_request_stats()
+            if stats:
+                response.headers.add('Server-Timing',
+                                     format_server_timing(stats))
+                signals.datastore_request_finished.send(
+                    flask.current_app._get_current_object(), stats=stats)
+            return response
+
+    if metrics is not None:
+        @admin_blueprint.before_request
+        def start_view_timer():
+            flask.g._admin_view_start = time.time()
+
+        @admin_blueprint.teardown_request
+        def observe_view_duration(exception=None):
+            start = getattr(flask.g, '_admin_view_start', None)
+            if start is None or request.endpoint is None:
+                return
+            metrics.observe('flask_admin_view_duration_seconds',
+                            time.time() - start,
+                            view=request.endpoint.rsplit('.', 1)[-1],
+                            model=get_metrics_model_name())
+
+    def get_metrics_model_name():
+        """Returns the model name of the current request, if it is
+        one of the datastore's models (so that made up model names in
+        urls don't each get their own series).
+        """
+        model_name = (request.view_args or {}).get('model_name', u'')
+        if model_name in datastore.get_model_registry():
+            return model_name
+        return u''
+
+    def count_validation_failure(view, model_name):
+        if metrics is not None:
+            metrics.inc('flask_admin_form_validation_failures_total',
+                        view=view, model=model_name)
+
+    def count_list_rows(model_name, pagination):
+        """Records the number of rows on a list page; for a streamed
+        list view, once the rows have all been rendered.
+        """
+        if metrics is None:
+            return
+        if isinstance(pagination.items, (list, tuple)):
+            metrics.observe('flask_admin_list_rows_rendered',
+                            len(pagination.items), model=model_name)
+            return
+
+        def counted(items):
+            count = 0
+            for item in items:
+                count += 1
+                yield item
+            metrics.observe('flask_admin_list_rows_rendered', count,
+                            model=model_name)
+        pagination.items = counted(pagination.items)
+
+    def get_list_filters(model_name):
+        """Returns a tuple of the filters in the url arguments of a
+        list view or export (including the one added with the list
+        view's filter form, if any) and the text of the search box.
+        """
+        filterable_columns = datastore.get_filterable_columns(model_name)
+        filters = set(util.parse_filters(request.args, filterable_columns))
+        column = request.args.get('filter_column')
+        operation = request.args.get('filter_operation', 'eq')
+        value = request.args.get('filter_value')
+        if column in filterable_columns and value and \
+               operation in util.FILTER_OPERATIONS:
+            filters.add(util.Filter(column, operation, value))
+        return sorted(filters), request.args.get('q', u'').strip()
+
+    def with_search(model_name, filters, search):
+        """Returns a list of filters with a prefix filter for the
+        search box text added to it.
+        """
+        search_column = datastore.get_search_column(model_name)
+        if search and search_column:
+            return filters + [util.Filter(search_column, 'startswith',
+                                          search)]
+        return filters
+
+    @admin_blueprint.context_processor
+    def inject_url_helpers():
+        return dict(get_model_url_key=get_model_url_key,
+                    model_url_builder=model_url_builder)
+
     def create_index_view():
         @view_decorator
         def index():
             """Landing page view for admin module
             """
+            registry = datastore.get_model_registry()
             return render_template(
                 'admin/index.html',
-                model_names=datastore.list_model_names())
+                model_names=registry.sorted_names)
         return index
 
     def create_list_view():
@@ -142,19 +289,59 @@ def create_admin_blueprint_new(
             """Lists instances of a given model, so they can
             beselected for editing or deletion.
             """
-            if not model_name in datastore.list_model_names():
+            registry = datastore.get_model_registry()
+            if not model_name in registry:
                 return "%s cannot be accessed through this admin page" % (
                     model_name,)
             per_page = list_view_pagination
             page = int(request.args.get('page', '1'))
-            pagination = datastore.create_model_pagination(
-                model_name, page, per_page)
-
-            return render_template(
+            cursor = request.args.get('cursor')
+            sortable_columns = datastore.get_sortable_columns(model_name)
+            sort = request.args.get('sort')
+            if util.parse_sort(sort)[0] not in sortable_columns:
+                sort = None
+            filters, search = get_list_filters(model_name)
+            try:
+                pagination = datastore.create_model_pagination(
+                    model_name, page, per_page, cursor=cursor,
+                    stream=stream_list_view, sort=sort,
+                    filters=with_search(model_name, filters, search))
+            except ValueError, e:
+                flash('Invalid filter: %s' % e, 'error')
+                pagination = datastore.create_model_pagination(
+                    model_name, page, per_page, cursor=cursor,
+                    stream=stream_list_view, sort=sort)
+            render = _stream_template if stream_list_view else \
+                     render_template
+            count_list_rows(model_name, pagination)
+
+            # the url arguments that links to other pages of the list
+            # (or to an export) need to keep the filters and search
+            list_args = util.filter_args(filters)
+            if search:
+                list_args['q'] = search
+            active_filters = [
+                (filter, util.filter_args(
+                    [other for other in filters if other != filter]))
+                for filter in filters]
+
+            return render(
                 'admin/list.html',
-                model_names=datastore.list_model_names(),
-                get_model_url_key=get_model_url_key,
+                model_names=registry.sorted_names,
+                edit_url_for=model_url_builder('.edit', model_name),
+                delete_url_for=model_url_builder('.delete', model_name),
                 model_name=model_name,
+                list_columns=datastore.get_list_columns(model_name),
+                sortable_columns=sortable_columns,
+                sort=sort,
+                filterable_columns=datastore.get_filterable_columns(
+                    model_name),
+                filter_operations=util.FILTER_OPERATIONS,
+                active_filters=active_filters,
+                search_column=datastore.get_search_column(model_name),
+                search=search,
+                list_args=list_args,
+                bulk_actions=sorted(bulk_actions.get(model_name, {})),
                 pagination=pagination)
         return list_view
 
@@ -162,10 +349,11 @@ def create_admin_blueprint_new(
         @view_decorator
         def edit(model_name, model_url_key):
             """Edit a particular instance of a model."""
+            registry = datastore.get_model_registry()
             model_keys = [key if key != empty_sequence else u''
                          for key in model_url_key.split('/')]
 
-            if not model_name in datastore.list_model_names():
+            if not model_name in registry:
                 return "%s cannot be accessed through this admin page" % (
                     model_name,)
 
@@ -174,14 +362,14 @@ def create_admin_blueprint_new(
                 model_name, model_keys)
 
             if not model_instance:
-                return "%s not found: %s" % (model_name, model_key)
+                return "%s not found: %s" % (model_name, model_keys)
 
             if request.method == 'GET':
                 form = model_form(obj=model_instance)
                 form._has_file_field = has_file_field(form)
                 return render_template(
                     'admin/edit.html',
-                    model_names=datastore.list_model_names(),
+                    model_names=registry.sorted_names,
                     model_instance=model_instance,
                     model_name=model_name, form=form)
 
@@ -198,12 +386,13 @@ def create_admin_blueprint_new(
                         url_for('.list',
                                 model_name=model_name))
                 else:
+                    count_validation_failure('edit', model_name)
                     flash('There was an error processing your form. '
                           'This %s has not been saved.' % model_name,
                           'error')
                     return render_template(
                         'admin/edit.html',
-                        model_names=datastore.list_model_names(),
+                        model_names=registry.sorted_names,
                         model_instance=model_instance,
                         model_name=model_name, form=form)
         return edit
@@ -212,10 +401,11 @@ def create_admin_blueprint_new(
         @view_decorator
         def add(model_name):
             """Create a new instance of a model."""
-            if not model_name in datastore.list_model_names():
+            registry = datastore.get_model_registry()
+            if not model_name in registry:
                 return "%s cannot be accessed through this admin page" % (
                     model_name)
-            model_class = datastore.get_model_class(model_name)
+            model_class = registry.descriptors[model_name].model_class
             model_form = datastore.get_model_form(model_name)
             model_instance = model_class()
             if request.method == 'GET':
@@ -223,7 +413,7 @@ def create_admin_blueprint_new(
                 form._has_file_field = has_file_field(form)
                 return render_template(
                     'admin/add.html',
-                    model_names=datastore.list_model_names(),
+                    model_names=registry.sorted_names,
                     model_name=model_name,
                     form=form)
             elif request.method == 'POST':
@@ -238,23 +428,168 @@ def create_admin_blueprint_new(
                     return redirect(url_for('.list',
                                             model_name=model_name))
                 else:
+                    count_validation_failure('add', model_name)
                     flash('There was an error processing your form. This '
                           '%s has not been saved.' % model_name, 'error')
                     return render_template(
                         'admin/add.html',
-                        model_names=datastore.list_model_names(),
+                        model_names=registry.sorted_names,
                         model_name=model_name,
                         form=form)
         return add
 
+    def create_autocomplete_view():
+        @view_decorator
+        def autocomplete(model_name):
+            """Returns a page of model instances matching a search
+            prefix as JSON, for filling in the options of autocomplete
+            select fields.
+            """
+            registry = datastore.get_model_registry()
+            if not model_name in registry:
+                return "%s cannot be accessed through this admin page" % (
+                    model_name,)
+            prefix = request.args.get('q', u'')
+            try:
+                limit = int(request.args.get('limit', '20'))
+                offset = int(request.args.get('offset', '0'))
+            except ValueError:
+                return flask.Response('Invalid limit or offset\n', 400,
+                                      mimetype='text/plain')
+            limit = max(1, min(limit, 100))
+            offset = max(0, offset)
+            model_instances = datastore.search_model_instances(
+                model_name, prefix, limit + 1, offset)
+            results = [
+                dict(id=u':'.join([unicode(value) for value in
+                                   datastore.get_model_keys(model_instance)]),
+                     text=unicode(model_instance))
+                for model_instance in model_instances[:limit]]
+            return flask.jsonify(results=results,
+                                 more=len(model_instances) > limit)
+        return autocomplete
+
+    def create_export_view():
+        @view_decorator
+        def export(model_name, fmt):
+            """Streams every instance of a model (or the ones that
+            match the filters of the list view) as CSV or as newline
+            delimited JSON.
+            """
+            registry = datastore.get_model_registry()
+            if not model_name in registry:
+                return "%s cannot be accessed through this admin page" % (
+                    model_name,)
+            filters, search = get_list_filters(model_name)
+            try:
+                column_names, rows = datastore.iter_model_rows(
+                    model_name, with_search(model_name, filters, search))
+            except ValueError, e:
+                return flask.Response('Invalid filter: %s\n' % e, 400,
+                                      mimetype='text/plain')
+            if fmt == 'csv':
+                chunks = util.iter_csv(column_names, rows)
+                mimetype = 'text/csv'
+            else:
+                chunks = util.iter_ndjson(column_names, rows)
+                mimetype = 'application/x-ndjson'
+            return flask.Response(
+                flask.stream_with_context(chunks), mimetype=mimetype,
+                headers={'Content-Disposition': 'attachment; filename=%s.%s'
+                         % (model_name, fmt)})
+        return export
+
+    def create_import_view():
+        def import_rows(model_name, rows):
+            """Validates rows of form data with the model form and
+            inserts the valid ones in batches, yielding a line of
+            report for each rejected row or failed batch.
+            """
+            model_form = datastore.get_import_form(model_name)
+            batch = []
+            imported = rejected = 0
+            for line_number, row in rows:
+                if isinstance(row, basestring):
+                    rejected += 1
+                    yield 'line %d: %s\n' % (line_number, row)
+                    continue
+                form = model_form(row)
+                if not form.validate():
+                    rejected += 1
+                    count_validation_failure('import', model_name)
+                    yield 'line %d: %s\n' % (line_number, '; '.join(
+                        '%s: %s' % (name, ' '.join(errors))
+                        for name, errors in sorted(form.errors.items())))
+                    continue
+                batch.append((line_number, form))
+                if len(batch) >= import_batch_size:
+                    inserted, error = insert_batch(model_name, batch)
+                    imported += inserted
+                    if error:
+                        yield error
+                    batch = []
+            if batch:
+                inserted, error = insert_batch(model_name, batch)
+                imported += inserted
+                if error:
+                    yield error
+            yield 'done: %d rows imported, %d rows rejected\n' % (
+                imported, rejected)
+
+        def insert_batch(model_name, batch):
+            """Inserts a batch of (line number, form) tuples, returning
+            a tuple of the number of rows that were inserted and a line
+            of report if the batch couldn't be (fully) inserted.
+            """
+            try:
+                datastore.insert_from_forms(
+                    model_name, [form for line_number, form in batch])
+            except BatchInsertError, e:
+                lines = 'lines %d-%d' % (batch[0][0], batch[-1][0])
+                if e.inserted is None:
+                    return 0, '%s: may have been partially imported: %s\n' \
+                           % (lines, e)
+                if e.inserted:
+                    return e.inserted, (
+                        '%s: only %d of %d rows were imported: %s\n' % (
+                            lines, e.inserted, len(batch), e))
+                return 0, '%s: could not be imported: %s\n' % (lines, e)
+            return len(batch), None
+
+        @view_decorator
+        def import_view(model_name):
+            """Imports instances of a model from an uploaded CSV or
+            newline delimited JSON file.
+            """
+            registry = datastore.get_model_registry()
+            if not model_name in registry:
+                return "%s cannot be accessed through this admin page" % (
+                    model_name,)
+            upload = request.files.get('file')
+            if request.method == 'GET' or not upload:
+                return render_template(
+                    'admin/import.html',
+                    model_names=registry.sorted_names,
+                    model_name=model_name)
+            if os.path.splitext(upload.filename)[1] in (
+                '.json', '.jsonl', '.ndjson'):
+                rows = util.read_ndjson(upload.stream)
+            else:
+                rows = util.read_csv(upload.stream)
+            return flask.Response(
+                flask.stream_with_context(import_rows(model_name, rows)),
+                mimetype='text/plain')
+        return import_view
+
     def create_delete_view():
         @view_decorator
         def delete(model_name, model_url_key):
             """Delete an instance of a model."""
+            registry = datastore.get_model_registry()
             model_keys = [key if key != empty_sequence else u''
                           for key in model_url_key.split('/')]
 
-            if not model_name in datastore.list_model_names():
+            if not model_name in registry:
                 return "%s cannot be accessed through this admin page" % (
                     model_name,)
             model_instance = datastore.delete_model_instance(model_name,
@@ -269,6 +604,51 @@ def create_admin_blueprint_new(
                 model_name=model_name))
         return delete
 
+    def create_bulk_view():
+        @view_decorator
+        def bulk(model_name):
+            """Deletes the selected instances of a model, or applies
+            one of the model's bulk actions to them.
+            """
+            registry = datastore.get_model_registry()
+            if not model_name in registry:
+                return "%s cannot be accessed through this admin page" % (
+                    model_name,)
+            action = request.form.get('action', 'delete')
+            model_keys_list = [
+                [key if key != empty_sequence else u''
+                 for key in model_url_key.split('/')]
+                for model_url_key in request.form.getlist('keys')]
+            if not model_keys_list:
+                flash('No %s selected' % model_name, 'error')
+            elif action == 'delete':
+                deleted = datastore.delete_model_instances(
+                    model_name, model_keys_list)
+                flash('%d %s deleted' % (deleted, model_name), 'success')
+            elif action in bulk_actions.get(model_name, {}):
+                updated = datastore.update_model_instances(
+                    model_name, model_keys_list,
+                    bulk_actions[model_name][action])
+                flash('%d %s updated: %s' % (updated, model_name, action),
+                      'success')
+            else:
+                flash('Unknown action for %s: %s' % (model_name, action),
+                      'error')
+            return redirect(url_for(
+                '.list',
+                model_name=model_name))
+        return bulk
+
+    def create_metrics_view():
+        @view_decorator
+        def metrics_view():
+            """Serves the collected metrics in the Prometheus text
+            exposition format.
+            """
+            return flask.Response(metrics.render(),
+                                  content_type=admin_metrics.CONTENT_TYPE)
+        return metrics_view
+
     admin_blueprint.add_url_rule('/', 'index',
                       view_func=create_index_view())
     admin_blueprint.add_url_rule('/list/<model_name>/',
@@ -281,14 +661,48 @@ def create_admin_blueprint_new(
     admin_blueprint.add_url_rule('/delete/<model_name>/<path:model_url_key>/',
                       'delete',
                       view_func=create_delete_view())
+    admin_blueprint.add_url_rule('/bulk/<model_name>/',
+                      'bulk',
+                      view_func=create_bulk_view(),
+                      methods=['POST'])
     admin_blueprint.add_url_rule('/add/<model_name>/',
                       'add',
                       view_func=create_add_view(),
                       methods=['GET', 'POST'])
+    admin_blueprint.add_url_rule('/import/<model_name>/',
+                      'import',
+                      view_func=create_import_view(),
+                      methods=['GET', 'POST'])
+    admin_blueprint.add_url_rule(
+                      '/export/<model_name>.<any(csv, ndjson):fmt>',
+                      'export',
+                      view_func=create_export_view())
+    admin_blueprint.add_url_rule('/autocomplete/<model_name>/',
+                      'autocomplete',
+                      view_func=create_autocomplete_view())
+    if metrics is not None:
+        admin_blueprint.add_url_rule('/metrics',
+                          'metrics',
+                          view_func=create_metrics_view())
 
     return admin_blueprint
 
 
+def _stream_template(template_name, **context):
+    """Like :func:`flask.render_template`, but returns a response that
+    streams the template as it is rendered. The request context is
+    kept around until the template is done rendering.
+    """
+    app = flask.current_app
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    # send the output in chunks of a few template statements instead
+    # of one chunk for every statement
+    stream.enable_buffering(_STREAM_BUFFER_SIZE)
+    return flask.Response(flask.stream_with_context(stream))
+
+
 def _get_admin_extension_dir():
     """Returns the directory path of this admin extension. This is
     necessary for setting the static_folder and templates_folder
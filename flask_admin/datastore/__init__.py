@@ -1 +1,7 @@
-from flask.ext.admin.datastore.core import AdminDatastore
+from flask.ext.admin.datastore.core import AdminDatastore, \
+     BatchInsertError, CachedCount, ExactCount, ModelDescriptor, \
+     ModelRegistry, count_rows
+from flask.ext.admin.datastore.caching import CachingDatastore, \
+     LRUCache
+from flask.ext.admin.datastore.instrumented import CallStats, \
+     InstrumentedDatastore
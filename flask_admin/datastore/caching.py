@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.datastore.caching
+    ~~~~~~~~~~~~~~
+
+    Defines a datastore wrapper that caches query results.
+
+    :copyright: (c) 2011 by wilsaj.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+from collections import OrderedDict
+import cPickle as pickle
+import hashlib
+import threading
+import time
+import uuid
+
+from flask.ext.admin.datastore.core import AdminDatastore
+
+
+class CachingDatastore(AdminDatastore):
+    """A datastore that wraps another `datastore` and caches the
+    pagination objects for the list view and the model instances
+    looked up for the edit view, so that opening the same page again
+    doesn't hit the database.
+
+    Results are cached for `ttl` seconds in `cache`, which can be any
+    object with the get/set/delete interface of the
+    `werkzeug.contrib.cache`_ backends (so a memcached or redis cache
+    can be shared between processes), or in a local :class:`LRUCache`
+    by default.
+
+    The cached results for a model are invalidated when a model
+    instance is saved or deleted through this datastore. Changes that
+    don't go through the admin interface, or changes to one model
+    that show up in the list view of another (e.g. in a __repr__ that
+    includes a related model), will only be picked up once the cached
+    results expire; call :meth:`invalidate` to pick them up sooner.
+
+    If a :class:`~flask.ext.admin.metrics.Metrics` object is given as
+    `metrics`, cache hits and misses are counted there.
+
+    .. _werkzeug.contrib.cache: http://werkzeug.pocoo.org/docs/contrib/cache/
+    """
+    def __init__(self, datastore, cache=None, ttl=60,
+                 key_prefix='flask-admin:', metrics=None):
+        self.datastore = datastore
+        self.cache = cache if cache is not None else LRUCache()
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self.metrics = metrics
+
+    def create_model_pagination(self, model_name, page, per_page=25,
+                                cursor=None, stream=False, sort=None,
+                                filters=None):
+        """Returns a pagination object for the list view, from the
+        cache if possible. Cached items have to be fetched all at
+        once, so `stream` is ignored.
+        """
+        key = self._make_key(model_name, 'pagination', page, per_page, cursor,
+                             sort, list(filters or ()))
+        pagination = self.cache.get(key)
+        self._count_lookup('pagination', model_name, pagination)
+        if pagination is None:
+            pagination = self.datastore.create_model_pagination(
+                model_name, page, per_page, cursor=cursor, sort=sort,
+                filters=filters)
+            self.cache.set(key, pagination, timeout=self.ttl)
+        else:
+            pagination.items = [
+                self.datastore.merge_model_instance(model_instance)
+                for model_instance in pagination.items]
+        return pagination
+
+    def delete_model_instance(self, model_name, model_keys):
+        """Deletes a model instance and invalidates the cached results
+        for its model.
+        """
+        deleted = self.datastore.delete_model_instance(model_name, model_keys)
+        if deleted:
+            self.invalidate(model_name)
+        return deleted
+
+    def delete_model_instances(self, model_name, model_keys_list):
+        """Deletes model instances and invalidates the cached results
+        for their model.
+        """
+        deleted = self.datastore.delete_model_instances(
+            model_name, model_keys_list)
+        self.invalidate(model_name)
+        return deleted
+
+    def find_model_instance(self, model_name, model_keys):
+        """Returns a model instance, from the cache if possible, that
+        matches model_name and model_keys. Returns None if no such
+        model instance exists.
+        """
+        key = self._make_key(model_name, 'instance', list(model_keys))
+        model_instance = self.cache.get(key)
+        self._count_lookup('instance', model_name, model_instance)
+        if model_instance is None:
+            model_instance = self.datastore.find_model_instance(
+                model_name, model_keys)
+            if model_instance is not None:
+                self.cache.set(key, model_instance, timeout=self.ttl)
+            return model_instance
+        return self.datastore.merge_model_instance(model_instance)
+
+    def get_list_columns(self, model_name):
+        return self.datastore.get_list_columns(model_name)
+
+    def get_model_class(self, model_name):
+        return self.datastore.get_model_class(model_name)
+
+    def get_model_form(self, model_name):
+        return self.datastore.get_model_form(model_name)
+
+    def get_import_form(self, model_name):
+        return self.datastore.get_import_form(model_name)
+
+    def get_model_keys(self, model_instance):
+        return self.datastore.get_model_keys(model_instance)
+
+    def get_model_registry(self):
+        return self.datastore.get_model_registry()
+
+    def get_filterable_columns(self, model_name):
+        return self.datastore.get_filterable_columns(model_name)
+
+    def get_search_column(self, model_name):
+        return self.datastore.get_search_column(model_name)
+
+    def get_sortable_columns(self, model_name):
+        return self.datastore.get_sortable_columns(model_name)
+
+    def invalidate(self, model_name=None):
+        """Invalidates the cached results for `model_name`, or for all
+        models if no model name is given.
+        """
+        model_names = [model_name] if model_name is not None \
+                      else self.get_model_registry().names
+        for model_name in model_names:
+            self.cache.set(self._generation_key(model_name),
+                           uuid.uuid4().hex)
+
+    def insert_from_forms(self, model_name, forms):
+        """Inserts a batch of model instances through the wrapped
+        datastore and invalidates the cached results for their model.
+        """
+        try:
+            return self.datastore.insert_from_forms(model_name, forms)
+        finally:
+            # a failed batch may have been partially inserted
+            self.invalidate(model_name)
+
+    def iter_model_rows(self, model_name, filters=None):
+        return self.datastore.iter_model_rows(model_name, filters)
+
+    def list_model_names(self):
+        return self.datastore.list_model_names()
+
+    def merge_model_instance(self, model_instance):
+        return self.datastore.merge_model_instance(model_instance)
+
+    def save_model(self, model_instance):
+        """Persists a model instance to the wrapped datastore and
+        invalidates the cached results for its model.
+        """
+        result = self.datastore.save_model(model_instance)
+        self.invalidate(self.get_model_registry().get_model_name(
+            type(model_instance)))
+        return result
+
+    def search_model_instances(self, model_name, prefix, limit=25, offset=0):
+        return self.datastore.search_model_instances(
+            model_name, prefix, limit, offset)
+
+    def update_model_instances(self, model_name, model_keys_list, values):
+        """Updates model instances and invalidates the cached results
+        for their model.
+        """
+        updated = self.datastore.update_model_instances(
+            model_name, model_keys_list, values)
+        self.invalidate(model_name)
+        return updated
+
+    def update_from_form(self, model_instance, form):
+        return self.datastore.update_from_form(model_instance, form)
+
+    def _count_lookup(self, cache, model_name, result):
+        if self.metrics is not None:
+            self.metrics.inc('flask_admin_cache_requests_total',
+                             cache=cache, model=model_name,
+                             result='miss' if result is None else 'hit')
+
+    def _generation_key(self, model_name):
+        return '%s%s:generation' % (self.key_prefix, model_name)
+
+    def _get_generation(self, model_name):
+        """Returns the current generation of the cached results for a
+        model. Invalidating a model starts a new generation, so the
+        results cached for older generations are never looked up
+        again and expire on their own. If the generation itself has
+        been evicted, a new one is started, since there's no telling
+        whether the model was invalidated in the meantime.
+        """
+        key = self._generation_key(model_name)
+        generation = self.cache.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.cache.set(key, generation)
+        return generation
+
+    def _make_key(self, model_name, *args):
+        """Returns a cache key for a result of `model_name` that
+        depends on `args`. The arguments are hashed so keys stay short
+        and safe for memcached.
+        """
+        digest = hashlib.md5(repr(args)).hexdigest()
+        return '%s%s:%s:%s' % (self.key_prefix, model_name,
+                               self._get_generation(model_name), digest)
+
+    def __getattr__(self, name):
+        return getattr(self.datastore, name)
+
+
+class LRUCache(object):
+    """A cache that keeps at most `max_entries` values in memory,
+    evicting the least recently used value when it is full. It has
+    the same get/set/delete/clear interface as the
+    `werkzeug.contrib.cache` backends; a `timeout` of 0 means that a
+    value never expires. Like werkzeug's SimpleCache, values are
+    pickled so that each get() returns a fresh copy.
+    """
+    def __init__(self, max_entries=1000, default_timeout=300):
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires and expires < time.time():
+                return None
+            self._entries[key] = entry
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else 0
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,11 +1,47 @@
+from collections import namedtuple
+import threading
+import time
+
+
+class BatchInsertError(Exception):
+    """Raised by :meth:`AdminDatastore.insert_from_forms` when a batch
+    couldn't be written to the database. `inserted` is the number of
+    model instances of the batch that were inserted anyway, or None if
+    it isn't known.
+    """
+    def __init__(self, message, inserted=0):
+        Exception.__init__(self, message)
+        self.inserted = inserted
+
+
 class AdminDatastore(object):
     """A base class for admin datastore objects. All datastores used
     in Flask-Admin should subclass this object and define the
     following methods.
     """
 
-    def create_model_pagination(self, model_name, page, per_page=25):
-        """Returns a pagination object for the list view."""
+    def create_model_pagination(self, model_name, page, per_page=25,
+                                cursor=None, stream=False, sort=None,
+                                filters=None):
+        """Returns a pagination object for the list view. If the
+        datastore supports keyset pagination, `cursor` is the opaque
+        cursor string of the requested page (see
+        :class:`~flask.ext.admin.util.KeysetPagination`); datastores
+        that don't support it can ignore the cursor. If `stream` is
+        True, the list view is being streamed, so the items of the
+        pagination may be an iterator that fetches them lazily rather
+        than a list; datastores can also ignore this. `sort` is the
+        name of the column to sort on, with a '-' in front of it for
+        a descending sort (see :func:`~flask.ext.admin.util.parse_sort`);
+        it should be ignored unless it is one of the columns returned
+        by :meth:`get_sortable_columns`. `filters` is a list of
+        :class:`~flask.ext.admin.util.Filter` that the model instances
+        should match, and should be passed on to the count strategy
+        (see :func:`count_rows`); filters on columns that aren't
+        returned by :meth:`get_filterable_columns` should be ignored,
+        and a ValueError should be raised if a filter's value isn't
+        valid for its column.
+        """
         raise NotImplementedError()
 
     def delete_model_instance(self, model_name, model_keys):
@@ -14,6 +50,15 @@ class AdminDatastore(object):
         """
         raise NotImplementedError()
 
+    def delete_model_instances(self, model_name, model_keys_list):
+        """Deletes the model instances matching each of the model keys
+        in `model_keys_list`, and returns the number of model instances
+        that were deleted. Datastores should override this to delete
+        them all at once; by default, each one is deleted on its own.
+        """
+        return len([model_keys for model_keys in model_keys_list
+                    if self.delete_model_instance(model_name, model_keys)])
+
     def find_model_instance(self, model_name, model_keys):
         """Returns a model instance, if one exists, that matches
         model_name and model_keys. Returns None if no such model
@@ -29,24 +74,265 @@ class AdminDatastore(object):
         """Returns a form, given a model name."""
         raise NotImplementedError()
 
+    def get_import_form(self, model_name):
+        """Returns the form that the import view validates each row of
+        an import with, given a model name. It is called once per
+        import, so datastores can return a form that shares work (like
+        loading the options of relationship fields) between the rows.
+        Defaults to the model form.
+        """
+        return self.get_model_form(model_name)
+
+    def get_list_columns(self, model_name):
+        """Returns the list of attribute names that the list view
+        should show as table columns for a given model, or None if the
+        list view should just show each model instance. Datastores
+        that don't support list columns don't need to override this.
+        """
+        return None
+
+    def get_filterable_columns(self, model_name):
+        """Returns the list of column names that the list view can be
+        filtered on for a given model. Datastores that don't support
+        filters don't need to override this.
+        """
+        return []
+
+    def get_search_column(self, model_name):
+        """Returns the name of the column that the search box of the
+        list view searches by prefix for a given model, or None if the
+        list view has no search box. Datastores that don't support
+        filters don't need to override this.
+        """
+        return None
+
+    def get_sortable_columns(self, model_name):
+        """Returns the list of column names that the list view can be
+        sorted on for a given model. Datastores that don't support
+        sorting don't need to override this.
+        """
+        return []
+
+    def get_model_registry(self):
+        """Returns the :class:`ModelRegistry` of the models in this
+        datastore. The registry is built the first time it is asked
+        for and then reused, so all models should be known to the
+        datastore by then.
+        """
+        registry = self.__dict__.get('_model_registry')
+        if registry is None:
+            registry = self._model_registry = ModelRegistry(self)
+        return registry
+
     def get_model_keys(self, model_instance):
         """Returns the keys for a given a model instance. This should
         be an iterable (e.g. list or tuple) containing the keys.
         """
         raise NotImplementedError()
 
+    def insert_from_forms(self, model_name, forms):
+        """Creates and saves a new model instance for each of a batch
+        of validated `forms`, and returns the number of model
+        instances that were saved. Raises a :class:`BatchInsertError`
+        if the batch can't be saved. Datastores should override this
+        to write the whole batch at once; by default, each model
+        instance is saved on its own, so the ones before a failed save
+        stay saved.
+        """
+        model_class = self.get_model_class(model_name)
+        for inserted, form in enumerate(forms):
+            model_instance = self.update_from_form(model_class(), form)
+            try:
+                self.save_model(model_instance)
+            except Exception, e:
+                raise BatchInsertError(str(e), inserted)
+        return len(forms)
+
+    def iter_model_rows(self, model_name, filters=None):
+        """Returns a tuple of (column names, rows) for exporting all
+        the instances of a model (or only the ones that match a list
+        of `filters`, as in :meth:`create_model_pagination`), where
+        rows is an iterator over tuples of column values. Rows should
+        be fetched in batches as the iterator is consumed, so that
+        exporting a large table doesn't load it into memory.
+        """
+        raise NotImplementedError()
+
     def list_model_names(self):
         """Returns a list of model names available in the datastore."""
         raise NotImplementedError()
 
+    def merge_model_instance(self, model_instance):
+        """Returns a model instance that was loaded by an earlier
+        request (e.g. one that comes from a cache, see
+        :class:`~flask.ext.admin.datastore.caching.CachingDatastore`),
+        made usable for the current request. Datastores that don't
+        tie model instances to a session don't need to override this.
+        """
+        return model_instance
+
     def save_model(self, model_instance):
         """Persists a model instance to the datastore. Note: this
         could be called when a model instance is added or edited.
         """
         raise NotImplementedError()
 
+    def search_model_instances(self, model_name, prefix, limit=25, offset=0):
+        """Returns a list of at most `limit` model instances, starting
+        at `offset`, that match a search `prefix`. This is used by the
+        autocomplete view.
+        """
+        raise NotImplementedError()
+
+    def update_model_instances(self, model_name, model_keys_list, values):
+        """Sets the attributes in the `values` dict on the model
+        instances matching each of the model keys in `model_keys_list`,
+        and returns the number of model instances that were updated.
+        Datastores should override this to update them all at once; by
+        default, each one is found, updated and saved on its own.
+        """
+        updated = 0
+        for model_keys in model_keys_list:
+            model_instance = self.find_model_instance(model_name, model_keys)
+            if model_instance is not None:
+                for name, value in values.items():
+                    setattr(model_instance, name, value)
+                self.save_model(model_instance)
+                updated += 1
+        return updated
+
     def update_from_form(self, model_instance, form):
         """Returns a model instance whose values have been updated
         with the values from a given form.
         """
         raise NotImplementedError()
+
+    def warm_up_forms(self, model_names=None, background=True):
+        """Generates the forms for `model_names` (or for all models, if
+        no model names are given) ahead of time, so the first request
+        for each form doesn't have to wait for it. By default this
+        happens in a background daemon thread, which is returned.
+
+        If your application server forks worker processes, call this
+        in each worker after the fork (e.g. from gunicorn's `post_fork`
+        hook), since threads don't survive a fork.
+        """
+        model_names = list(model_names or self.list_model_names())
+
+        def build_forms():
+            for model_name in model_names:
+                self.get_model_form(model_name)
+
+        if not background:
+            build_forms()
+            return None
+        thread = threading.Thread(target=build_forms,
+                                  name='flask-admin-warm-up-forms')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+ModelDescriptor = namedtuple('ModelDescriptor', ['name', 'model_class'])
+
+
+class ModelRegistry(object):
+    """The models of a datastore, collected once so the views don't
+    have to ask the datastore for them on every request. `names` is
+    a frozenset of the model names, `sorted_names` is a tuple of the
+    model names in display order and `descriptors` maps each model
+    name to a :class:`ModelDescriptor`. Checking whether a model name
+    is `in` a registry is a set lookup.
+    """
+    def __init__(self, datastore):
+        self.names = frozenset(datastore.list_model_names())
+        self.sorted_names = tuple(sorted(self.names))
+        self.descriptors = dict(
+            [(name, ModelDescriptor(name, datastore.get_model_class(name)))
+             for name in self.names])
+        self._names_by_class = dict(
+            [(descriptor.model_class, name)
+             for name, descriptor in self.descriptors.items()])
+
+    def __contains__(self, model_name):
+        return model_name in self.names
+
+    def __iter__(self):
+        return iter(self.sorted_names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_model_name(self, model_class):
+        """Returns the model name for a model class, or None if the
+        model class isn't in the registry.
+        """
+        return self._names_by_class.get(model_class)
+
+
+class ExactCount(object):
+    """A count strategy that counts the rows of a model exactly, by
+    running a count query for every list view. This is the default
+    count strategy for the datastores that come with Flask-Admin.
+
+    A count strategy is any object with a `count` method that takes a
+    datastore, a model name and the datastore-specific query for the
+    list view, and returns a tuple of (total count, is_estimate). If
+    the list view is filtered, the list of filters is passed as well,
+    as a `filters` keyword argument (see :func:`count_rows`).
+    """
+    def count(self, datastore, model_name, query, filters=None):
+        return query.count(), False
+
+
+class CachedCount(object):
+    """A count strategy that remembers the counts returned by another
+    count `strategy` (an :class:`ExactCount` by default) for `ttl`
+    seconds, so the count query is run at most once per `ttl` seconds
+    for each model. Use a separate CachedCount for each model if you
+    need different ttls for different models. If a
+    :class:`~flask.ext.admin.metrics.Metrics` object is given as
+    `metrics`, cache hits and misses are counted there.
+    """
+    def __init__(self, strategy=None, ttl=60, metrics=None):
+        self.strategy = strategy or ExactCount()
+        self.ttl = ttl
+        self.metrics = metrics
+        self._cache = {}
+
+    def count(self, datastore, model_name, query, filters=None):
+        now = time.time()
+        key = (model_name, tuple(filters or ()))
+        cached = self._cache.get(key)
+        hit = cached is not None and cached[0] > now
+        if self.metrics is not None:
+            self.metrics.inc('flask_admin_cache_requests_total',
+                             cache='count', model=model_name,
+                             result='hit' if hit else 'miss')
+        if hit:
+            return cached[1]
+        result = count_rows(self.strategy, datastore, model_name, query,
+                            filters)
+        self._cache[key] = (now + self.ttl, result)
+        return result
+
+    def invalidate(self, model_name=None):
+        """Forgets the cached counts for `model_name`, or for all
+        models if no model name is given.
+        """
+        if model_name is None:
+            self._cache.clear()
+        else:
+            for key in self._cache.keys():
+                if key[0] == model_name:
+                    self._cache.pop(key, None)
+
+
+def count_rows(strategy, datastore, model_name, query, filters=None):
+    """Runs the `count` method of a count strategy. The `filters` are
+    only passed to it if there are any, so count strategies that
+    don't take them still work for list views that aren't filtered.
+    """
+    if filters:
+        return strategy.count(datastore, model_name, query, filters=filters)
+    return strategy.count(datastore, model_name, query)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.datastore.instrumented
+    ~~~~~~~~~~~~~~
+
+    Defines a datastore wrapper that times the datastore calls made
+    during each request.
+
+    :copyright: (c) 2011 by wilsaj.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+from collections import namedtuple
+import inspect
+import time
+
+import flask
+
+from flask.ext.admin.datastore.core import AdminDatastore
+from flask.ext.admin import signals
+
+
+#: The totals for one datastore method over a request: the number of
+#: calls, the time spent in them (in seconds) and the number of SQL
+#: statements they executed.
+CallStats = namedtuple('CallStats', 'calls duration statements')
+
+
+class InstrumentedDatastore(AdminDatastore):
+    """A datastore that wraps another `datastore` and keeps track of
+    how many times each of its methods is called during a request,
+    and how long those calls take. If a SQLAlchemy `engine` is given,
+    the SQL statements executed on it during each call are counted
+    too. If a :class:`~flask.ext.admin.metrics.Metrics` object is
+    given as `metrics`, the duration of every call is also recorded
+    there, by method and model.
+
+    The admin blueprint adds the totals for each request to its
+    response as a `Server-Timing`_ header, and sends them with the
+    :data:`~flask.ext.admin.signals.datastore_request_finished`
+    signal. Each call also sends the
+    :data:`~flask.ext.admin.signals.datastore_called` signal. Signals
+    require the `blinker`_ library.
+
+    Only the calls themselves are timed: the rows of a streamed list
+    view or export are fetched after the call returns (and after the
+    response headers are sent), so they aren't included.
+
+    .. _Server-Timing: http://www.w3.org/TR/server-timing/
+    .. _blinker: http://pypi.python.org/pypi/blinker
+    """
+    def __init__(self, datastore, engine=None, metrics=None):
+        self.datastore = datastore
+        self.engine = engine
+        self.metrics = metrics
+        if engine is not None:
+            import sqlalchemy as sa
+            sa.event.listen(engine, 'before_cursor_execute',
+                            self._count_statement)
+
+    def get_request_stats(self):
+        """Returns a dict of the :class:`CallStats` for each datastore
+        method that has been called during the current request.
+        """
+        stats = getattr(flask.g, '_admin_datastore_stats', {})
+        return dict([(name, CallStats(*totals))
+                     for name, totals in stats.items()])
+
+    def _call(self, name, *args, **kwargs):
+        """Calls a method of the wrapped datastore and adds its
+        duration and statement count to the totals of the current
+        request.
+        """
+        start = time.time()
+        if not flask.has_request_context():
+            try:
+                return getattr(self.datastore, name)(*args, **kwargs)
+            finally:
+                self._observe(name, args, time.time() - start)
+
+        statements = getattr(flask.g, '_admin_statement_count', 0)
+        try:
+            return getattr(self.datastore, name)(*args, **kwargs)
+        finally:
+            duration = time.time() - start
+            self._observe(name, args, duration)
+            statements = getattr(flask.g, '_admin_statement_count', 0) - \
+                         statements
+            if not hasattr(flask.g, '_admin_datastore_stats'):
+                flask.g._admin_datastore_stats = {}
+            totals = flask.g._admin_datastore_stats.setdefault(
+                name, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] += statements
+            signals.datastore_called.send(
+                self, method=name, duration=duration, statements=statements)
+
+    def _observe(self, name, args, duration):
+        """Records the duration of a call in `metrics`. The model is
+        the call's first argument if it is a model name, or the model
+        of its first argument if it is a model instance.
+        """
+        if self.metrics is None:
+            return
+        model_name = u''
+        if args and isinstance(args[0], basestring):
+            model_name = args[0]
+        elif args:
+            model_name = self.datastore.get_model_registry().get_model_name(
+                type(args[0])) or u''
+        self.metrics.observe('flask_admin_datastore_call_duration_seconds',
+                             duration, method=name, model=model_name)
+
+    def _count_statement(self, *args):
+        # statements run outside of a request, or in another thread
+        # (like a concurrent count), aren't counted
+        if flask.has_request_context():
+            flask.g._admin_statement_count = getattr(
+                flask.g, '_admin_statement_count', 0) + 1
+
+    def __getattr__(self, name):
+        return getattr(self.datastore, name)
+
+
+def format_server_timing(stats):
+    """Returns the value of a Server-Timing header for a dict of
+    :class:`CallStats`, with one metric per datastore method and a
+    `datastore` metric for the total.
+    """
+    metrics = []
+    for name, call_stats in sorted(stats.items()):
+        metrics.append('%s;dur=%.1f;desc="calls=%d statements=%d"' % (
+            name, call_stats.duration * 1000, call_stats.calls,
+            call_stats.statements))
+    metrics.append('datastore;dur=%.1f' % (
+        sum(call_stats.duration for call_stats in stats.values()) * 1000))
+    return ', '.join(metrics)
+
+
+def _instrumented_method(name):
+    def method(self, *args, **kwargs):
+        return self._call(name, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = getattr(AdminDatastore, name).__doc__
+    return method
+
+
+# wrap every public AdminDatastore method, so that none of them falls
+# through to AdminDatastore's own implementation
+for _name, _method in inspect.getmembers(AdminDatastore, inspect.ismethod):
+    if not _name.startswith('_'):
+        setattr(InstrumentedDatastore, _name, _instrumented_method(_name))
+del _name, _method
@@ -9,15 +9,25 @@
 """
 from __future__ import absolute_import
 
+import datetime
+from functools import partial
+import re
+import threading
 import types
 
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 import mongoalchemy as ma
 from mongoalchemy.document import Document
+from mongoalchemy.exceptions import BadValueException
+from mongoalchemy.query_expression import QueryExpression
+from pymongo.errors import PyMongoError
 from wtforms import fields as f
 from wtforms import form, validators, widgets
 from wtforms.form import Form
 
-from flask.ext.admin.datastore import AdminDatastore
+from flask.ext.admin.datastore import AdminDatastore, \
+     BatchInsertError, ExactCount, count_rows
 from flask.ext.admin import wtforms as admin_wtf
 from flask.ext.admin import util
 
@@ -48,13 +58,66 @@ class MongoAlchemyDatastore(AdminDatastore):
     that should be used as forms for creating and editing instances of
     these models.
 
+    The `count_strategy` parameter controls how the total number of
+    documents is counted for the list view pagination. It can be set
+    to a count strategy object, like
+    :class:`~flask.ext.admin.datastore.core.CachedCount`, or to a dict
+    with model names as keys matched to count strategies. By default,
+    documents are counted with a count query on each request.
+
+    The `keyset_pagination` parameter turns on keyset (a.k.a. range)
+    pagination for the list view. Rather than skipping over the
+    documents of previous pages, which MongoDB does by walking through
+    them, the list view will then query for the documents after (or
+    before) the last document that was displayed with `$gt` and `$lt`
+    bounds, so deep pages cost the same as the first page. Set it to
+    True to paginate on `mongo_id` for every model, or to a dict with
+    model names as keys matched to either True or the name of an
+    indexed field to paginate on. When a field is given, `mongo_id`
+    is used to break ties between documents with equal values.
+
+    If `concurrent_count` is set to True, the list view runs the count
+    query on a small thread pool while the page itself is fetched, so
+    a list view costs roughly one round trip to mongod rather than
+    two.
+
+    The list view can be sorted on a field by clicking on its name. By
+    default, only fields that lead one of the collection's indexes
+    (as reported by mongod, including the one on `mongo_id`) are
+    sortable, since sorting on any other field makes mongod sort the
+    whole collection in memory for every page. The indexes are looked
+    up the first time they are needed. The `sortable_columns`
+    parameter can be set to True to make every field sortable, or to
+    a dict with model names as keys matched to either True or a list
+    of the field names that are sortable. Documents with equal values
+    are ordered by `mongo_id`, and the list view is ordered by
+    `mongo_id` when it isn't sorted.
+
+    The list view can also be filtered on fields, and searched by
+    prefix with a search box on the first string field. Filters and
+    the search box also apply to exports. Like sorting, this is
+    limited to the fields that lead an index by default; the
+    `filterable_columns` parameter works like `sortable_columns` and
+    can be used to allow others.
+
     .. _MongoAlchemy documentation: http://www.mongoalchemy.org/api/session.html
     .. _WTForms documentation: http://wtforms.simplecodes.com/
     """
-    def __init__(self, models, db_session, model_forms=None):
+    def __init__(self, models, db_session, model_forms=None,
+                 count_strategy=None, list_columns=None,
+                 keyset_pagination=None, concurrent_count=False,
+                 sortable_columns=None, filterable_columns=None):
         self.model_classes = {}
         self.model_forms = model_forms
         self.db_session = db_session
+        self.count_strategy = count_strategy
+        self.concurrent_count = concurrent_count
+        self.keyset_pagination = keyset_pagination
+        self.list_columns = list_columns or {}
+        self.sortable_columns = sortable_columns
+        self.filterable_columns = filterable_columns
+        self._column_lists = {}
+        self._indexed_fields = {}
 
         if not self.model_forms:
             self.model_forms = {}
@@ -69,32 +132,90 @@ class MongoAlchemyDatastore(AdminDatastore):
                  for model in models
                  if issubclass(model, Document)])
 
-        if self.model_classes:
-            self.form_dict = dict(
-                [(k, _form_for_model(v, db_session,))
-                 for k, v in self.model_classes.items()])
-            for model_name, form in self.model_forms.items():
-                if model_name in self.form_dict:
-                    self.form_dict[model_name] = form
-
-    def create_model_pagination(self, model_name, page, per_page=25):
-        """Returns a pagination object for the list view."""
+        # forms are generated the first time they are asked for (see
+        # get_model_form), so only custom forms are known up front
+        self.form_dict = dict(
+            [(k, v) for k, v in self.model_forms.items()
+             if k in self.model_classes])
+        self._form_lock = threading.Lock()
+
+    def create_model_pagination(self, model_name, page, per_page=25,
+                                cursor=None, stream=False, sort=None,
+                                filters=None):
+        """Returns a pagination object for the list view. If `stream`
+        is True, the items of numbered pages are an iterator that
+        fetches documents from mongod in batches as they are consumed.
+        Sorting on a field that isn't sortable, and filters on fields
+        that aren't filterable, are ignored.
+        """
         model_class = self.get_model_class(model_name)
-        query = self.db_session.query(model_class).skip(
-            (page - 1) * per_page).limit(per_page)
-        return MongoAlchemyPagination(page, per_page, query)
+        query = self._filter_query(
+            model_name, self.db_session.query(model_class), filters)
+        keyset_fields = self._get_keyset_fields(model_name)
+        sort_fields, descending = self._get_sort_fields(model_name, sort)
+        if keyset_fields and sort_fields:
+            keyset_fields = sort_fields
+        list_columns = self.get_list_columns(model_name)
+        if list_columns:
+            query = query.fields(
+                *set(list(list_columns) + list(keyset_fields or [])))
+        if keyset_fields:
+            return _keyset_pagination(query, model_class, keyset_fields,
+                                      per_page, cursor, descending=descending)
+        # without an order, mongod may return documents in a different
+        # order for each page
+        for name in sort_fields or ['mongo_id']:
+            query = query.descending(name) if descending else \
+                    query.ascending(name)
+        query = query.skip((page - 1) * per_page).limit(per_page)
+        count_strategy = self._get_count_strategy(model_name)
+        if stream:
+            total_count, estimated = count_rows(
+                count_strategy, self, model_name, query, filters)
+            # estimated paginations look at the number of items to
+            # find out if there is a next page, so they can't stream
+            if estimated:
+                items = query.all()
+            else:
+                items = iter(query)
+                items.cursor.batch_size(util.STREAM_BATCH_SIZE)
+        elif self.concurrent_count:
+            count_query = query.clone()
+            (total_count, estimated), items = util.call_concurrently(
+                lambda: count_rows(count_strategy, self, model_name,
+                                   count_query, filters),
+                query.all)
+        else:
+            items = query.all()
+            total_count, estimated = count_rows(
+                count_strategy, self, model_name, query, filters)
+        return MongoAlchemyPagination(page, per_page, query,
+                                      total_count=total_count,
+                                      items=items, estimated=estimated)
 
     def delete_model_instance(self, model_name, model_keys):
         """Deletes a model instance. Returns True if model instance
-        was successfully deleted, returns False otherwise.
+        was successfully deleted, returns False otherwise. The
+        document is removed by its mongo_id, without being fetched
+        first.
         """
-        model_class = self.get_model_class(model_name)
-        try:
-            model_instance = self.find_model_instance(model_name, model_keys)
-            self.db_session.remove(model_instance)
-            return True
-        except ma.query.BadResultException:
+        mongo_ids = _get_mongo_ids([model_keys])
+        if not mongo_ids:
             return False
+        model_class = self.get_model_class(model_name)
+        result = self._get_collection(model_class).remove(
+            {'_id': mongo_ids[0]}, safe=True)
+        return result['n'] > 0
+
+    def delete_model_instances(self, model_name, model_keys_list):
+        """Deletes the documents matching each of the model keys in
+        `model_keys_list` with a single remove, and returns the number
+        of documents that were deleted.
+        """
+        model_class = self.get_model_class(model_name)
+        result = self._get_collection(model_class).remove(
+            {'_id': {'$in': _get_mongo_ids(model_keys_list)}}, safe=True)
+        return result['n']
 
     def find_model_instance(self, model_name, model_keys):
         """Returns a model instance, if one exists, that matches
@@ -111,13 +232,94 @@ class MongoAlchemyDatastore(AdminDatastore):
         return self.model_classes.get(model_name, None)
 
     def get_model_form(self, model_name):
-        """Returns a form, given a model name."""
-        return self.form_dict.get(model_name, None)
+        """Returns a form, given a model name. Forms are generated
+        the first time they are requested and then reused.
+        """
+        form = self.form_dict.get(model_name, None)
+        if form is not None or model_name not in self.model_classes:
+            return form
+
+        with self._form_lock:
+            if model_name not in self.form_dict:
+                self.form_dict[model_name] = _form_for_model(
+                    self.model_classes[model_name], self.db_session)
+            return self.form_dict[model_name]
+
+    def get_list_columns(self, model_name):
+        """Returns the list of field names that the list view should
+        show as table columns for a given model, or None.
+        """
+        return self.list_columns.get(model_name)
+
+    def get_filterable_columns(self, model_name):
+        """Returns the list of field names that the list view of a
+        given model can be filtered on: the ones given by the
+        `filterable_columns` parameter, or else the fields that lead
+        an index of the model's collection.
+        """
+        return self._get_column_list('filterable_columns', model_name)
+
+    def get_search_column(self, model_name):
+        """Returns the name of the field that the list view's search
+        box searches for a given model, which is its first string
+        field, or None if that field isn't filterable.
+        """
+        name = _get_search_field_name(self.get_model_class(model_name))
+        if name in self.get_filterable_columns(model_name):
+            return name
+        return None
+
+    def get_sortable_columns(self, model_name):
+        """Returns the list of field names that the list view of a
+        given model can be sorted on: the ones given by the
+        `sortable_columns` parameter, or else the fields that lead an
+        index of the model's collection.
+        """
+        return self._get_column_list('sortable_columns', model_name)
 
     def get_model_keys(self, model_instance):
         """Returns the keys for a given a model instance."""
         return [model_instance.mongo_id]
 
+    def insert_from_forms(self, model_name, forms):
+        """Inserts a new document for each of a batch of validated
+        forms with a single insert. If mongod rejects a document, the
+        documents before it stay inserted, and the BatchInsertError
+        that is raised tells how many there are.
+        """
+        model_class = self.get_model_class(model_name)
+        documents = [self.update_from_form(model_class(), form).wrap()
+                     for form in forms]
+        if documents:
+            collection = self._get_collection(model_class)
+            # the session ensures the declared indexes before each of
+            # its operations, which this insert bypasses
+            for index in model_class.get_indexes():
+                index.ensure(collection)
+            try:
+                collection.insert(documents, safe=True)
+            except PyMongoError, e:
+                raise BatchInsertError(
+                    str(e), _count_inserted(collection, documents))
+        return len(documents)
+
+    def iter_model_rows(self, model_name, filters=None):
+        """Returns a tuple of (field names, rows) for exporting all
+        the documents of a model, or the ones that match `filters`.
+        Documents are fetched from mongod in batches as the rows are
+        consumed.
+        """
+        model_class = self.get_model_class(model_name)
+        field_names = ['mongo_id'] + sorted(
+            name for name in model_class.get_fields() if name != 'mongo_id')
+        documents = iter(self._filter_query(
+            model_name, self.db_session.query(model_class),
+            filters).ascending('mongo_id'))
+        documents.cursor.batch_size(util.STREAM_BATCH_SIZE)
+        rows = (tuple(getattr(document, name, None) for name in field_names)
+                for document in documents)
+        return field_names, rows
+
     def list_model_names(self):
         """Returns a list of model names available in the datastore."""
         return self.model_classes.keys()
@@ -125,36 +327,305 @@ class MongoAlchemyDatastore(AdminDatastore):
     def save_model(self, model_instance):
         """Persists a model instance to the datastore. Note: this
         could be called when a model instance is added or edited.
+        Documents that are already in the database are updated with
+        only the fields that have changed, or not at all if nothing
+        has changed. Returns the result of the write, like
+        `Document.commit`.
+        """
+        if not model_instance.has_id():
+            return model_instance.commit(self.db_session.db)
+        if not any(model_instance.get_dirty_ops().values()):
+            return None
+        result = self.db_session.update(model_instance, safe=True)
+        _mark_clean(model_instance)
+        return result
+
+    def search_model_instances(self, model_name, prefix, limit=25, offset=0):
+        """Returns a list of at most `limit` model instances, starting
+        at `offset`, whose first string field starts with `prefix`.
+        """
+        model_class = self.get_model_class(model_name)
+        field_name = _get_search_field_name(model_class)
+        query = self.db_session.query(model_class)
+        if prefix and field_name:
+            # an anchored, case sensitive regular expression can use
+            # an index on the field. The query resolves the attribute
+            # name to the field's db_field.
+            query = query.filter({field_name: {
+                '$regex': '^' + re.escape(prefix)}})
+        if field_name:
+            query = query.ascending(field_name)
+        return query.skip(offset).limit(limit).all()
+
+    def update_model_instances(self, model_name, model_keys_list, values):
+        """Sets the fields in the `values` dict on the documents
+        matching each of the model keys in `model_keys_list` with a
+        single multi-document update, and returns the number of
+        documents that were updated.
         """
-        return model_instance.commit(self.db_session.db)
+        model_class = self.get_model_class(model_name)
+        fields = model_class.get_fields()
+        result = self._get_collection(model_class).update(
+            {'_id': {'$in': _get_mongo_ids(model_keys_list)}},
+            {'$set': dict([(fields[name].db_field, fields[name].wrap(value))
+                           for name, value in values.items()])},
+            multi=True, safe=True)
+        return result['n']
 
     def update_from_form(self, model_instance, form):
         """Returns a model instance whose values have been updated
-        with the values from a given form.
+        with the values from a given form. Only the fields whose data
+        differs from the model instance's values are set, so that
+        :meth:`save_model` only writes the fields that changed.
         """
         for field in form:
             # handle FormFields that were generated for mongoalchemy
             # TupleFields as a special case
             if field.__class__ == f.FormField:
-                data_tuple = tuple([subfield.data for subfield in field])
-                setattr(model_instance, field.name, data_tuple)
-                continue
+                data = tuple([subfield.data for subfield in field])
 
             # don't use the mongo id from the form - it comes from the
             # key/url and if someone tampers with the form somehow, we
             # should ignore that
             elif field.name != 'mongo_id':
-                setattr(model_instance, field.name, field.data)
+                data = field.data
+            else:
+                continue
+            if util.has_changed(model_instance, field.name, data):
+                setattr(model_instance, field.name, data)
         return model_instance
 
+    def _get_collection(self, model_class):
+        """Returns the pymongo collection of a document class."""
+        return self.db_session.db[model_class.get_collection_name()]
+
+    def _filter_query(self, model_name, query, filters):
+        """Returns `query` filtered with a list of filters, leaving out
+        the ones on fields that aren't filterable. Raises a ValueError
+        if a filter's value isn't valid for its field, or if a prefix
+        filter isn't on a string field.
+        """
+        model_class = self.get_model_class(model_name)
+        fields = model_class.get_fields()
+        filterable_columns = self.get_filterable_columns(model_name)
+        for name, operation, value in filters or []:
+            if name not in filterable_columns:
+                continue
+            if operation == 'startswith':
+                if not isinstance(fields[name], ma.fields.StringField):
+                    raise ValueError('%s is not a string field' % name)
+                # an anchored, case sensitive regular expression can use
+                # an index on the field
+                query = query.filter({name: {
+                    '$regex': '^' + re.escape(value)}})
+                continue
+            query_field = getattr(model_class, name)
+            value = _coerce_field_value(fields[name], value)
+            if operation == 'eq':
+                query = query.filter(query_field == value)
+            elif operation == 'lt':
+                query = query.filter(query_field < value)
+            elif operation == 'lte':
+                query = query.filter(query_field <= value)
+            elif operation == 'gt':
+                query = query.filter(query_field > value)
+            elif operation == 'gte':
+                query = query.filter(query_field >= value)
+        return query
+
+    def _get_column_list(self, option, model_name):
+        """Returns the list of field names that the `sortable_columns`
+        or `filterable_columns` parameter (as named by `option`)
+        allows for a given model. The collection's indexes are only
+        looked up once.
+        """
+        key = (option, model_name)
+        if key not in self._column_lists:
+            allowed = getattr(self, option)
+            if isinstance(allowed, dict):
+                allowed = allowed.get(model_name)
+            model_class = self.model_classes[model_name]
+            fields = model_class.get_fields()
+            if isinstance(allowed, (list, tuple)):
+                names = list(allowed)
+            elif allowed is True:
+                names = sorted(fields)
+            else:
+                if model_name not in self._indexed_fields:
+                    self._indexed_fields[model_name] = set(
+                        index['key'][0][0] for index in self._get_collection(
+                            model_class).index_information().values())
+                leading_fields = self._indexed_fields[model_name]
+                names = sorted(name for name, field in fields.items()
+                               if field.db_field in leading_fields)
+            self._column_lists[key] = names
+        return self._column_lists[key]
+
+    def _get_count_strategy(self, model_name):
+        """Returns the count strategy to use for a given model."""
+        strategy = self.count_strategy
+        if isinstance(strategy, dict):
+            strategy = strategy.get(model_name)
+        return strategy or ExactCount()
+
+    def _get_sort_fields(self, model_name, sort):
+        """Returns a tuple of the list of field names that the list
+        view of a given model should be ordered by for a `sort`
+        argument (the sort field followed by `mongo_id`), and whether
+        the order is descending. The list is None if the argument
+        doesn't name a sortable field.
+        """
+        name, descending = util.parse_sort(sort)
+        if name is None or name not in self.get_sortable_columns(model_name):
+            return None, False
+        if name == 'mongo_id':
+            return ['mongo_id'], descending
+        return [name, 'mongo_id'], descending
+
+    def _get_keyset_fields(self, model_name):
+        """Returns the list of field names that keyset pagination
+        should seek on for a given model, or None if keyset pagination
+        isn't used for that model.
+        """
+        keyset = self.keyset_pagination
+        if isinstance(keyset, dict):
+            keyset = keyset.get(model_name)
+        if not keyset:
+            return None
+        if keyset is True or keyset == 'mongo_id':
+            return ['mongo_id']
+        return [keyset, 'mongo_id']
+
 
 class MongoAlchemyPagination(util.Pagination):
-    def __init__(self, page, per_page, query, *args, **kwargs):
+    def __init__(self, page, per_page, query, total_count=None,
+                 items=None, *args, **kwargs):
+        if total_count is None:
+            total_count = query.count()
+        if items is None:
+            items = query.all()
         super(MongoAlchemyPagination, self).__init__(
-            page, per_page, total_count=query.count(), items=query.all(),
+            page, per_page, total_count=total_count, items=items,
             *args, **kwargs)
 
 
+def _mark_clean(document):
+    """Forgets the changes made to a document and to the documents
+    embedded in it, once they have been written, so that they aren't
+    written again by the next update.
+    """
+    document._dirty.clear()
+    for name in document.get_fields():
+        value = getattr(document, name, None)
+        if isinstance(value, Document):
+            _mark_clean(value)
+
+
+def _count_inserted(collection, documents):
+    """Returns how many of a list of documents that were passed to a
+    failed insert made it into the collection, or None if that can't
+    be found out. pymongo gives each document its _id before sending
+    it.
+    """
+    mongo_ids = [document['_id'] for document in documents
+                 if '_id' in document]
+    try:
+        return collection.find({'_id': {'$in': mongo_ids}}).count()
+    except PyMongoError:
+        return None
+
+
+def _keyset_pagination(query, document_class, field_names, per_page,
+                       cursor=None, descending=False):
+    """Returns a KeysetPagination for a query, seeking on the given
+    list of field names from the position encoded in `cursor`, in
+    ascending order or in `descending` order.
+    """
+    fields = document_class.get_fields()
+
+    def fetch(values, forward, limit):
+        # going forward in a descending order, or backwards in an
+        # ascending one, means going towards smaller values
+        after = forward != descending
+        page_query = query
+        if values:
+            page_query = page_query.filter(_seek_expression(
+                document_class, field_names, values, after=after))
+        for name in field_names:
+            page_query = page_query.ascending(name) if after else \
+                         page_query.descending(name)
+        return page_query.limit(limit).all()
+
+    return util.keyset_page(
+        cursor, per_page, field_names,
+        [partial(_coerce_field_value, fields[name]) for name in field_names],
+        fetch)
+
+
+def _seek_expression(document_class, field_names, values, after=True):
+    """Returns a query expression that matches the documents that come
+    after (or before, if `after` is False) the document with the given
+    values, in the order given by `field_names`. With more than one
+    field, this is written out as {$or: [{a: {$gt: x}}, {a: x, b:
+    {$gt: y}}]}.
+    """
+    expressions = []
+    for i, (name, value) in enumerate(zip(field_names, values)):
+        query_field = getattr(document_class, name)
+        compare = query_field > value if after else query_field < value
+        clause = {}
+        for prev_name, prev_value in zip(field_names[:i], values[:i]):
+            clause.update((getattr(document_class, prev_name) ==
+                           prev_value).obj)
+        clause.update(compare.obj)
+        expressions.append(QueryExpression(clause))
+    return reduce(lambda left, right: left | right, expressions)
+
+
+_python_types = {
+    ma.fields.BoolField: bool,
+    ma.fields.DateTimeField: datetime.datetime,
+    ma.fields.FloatField: float,
+    ma.fields.IntField: int,
+}
+
+
+def _coerce_field_value(field, value):
+    """Converts a value decoded from a cursor back into a value for a
+    MongoAlchemy field. Raises a ValueError if the value isn't valid
+    for the field.
+    """
+    value = util.coerce_value(_python_types.get(type(field)), value)
+    try:
+        return field.wrap(value) if value is not None else None
+    except BadValueException, e:
+        raise ValueError(str(e))
+
+
+def _get_mongo_ids(model_keys_list):
+    """Returns the ObjectIds for a list of model keys, leaving out the
+    ones that aren't valid ObjectIds.
+    """
+    mongo_ids = []
+    for model_keys in model_keys_list:
+        try:
+            mongo_ids.append(ObjectId(model_keys[0]))
+        except (InvalidId, TypeError, IndexError):
+            pass
+    return mongo_ids
+
+
+def _get_search_field_name(document_class):
+    """Returns the name of the field that is searched by prefix for a
+    given document class: the first string field, in alphabetical
+    order, or None if it has no string fields.
+    """
+    for name, field in sorted(document_class.get_fields().items()):
+        if isinstance(field, ma.fields.StringField):
+            return name
+    return None
+
+
 def _form_for_model(document_class, db_session):
     """returns a wtform Form object for a given document model class.
     """
@@ -10,24 +10,37 @@
 """
 from __future__ import absolute_import
 
+from collections import namedtuple
 import datetime
-from functools import wraps
+from functools import partial, wraps
 import inspect
 import os
+import re
+import threading
 import time
 import types
+import weakref
 
 import flask
 from flask import flash, render_template, redirect, request, url_for
-from flaskext.sqlalchemy import Pagination
+
 import sqlalchemy as sa
-from sqlalchemy.orm.exc import NoResultFound
 from wtforms import validators, widgets
 from wtforms.ext.sqlalchemy.orm import model_form, converts, ModelConverter
 from wtforms.ext.sqlalchemy import fields as sa_fields
 
 from flask.ext.admin.wtforms import *
-from flask.ext.admin.datastore import AdminDatastore
+from flask.ext.admin.datastore import AdminDatastore, \
+     BatchInsertError, ExactCount, count_rows
+from flask.ext.admin import util
+
+
+# maximum number of primary keys in a single bulk statement
+_BULK_CHUNK_SIZE = 500
+
+# dialects that sort NULLs after every other value in ascending order
+# (the others sort them first)
+_NULLS_LAST_DIALECTS = ('oracle', 'postgresql')
 
 
 class SQLAlchemyDatastore(AdminDatastore):
@@ -61,13 +74,113 @@ class SQLAlchemyDatastore(AdminDatastore):
     the nature of foreign key relationships. If you want to expose the
     primary key, set this to False.
 
+    The `keyset_pagination` parameter turns on keyset (a.k.a. seek)
+    pagination for the list view. Rather than skipping over the rows
+    of previous pages with an OFFSET, the list view will then seek
+    directly to the rows after (or before) the last row that was
+    displayed, so deep pages cost the same as the first page. Set it
+    to True to use keyset pagination on the primary key of every
+    model, or to a dict with model names as keys matched to either
+    True (seek on the primary key) or the name of an indexed,
+    non-nullable column to seek on. When a column is given, the
+    primary key is used to break ties between rows with equal values.
+
+    The `count_strategy` parameter controls how the total number of
+    rows is counted for the list view pagination. It can be set to a
+    count strategy object, like
+    :class:`~flask.ext.admin.datastore.core.CachedCount` or
+    :class:`ApproximateCount`, or to a dict with model names as keys
+    matched to count strategies. By default, rows are counted exactly
+    with a count query on each request.
+
+    By default, relationship fields in the generated forms are select
+    fields that list every instance of the related model, which means
+    loading the entire related table whenever a form is rendered. The
+    `autocomplete` parameter can be used to render these fields with
+    only their selected values instead; other options are then looked
+    up as you type through the admin's autocomplete view. Set it to
+    True to use autocomplete fields for every related model, or to a
+    dict with related model names as keys matched to either True or
+    the name of the (preferably indexed) column that should be
+    searched by prefix. By default, the first string column of the
+    related model is searched.
+
+    The `list_columns` parameter can be set to a dict with model names
+    as keys matched to lists of attribute names. For these models, the
+    list view shows a table of those columns instead of the model's
+    __repr__, and only those columns (plus the primary key) are
+    loaded, so large TEXT and BLOB columns are left in the database.
+
+    If `concurrent_count` is set to True, the list view runs the count
+    query on a small thread pool while the page itself is fetched, so
+    a list view costs roughly the slower of the two queries rather
+    than both. The count then runs in a session (and connection) of
+    its own, so it won't see changes that haven't been committed yet,
+    and it can't be used with an in-memory SQLite database, which
+    exists only for the connection that created it.
+
+    The `eager_load` parameter loads relationships along with the
+    model instances of the list and edit views, so that a __repr__
+    (or a list column) that uses a relationship doesn't cost a query
+    per row. Related objects are loaded with a join, and related
+    collections with one extra query per page (collections aren't
+    eager loaded when the list view is streamed, since that fetches
+    rows in batches). Set it to True to eager load every relationship
+    of every model (in the list view of a model with `list_columns`,
+    only the relationships among them), or to a dict with model names
+    as keys matched to either True or a list of relationship names.
+
+    The list view can be sorted on a column by clicking on its name.
+    By default, only columns that lead an index (including the
+    primary key and unique columns) declared on the model's table are
+    sortable, since sorting a large table on any other column means
+    sorting the whole table for every page. Indexes that exist in the
+    database but aren't declared on the table aren't seen. The
+    `sortable_columns` parameter can be set to True to make every
+    column sortable, or to a dict with model names as keys matched to
+    either True or a list of the attribute names that are sortable.
+    Rows with equal values are ordered by primary key, and the list
+    view is ordered by primary key when it isn't sorted.
+
+    The list view can also be filtered on columns, and searched by
+    prefix with a search box on the column that the autocomplete view
+    searches (see `autocomplete`). Filters and the search box also
+    apply to exports. Like sorting, this is limited to the columns
+    that lead an index by default; the `filterable_columns` parameter
+    works like `sortable_columns` and can be used to allow others.
+
+    The `choices_cache` parameter can be set to a :class:`ChoicesCache`
+    (or to True for one with the default ttl) to cache the options of
+    the relationship select fields in the generated forms, instead of
+    loading the related table every time a form is created. The
+    cached options of a model are dropped whenever the datastore
+    saves, inserts, updates or deletes instances of it.
+
     .. _SQLAlchemy in Flask: http://flask.pocoo.org/docs/patterns/sqlalchemy/
     .. _WTForms documentation: http://wtforms.simplecodes.com/
     """
-    def __init__(self, models, db_session, model_forms=None, exclude_pks=True):
+    def __init__(self, models, db_session, model_forms=None, exclude_pks=True,
+                 keyset_pagination=None, count_strategy=None,
+                 autocomplete=None, list_columns=None,
+                 concurrent_count=False, eager_load=None,
+                 choices_cache=None, sortable_columns=None,
+                 filterable_columns=None):
         self.model_classes = {}
         self.model_forms = model_forms
         self.db_session = db_session
+        self.keyset_pagination = keyset_pagination
+        self.count_strategy = count_strategy
+        self.concurrent_count = concurrent_count
+        self.autocomplete = autocomplete
+        self.list_columns = list_columns or {}
+        self.eager_load = eager_load
+        self.choices_cache = ChoicesCache() if choices_cache is True \
+                             else choices_cache
+        self.sortable_columns = sortable_columns
+        self.filterable_columns = filterable_columns
+        self._list_options = {}
+        self._eager_options = {}
+        self._column_lists = {}
 
         if not self.model_forms:
             self.model_forms = {}
@@ -85,34 +198,158 @@ class SQLAlchemyDatastore(AdminDatastore):
                  if isinstance(model, sa.ext.declarative.DeclarativeMeta)
                  and model.__name__ != 'Base'])
 
-        if self.model_classes:
-            self.form_dict = dict(
-                [(k, _form_for_model(v, db_session,
-                                     exclude_pk=exclude_pks))
-                 for k, v in self.model_classes.items()])
-            for model_name, form in self.model_forms.items():
-                if model_name in self.form_dict:
-                    self.form_dict[model_name] = form
-
-    def create_model_pagination(self, model_name, page, per_page=25):
-        """Returns a pagination object for the list view."""
+        self.pk_info = dict(
+            [(v, _pk_info_for(v)) for v in self.model_classes.values()])
+
+        # forms are generated the first time they are asked for (see
+        # get_model_form), so only custom forms are known up front
+        self.exclude_pks = exclude_pks
+        self.autocomplete_models = dict(
+            [(v, k) for k, v in self.model_classes.items()
+             if autocomplete is True or
+             (isinstance(autocomplete, dict) and autocomplete.get(k))])
+        self.form_dict = dict(
+            [(k, v) for k, v in self.model_forms.items()
+             if k in self.model_classes])
+        self._form_lock = threading.Lock()
+        # the choices caches of the forms of running imports
+        self._import_caches = weakref.WeakSet()
+
+    def create_model_pagination(self, model_name, page, per_page=25,
+                                cursor=None, stream=False, sort=None,
+                                filters=None):
+        """Returns a pagination object for the list view. If `stream`
+        is True, the items of numbered pages are an iterator that
+        fetches rows from the database in batches (with yield_per) as
+        they are consumed. Sorting on a column that isn't sortable,
+        and filters on columns that aren't filterable, are ignored.
+        """
         model_class = self.model_classes[model_name]
-        model_instances = self.db_session.query(model_class)
+        model_instances = self._filter_query(
+            model_name, self.db_session.query(model_class), filters)
+        keyset_columns = self._get_keyset_columns(model_name)
+        list_options = self._get_list_options(model_name)
+        if list_options:
+            model_instances = model_instances.options(*list_options)
+        # eager loads only go on the queries for the items, not on
+        # the count query (keyset pages are never streamed)
+        eager_options = self._get_eager_options(
+            model_name, list_view=True,
+            collections=bool(keyset_columns) or not stream)
+        sort_columns, descending = self._get_sort_columns(model_name, sort)
+        if keyset_columns:
+            if sort_columns:
+                keyset_columns = sort_columns
+                # the sort column may be deferred by the list options,
+                # but the cursors need its value
+                eager_options = eager_options + [
+                    sa.orm.undefer(sort_columns[0].key)]
+            bind = self.db_session.get_bind(sa.orm.class_mapper(model_class))
+            return _keyset_pagination(
+                model_instances.options(*eager_options), keyset_columns,
+                per_page, cursor, descending=descending,
+                nulls_last=bind.dialect.name in _NULLS_LAST_DIALECTS)
+        # without an order, the database may return rows in a
+        # different order for each page
+        order_columns = sort_columns or \
+                        self._get_pk_info(model_class).attributes
         offset = (page - 1) * per_page
-        items = model_instances.limit(per_page).offset(offset).all()
-        return Pagination(model_instances, page, per_page,
-                          model_instances.count(), items)
+        page_query = model_instances.options(*eager_options) \
+                                    .order_by(*[column.desc() if descending
+                                                else column.asc()
+                                                for column in order_columns]) \
+                                    .limit(per_page).offset(offset)
+        count_strategy = self._get_count_strategy(model_name)
+        if stream:
+            total_count, estimated = count_rows(
+                count_strategy, self, model_name, model_instances, filters)
+            # estimated paginations look at the number of items to
+            # find out if there is a next page, so they can't stream
+            if estimated:
+                items = page_query.all()
+            else:
+                items = iter(page_query.yield_per(util.STREAM_BATCH_SIZE))
+        elif self.concurrent_count:
+            (total_count, estimated), items = util.call_concurrently(
+                self._concurrent_count(count_strategy, model_name,
+                                       model_instances, filters),
+                page_query.all)
+        else:
+            items = page_query.all()
+            total_count, estimated = count_rows(
+                count_strategy, self, model_name, model_instances, filters)
+        return util.Pagination(page, per_page, total_count, items,
+                               estimated=estimated)
 
     def delete_model_instance(self, model_name, model_keys):
         """Deletes a model instance. Returns True if model instance
-        was successfully deleted, returns False otherwise.
+        was successfully deleted, returns False otherwise. If nothing
+        has to happen in the session when the model instance is
+        deleted (no cascades and no delete or flush event listeners),
+        its row is deleted with a single DELETE statement instead of
+        being loaded first.
         """
-        model_instance = self.find_model_instance(model_name, model_keys)
-        if not model_instance:
+        model_class = self.get_model_class(model_name)
+        if not _can_delete_directly(sa.orm.class_mapper(model_class),
+                                    self.db_session):
+            model_instance = self.find_model_instance(model_name, model_keys)
+            if not model_instance:
+                return False
+            self.db_session.delete(model_instance)
+            self._invalidate_choices(model_class)
+            self.db_session.commit()
+            return True
+
+        ident = self._get_ident(model_class, model_keys)
+        if ident is None:
             return False
-        self.db_session.delete(model_instance)
-        self.db_session.commit()
-        return True
+        try:
+            deleted = self.db_session.query(model_class).filter(
+                self._pk_criterion(model_class, ident)).delete(
+                    synchronize_session=False)
+            # don't leave a stale copy of the row in the session
+            model_instance = self.db_session.identity_map.get(
+                sa.orm.util.identity_key(model_class, ident))
+            if model_instance is not None:
+                self.db_session.expunge(model_instance)
+            self._invalidate_choices(model_class)
+            self.db_session.commit()
+        except:
+            self.db_session.rollback()
+            raise
+        return bool(deleted)
+
+    def delete_model_instances(self, model_name, model_keys_list):
+        """Deletes the model instances matching each of the model keys
+        in `model_keys_list` in a single transaction, and returns the
+        number of model instances that were deleted. Rows are deleted
+        with DELETE ... WHERE pk IN (...) statements, unless the model
+        has relationships or delete event listeners, or the session has
+        flush event listeners, in which case the model instances are
+        deleted through the session so that cascades and listeners
+        still work.
+        """
+        model_class = self.model_classes[model_name]
+        query = self.db_session.query(model_class)
+        delete_directly = _can_delete_directly(
+            sa.orm.class_mapper(model_class), self.db_session)
+        deleted = 0
+        try:
+            for criterion in self._pk_in_criteria(model_class,
+                                                  model_keys_list):
+                if delete_directly:
+                    deleted += query.filter(criterion).delete(
+                        synchronize_session=False)
+                else:
+                    for model_instance in query.filter(criterion):
+                        self.db_session.delete(model_instance)
+                        deleted += 1
+            self._invalidate_choices(model_class)
+            self.db_session.commit()
+        except:
+            self.db_session.rollback()
+            raise
+        return deleted
 
     def find_model_instance(self, model_name, model_keys):
         """Returns a model instance, if one exists, that matches
@@ -120,55 +357,574 @@ class SQLAlchemyDatastore(AdminDatastore):
         instance exists.
         """
         model_class = self.get_model_class(model_name)
-        pk_query_dict = {}
-
-        for key, value in zip(_get_pk_names(model_class), model_keys):
-            pk_query_dict[key] = value
-
-        try:
-            return self.db_session.query(model_class).filter_by(
-                **pk_query_dict).one()
-        except NoResultFound:
+        ident = self._get_ident(model_class, model_keys)
+        if ident is None:
             return None
 
+        # Query.get() looks in the session's identity map before going
+        # to the database
+        return self.db_session.query(model_class).options(
+            *self._get_eager_options(model_name)).get(ident)
+
     def get_model_class(self, model_name):
         """Returns a model class, given a model name."""
         return self.model_classes[model_name]
 
     def get_model_form(self, model_name):
-        """Returns a form, given a model name."""
-        return self.form_dict[model_name]
+        """Returns a form, given a model name. Forms are generated
+        the first time they are requested and then reused.
+        """
+        try:
+            return self.form_dict[model_name]
+        except KeyError:
+            model_class = self.model_classes[model_name]
+
+        with self._form_lock:
+            if model_name not in self.form_dict:
+                self.form_dict[model_name] = _form_for_model(
+                    model_class, self.db_session,
+                    exclude_pk=self.exclude_pks,
+                    autocomplete_models=self.autocomplete_models,
+                    choices_cache=self.choices_cache)
+            return self.form_dict[model_name]
+
+    def get_import_form(self, model_name):
+        """Returns the form that rows of an import of a given model
+        are validated with. Unless the form is a custom one or the
+        datastore already has a `choices_cache`, it is generated with
+        a new :class:`ChoicesCache`, so that the related table of each
+        relationship field is loaded once per import rather than once
+        per row.
+        """
+        if self.choices_cache is not None or model_name in self.model_forms:
+            return self.get_model_form(model_name)
+        choices_cache = ChoicesCache()
+        with self._form_lock:
+            self._import_caches.add(choices_cache)
+        return _form_for_model(
+            self.model_classes[model_name], self.db_session,
+            exclude_pk=self.exclude_pks,
+            autocomplete_models=self.autocomplete_models,
+            choices_cache=choices_cache)
+
+    def get_list_columns(self, model_name):
+        """Returns the list of attribute names that the list view
+        should show as table columns for a given model, or None.
+        """
+        return self.list_columns.get(model_name)
+
+    def get_filterable_columns(self, model_name):
+        """Returns the list of attribute names that the list view of a
+        given model can be filtered on: the ones given by the
+        `filterable_columns` parameter, or else the columns that lead
+        an index of the model's table.
+        """
+        return self._get_column_list('filterable_columns', model_name)
+
+    def get_search_column(self, model_name):
+        """Returns the name of the column that the list view's search
+        box searches for a given model, which is the column that the
+        autocomplete view searches, or None if that column isn't
+        filterable.
+        """
+        name = self._get_search_column(model_name).key
+        if name in self.get_filterable_columns(model_name):
+            return name
+        return None
+
+    def get_sortable_columns(self, model_name):
+        """Returns the list of attribute names that the list view of a
+        given model can be sorted on: the ones given by the
+        `sortable_columns` parameter, or else the columns that lead an
+        index of the model's table.
+        """
+        return self._get_column_list('sortable_columns', model_name)
 
     def get_model_keys(self, model_instance):
         """Returns the keys for a given a model instance."""
-        return [getattr(model_instance, value)
-                for value in _get_pk_names(model_instance)]
+        return [getattr(model_instance, name)
+                for name in self._get_pk_info(type(model_instance)).names]
+
+    def insert_from_forms(self, model_name, forms):
+        """Inserts a new row for each of a batch of validated forms and
+        commits. Rows are written with executemany INSERT statements
+        rather than through the session, except for models with a
+        custom form or more than one table and for forms that set
+        related collections, which need the session's unit of work.
+        If the database rejects any of the rows, the transaction is
+        rolled back and a BatchInsertError is raised.
+        """
+        model_class = self.model_classes[model_name]
+        mapper = sa.orm.class_mapper(model_class)
+        use_rows = model_name not in self.model_forms and \
+                   len(mapper.tables) == 1
+        rows = {}
+        model_instances = []
+        for form in forms:
+            row = _insert_row(mapper, form) if use_rows else None
+            if row is None:
+                model_instances.append(
+                    self.update_from_form(model_class(), form))
+            else:
+                rows.setdefault(frozenset(row), []).append(row)
+
+        try:
+            # rows with the same columns can share a statement
+            for same_columns in rows.values():
+                self.db_session.execute(mapper.local_table.insert(),
+                                        same_columns)
+            self.db_session.add_all(model_instances)
+            self._invalidate_choices(model_class)
+            self.db_session.commit()
+        except sa.exc.SQLAlchemyError, e:
+            self.db_session.rollback()
+            raise BatchInsertError(str(e))
+        except:
+            self.db_session.rollback()
+            raise
+        return len(forms)
+
+    def iter_model_rows(self, model_name, filters=None):
+        """Returns a tuple of (column names, rows) for exporting all
+        the instances of a model, or the ones that match `filters`.
+        The rows are plain tuples rather than model instances, and are
+        fetched from a server-side cursor (where the database driver
+        supports it) in batches.
+        """
+        model_class = self.model_classes[model_name]
+        mapper = sa.orm.class_mapper(model_class)
+        column_names = mapper.columns.keys()
+        query = self._filter_query(model_name, self.db_session.query(
+            *[getattr(model_class, name) for name in column_names]), filters)
+        query = query.order_by(*self._get_pk_info(model_class).attributes)
+        rows = query.execution_options(stream_results=True).yield_per(
+            util.STREAM_BATCH_SIZE)
+        return column_names, iter(rows)
 
     def list_model_names(self):
         """Returns a list of model names available in the datastore."""
         return self.model_classes.keys()
 
+    def merge_model_instance(self, model_instance):
+        """Returns a copy of a detached model instance that belongs to
+        the current session, without querying the database.
+        """
+        return self.db_session.merge(model_instance, load=False)
+
     def save_model(self, model_instance):
         """Persists a model instance to the datastore. Note: this
-        could be called when a model instance is added or edited.
+        could be called when a model instance is added or edited. If
+        nothing in the session has changed, nothing is written.
         """
+        if model_instance in self.db_session and \
+               not self.db_session.new and not self.db_session.deleted and \
+               not any(self.db_session.is_modified(instance, passive=True)
+                       for instance in self.db_session.dirty):
+            return
         self.db_session.add(model_instance)
+        # the session may be writing instances of other models too
+        for instance in set(self.db_session.new) | \
+                set(self.db_session.dirty) | set(self.db_session.deleted):
+            self._invalidate_choices(type(instance))
         self.db_session.commit()
 
+    def search_model_instances(self, model_name, prefix, limit=25, offset=0):
+        """Returns a list of at most `limit` model instances, starting
+        at `offset`, whose search column starts with `prefix`.
+        """
+        column = self._get_search_column(model_name)
+        query = self.db_session.query(self.model_classes[model_name])
+        if prefix:
+            query = query.filter(column.like(_escape_like(prefix) + u'%',
+                                             escape='\\'))
+        return query.order_by(column).limit(limit).offset(offset).all()
+
+    def update_model_instances(self, model_name, model_keys_list, values):
+        """Sets the column attributes in the `values` dict on the model
+        instances matching each of the model keys in `model_keys_list`
+        with UPDATE ... WHERE pk IN (...) statements in a single
+        transaction, and returns the number of rows that were updated.
+        """
+        model_class = self.model_classes[model_name]
+        query = self.db_session.query(model_class)
+        updated = 0
+        try:
+            for criterion in self._pk_in_criteria(model_class,
+                                                  model_keys_list):
+                updated += query.filter(criterion).update(
+                    values, synchronize_session=False)
+            self._invalidate_choices(model_class)
+            self.db_session.commit()
+        except:
+            self.db_session.rollback()
+            raise
+        return updated
+
     def update_from_form(self, model_instance, form):
         """Returns a model instance whose values have been updated
-        with the values from a given form.
+        with the values from a given form. Only the fields whose data
+        differs from the model instance's values are populated, so
+        that the UPDATE statement only sets the columns that changed.
         """
         for name, field in form._fields.iteritems():
-            field.populate_obj(model_instance, name)
+            if util.has_changed(model_instance, name, field.data):
+                field.populate_obj(model_instance, name)
 
         return model_instance
 
+    def _invalidate_choices(self, model_class):
+        if self.choices_cache is not None:
+            self.choices_cache.invalidate(model_class)
+        with self._form_lock:
+            import_caches = list(self._import_caches)
+        for choices_cache in import_caches:
+            choices_cache.invalidate(model_class)
 
-def _form_for_model(model_class, db_session, exclude=None, exclude_pk=True):
+    def _get_search_column(self, model_name):
+        """Returns the model attribute that is searched by prefix for
+        a given model.
+        """
+        model_class = self.model_classes[model_name]
+        if isinstance(self.autocomplete, dict) and \
+               isinstance(self.autocomplete.get(model_name), basestring):
+            return getattr(model_class, self.autocomplete[model_name])
+
+        pk_names = self._get_pk_info(model_class).names
+        for prop in sa.orm.class_mapper(model_class).iterate_properties:
+            if isinstance(prop, sa.orm.properties.ColumnProperty) and \
+                   prop.key not in pk_names and \
+                   isinstance(prop.columns[0].type, sa.String):
+                return getattr(model_class, prop.key)
+        return getattr(model_class, pk_names[0])
+
+    def _concurrent_count(self, count_strategy, model_name, query,
+                          filters=None):
+        """Returns a function that runs a count strategy for `query`
+        in a new session, since a session can't be shared with the
+        thread pool that the function is called from.
+        """
+        bind = self.db_session.get_bind(
+            sa.orm.class_mapper(self.model_classes[model_name]))
+
+        def count():
+            session = sa.orm.Session(bind=bind)
+            try:
+                return count_rows(count_strategy, self, model_name,
+                                  query.with_session(session), filters)
+            finally:
+                session.close()
+        return count
+
+    def _filter_query(self, model_name, query, filters):
+        """Returns `query` filtered with a list of filters, leaving out
+        the ones on columns that aren't filterable. Raises a
+        ValueError if a filter's value can't be converted to the type
+        of its column, or if a prefix filter isn't on a string column.
+        """
+        model_class = self.model_classes[model_name]
+        filterable_columns = self.get_filterable_columns(model_name)
+        for name, operation, value in filters or []:
+            if name not in filterable_columns:
+                continue
+            column = getattr(model_class, name)
+            python_type = _get_python_type(column)
+            if operation == 'startswith':
+                if python_type not in (str, unicode, None):
+                    raise ValueError('%s is not a string column' % name)
+                query = query.filter(column.like(
+                    _escape_like(value) + u'%', escape='\\'))
+                continue
+            value = util.coerce_value(python_type, value)
+            if operation == 'eq':
+                query = query.filter(column == value)
+            elif operation == 'lt':
+                query = query.filter(column < value)
+            elif operation == 'lte':
+                query = query.filter(column <= value)
+            elif operation == 'gt':
+                query = query.filter(column > value)
+            elif operation == 'gte':
+                query = query.filter(column >= value)
+        return query
+
+    def _get_column_list(self, option, model_name):
+        """Returns the list of attribute names that the
+        `sortable_columns` or `filterable_columns` parameter (as named
+        by `option`) allows for a given model.
+        """
+        key = (option, model_name)
+        if key not in self._column_lists:
+            allowed = getattr(self, option)
+            if isinstance(allowed, dict):
+                allowed = allowed.get(model_name)
+            if isinstance(allowed, (list, tuple)):
+                names = list(allowed)
+            else:
+                names = _column_names(self.model_classes[model_name],
+                                      indexed_only=allowed is not True)
+            self._column_lists[key] = names
+        return self._column_lists[key]
+
+    def _get_count_strategy(self, model_name):
+        """Returns the count strategy to use for a given model."""
+        strategy = self.count_strategy
+        if isinstance(strategy, dict):
+            strategy = strategy.get(model_name)
+        return strategy or ExactCount()
+
+    def _get_ident(self, model_class, model_keys):
+        """Returns the primary key values of a model class, converted
+        from the strings in `model_keys` and in the order of the
+        mapper's primary key, or None if the model keys aren't valid.
+        """
+        pk_info = self._get_pk_info(model_class)
+        if len(model_keys) != len(pk_info.converters):
+            return None
+        try:
+            return _to_ident(pk_info, [
+                convert(value)
+                for convert, value in zip(pk_info.converters, model_keys)])
+        except ValueError:
+            return None
+
+    def _get_eager_options(self, model_name, list_view=False,
+                           collections=True):
+        """Returns the eager loading options for the relationships of
+        a given model that the `eager_load` parameter asks for. For
+        the `list_view` of a model with list columns, only the
+        relationships among them are loaded. Relationships to
+        collections are left out if `collections` is False.
+        """
+        key = (model_name, list_view, collections)
+        if key not in self._eager_options:
+            eager_load = self.eager_load
+            if isinstance(eager_load, dict):
+                eager_load = eager_load.get(model_name)
+            names = None
+            if isinstance(eager_load, (list, tuple)):
+                names = eager_load
+            elif list_view:
+                names = self.get_list_columns(model_name)
+            options = []
+            if eager_load:
+                options = _eager_load_relationships(
+                    self.model_classes[model_name], names, collections)
+            self._eager_options[key] = options
+        return self._eager_options[key]
+
+    def _get_sort_columns(self, model_name, sort):
+        """Returns a tuple of the list of model attributes that the
+        list view of a given model should be ordered by for a `sort`
+        argument (the sort column followed by the primary key), and
+        whether the order is descending. The list is None if the
+        argument doesn't name a sortable column.
+        """
+        name, descending = util.parse_sort(sort)
+        if name is None or name not in self.get_sortable_columns(model_name):
+            return None, False
+        model_class = self.model_classes[model_name]
+        return ([getattr(model_class, name)] +
+                [attribute for attribute
+                 in self._get_pk_info(model_class).attributes
+                 if attribute.key != name]), descending
+
+    def _get_keyset_columns(self, model_name):
+        """Returns the list of model attributes that keyset
+        pagination should seek on for a given model, or None if
+        keyset pagination isn't used for that model.
+        """
+        keyset = self.keyset_pagination
+        if isinstance(keyset, dict):
+            keyset = keyset.get(model_name)
+        if not keyset:
+            return None
+
+        pk_info = self._get_pk_info(self.model_classes[model_name])
+        if keyset is True or keyset in pk_info.names:
+            return pk_info.attributes
+        return [getattr(pk_info.model_class, keyset)] + pk_info.attributes
+
+    def _get_list_options(self, model_name):
+        """Returns the query options for the list view of a given
+        model: these defer every column that isn't shown in the list
+        view or needed for pagination.
+        """
+        if model_name not in self._list_options:
+            options = []
+            list_columns = self.get_list_columns(model_name)
+            if list_columns:
+                keep = set(list_columns)
+                keep.update(column.key for column in
+                            self._get_keyset_columns(model_name) or [])
+                options = _defer_columns(self.model_classes[model_name], keep)
+            self._list_options[model_name] = options
+        return self._list_options[model_name]
+
+    def _get_pk_info(self, model_class):
+        """Returns the PrimaryKeyInfo for a model class."""
+        try:
+            return self.pk_info[model_class]
+        except KeyError:
+            # e.g. a subclass of one of the models
+            pk_info = self.pk_info[model_class] = _pk_info_for(model_class)
+            return pk_info
+
+    def _pk_criterion(self, model_class, ident):
+        """Returns a criterion that matches the model instance with
+        the primary key values `ident`.
+        """
+        pk_info = self._get_pk_info(model_class)
+        return sa.and_(*[attribute == value for attribute, value
+                         in zip(_to_ident(pk_info, pk_info.attributes),
+                                ident)])
+
+    def _pk_in_criteria(self, model_class, model_keys_list):
+        """Returns a list of criteria that together match the model
+        instances for each of the model keys in `model_keys_list`,
+        each matching at most _BULK_CHUNK_SIZE primary keys so the
+        statements stay within the databases' limits on parameters.
+        Invalid model keys are left out.
+        """
+        attributes = self._get_pk_info(model_class).attributes
+        idents = [ident for ident in
+                  [self._get_ident(model_class, model_keys)
+                   for model_keys in model_keys_list]
+                  if ident is not None]
+        criteria = []
+        for i in xrange(0, len(idents), _BULK_CHUNK_SIZE):
+            chunk = idents[i:i + _BULK_CHUNK_SIZE]
+            if len(attributes) == 1:
+                criteria.append(attributes[0].in_(
+                    [ident[0] for ident in chunk]))
+            else:
+                criteria.append(sa.or_(*[
+                    self._pk_criterion(model_class, ident)
+                    for ident in chunk]))
+        return criteria
+
+
+class ApproximateCount(object):
+    """A count strategy that uses the query planner's row estimates
+    instead of counting rows. On PostgreSQL the estimate comes from
+    the table statistics in pg_class, or from EXPLAIN if the query is
+    filtered. On MySQL it comes from information_schema (which is
+    exact for MyISAM tables and an estimate for InnoDB tables).
+
+    Estimates for small tables can be off by a large fraction, so if
+    an estimate is smaller than `exact_below`, the rows are counted
+    exactly instead. Databases that don't provide row estimates (like
+    SQLite) are always counted exactly.
+    """
+    def __init__(self, exact_below=10000):
+        self.exact_below = exact_below
+
+    def count(self, datastore, model_name, query, filters=None):
+        estimate = self.estimate(datastore, model_name, query)
+        if estimate is None or estimate < self.exact_below:
+            return query.count(), False
+        return estimate, True
+
+    def estimate(self, datastore, model_name, query):
+        """Returns the planner's estimate of the number of rows that
+        `query` would return, or None if no estimate is available.
+        """
+        mapper = sa.orm.class_mapper(datastore.get_model_class(model_name))
+        bind = datastore.db_session.get_bind(mapper)
+        dialect = bind.dialect.name
+        table = mapper.local_table
+
+        if query.whereclause is not None:
+            if dialect not in ('postgresql', 'mysql'):
+                return None
+            compiled = query.statement.compile(dialect=bind.dialect)
+            # positional paramstyles (like the %s of MySQLdb) need the
+            # parameters in the order they appear in the statement
+            params = compiled.params
+            if compiled.positional:
+                params = tuple(params[name] for name in compiled.positiontup)
+            rows = bind.execute('EXPLAIN ' + unicode(compiled),
+                                params).fetchall()
+            if dialect == 'mysql':
+                return int(rows[0]['rows']) if rows else None
+            match = rows and re.search(r'rows=(\d+)', rows[0][0])
+            return int(match.group(1)) if match else None
+
+        if dialect == 'postgresql':
+            estimate = bind.execute(
+                sa.text('SELECT reltuples FROM pg_class '
+                        'WHERE oid = CAST(:table AS regclass)'),
+                table=table.fullname).scalar()
+        elif dialect == 'mysql':
+            estimate = bind.execute(
+                sa.text('SELECT table_rows FROM information_schema.tables '
+                        'WHERE table_schema = COALESCE(:schema, DATABASE()) '
+                        'AND table_name = :table'),
+                schema=table.schema, table=table.name).scalar()
+        else:
+            return None
+        return int(estimate) if estimate is not None else None
+
+
+def _can_delete_directly(mapper, db_session=None):
+    """Returns True if the rows of a mapped class can be deleted with
+    a DELETE statement without going through the session. The class
+    has to be mapped to a single table, without subclasses, a version
+    counter or delete event listeners, and the session must have
+    nothing to do for any of its relationships: a many-to-one
+    relationship is fine unless it cascades deletes, and any other
+    relationship is fine if it has passive_deletes set, which leaves
+    the related rows (or association rows) to the foreign keys' ON
+    DELETE rules in the database. If `db_session` is given, it must
+    not have flush event listeners either, since nothing is flushed.
+    """
+    if len(mapper.tables) != 1 or \
+       list(mapper.self_and_descendants) != [mapper] or \
+       mapper.version_id_col is not None or \
+       mapper.dispatch.before_delete or mapper.dispatch.after_delete:
+        return False
+    if db_session is not None:
+        if isinstance(db_session, sa.orm.scoping.ScopedSession):
+            db_session = db_session()
+        dispatch = db_session.dispatch
+        if dispatch.before_flush or dispatch.after_flush or \
+           dispatch.after_flush_postexec:
+            return False
+    for prop in mapper.iterate_properties:
+        if not isinstance(prop, sa.orm.properties.RelationshipProperty):
+            continue
+        if prop.direction is sa.orm.interfaces.MANYTOONE:
+            if prop.cascade.delete:
+                return False
+        elif not prop.passive_deletes:
+            return False
+    return True
+
+
+def _eager_load_relationships(model_class, names=None, collections=True):
+    """Returns query options that eager load the relationships of a
+    model class (or only the ones in `names`): a joinedload for each
+    relationship to a single object and, if `collections` is True, a
+    subqueryload for each relationship to a collection.
+    """
+    options = []
+    for prop in sa.orm.class_mapper(model_class).iterate_properties:
+        if not isinstance(prop, sa.orm.properties.RelationshipProperty) or \
+               (names is not None and prop.key not in names):
+            continue
+        if not prop.uselist:
+            options.append(sa.orm.joinedload(prop.key))
+        elif collections:
+            options.append(sa.orm.subqueryload(prop.key))
+    return options
+
+
+def _form_for_model(model_class, db_session, exclude=None, exclude_pk=True,
+                    autocomplete_models=None, choices_cache=None):
     """Return a form for a given model. This will be a form generated
     by wtforms.ext.sqlalchemy.model_form, but decorated with a
-    QuerySelectField for foreign keys.
+    QuerySelectField for foreign keys, or an AutocompleteSelectField
+    if the related model class is a key of `autocomplete_models`, or
+    a CachedQuerySelectField if a `choices_cache` is given.
     """
     if not exclude:
         exclude = []
@@ -190,11 +946,45 @@ def _form_for_model(model_class, db_session, exclude=None, exclude_pk=True):
                                   sa.orm.properties.RelationshipProperty)
                     and relationship.local_side[0].name not in pk_names])
     form = model_form(model_class, exclude=exclude,
-                      converter=AdminConverter(db_session))
+                      converter=AdminConverter(
+                          db_session, autocomplete_models=autocomplete_models,
+                          choices_cache=choices_cache))
 
     return form
 
 
+#: Primary key metadata for a model class: the names of the primary key
+#: attributes, the attributes themselves, functions (one for each
+#: attribute) that convert strings from urls into primary key values,
+#: and the positions of the attributes in the order of the mapper's
+#: primary key columns, which is the order that Query.get and identity
+#: keys expect the values in.
+PrimaryKeyInfo = namedtuple('PrimaryKeyInfo',
+                            'model_class names attributes converters '
+                            'ident_order')
+
+
+def _pk_info_for(model_class):
+    """Returns a PrimaryKeyInfo for a given model class."""
+    names = _get_pk_names(model_class)
+    attributes = [getattr(model_class, name) for name in names]
+    converters = [partial(util.coerce_value, _get_python_type(attribute))
+                  for attribute in attributes]
+    mapper = sa.orm.class_mapper(model_class)
+    ident_order = [names.index(mapper.get_property_by_column(column).key)
+                   for column in mapper.primary_key]
+    return PrimaryKeyInfo(model_class, names, attributes, converters,
+                          ident_order)
+
+
+def _to_ident(pk_info, values):
+    """Returns a list of primary key values, given in the order of
+    the primary key attribute names, in the order of the mapper's
+    primary key columns.
+    """
+    return [values[i] for i in pk_info.ident_order]
+
+
 def _get_pk_names(model):
     """Return the primary key attribute names for a given model
     (either instance or class).
@@ -206,6 +996,153 @@ def _get_pk_names(model):
                 prop.columns[0].primary_key]
 
 
+def _keyset_pagination(query, columns, per_page, cursor=None,
+                       descending=False, nulls_last=False):
+    """Returns a KeysetPagination for a query, seeking on the given
+    list of model attributes from the position encoded in `cursor`,
+    in ascending order or in `descending` order. `nulls_last` tells
+    whether the database sorts NULLs after (rather than before) every
+    other value in ascending order.
+    """
+    def fetch(values, forward, limit):
+        # going forward in a descending order, or backwards in an
+        # ascending one, means going towards smaller values
+        after = forward != descending
+        page_query = query
+        if values:
+            page_query = page_query.filter(_seek_clause(
+                columns, values, after=after, nulls_last=nulls_last))
+        return page_query.order_by(*[column.asc() if after
+                                     else column.desc()
+                                     for column in columns]) \
+                         .limit(limit).all()
+
+    return util.keyset_page(
+        cursor, per_page, [column.key for column in columns],
+        [partial(util.coerce_value, _get_python_type(column))
+         for column in columns], fetch)
+
+
+def _column_names(model_class, indexed_only=True):
+    """Returns the names of the column attributes of a model class,
+    or only of those whose column is the first column of the primary
+    key, of an index or of a unique constraint if `indexed_only` is
+    True.
+    """
+    leading_columns = set()
+    for table in sa.orm.class_mapper(model_class).tables:
+        column_lists = [list(table.primary_key.columns)] + \
+                       [list(index.columns) for index in table.indexes] + \
+                       [list(constraint.columns)
+                        for constraint in table.constraints
+                        if isinstance(constraint, sa.UniqueConstraint)]
+        leading_columns.update(columns[0] for columns in column_lists
+                               if columns)
+    return [prop.key
+            for prop in sa.orm.class_mapper(model_class).iterate_properties
+            if isinstance(prop, sa.orm.properties.ColumnProperty)
+            and len(prop.columns) == 1
+            and (not indexed_only or prop.columns[0] in leading_columns)]
+
+
+def _seek_clause(columns, values, after=True, nulls_last=False):
+    """Returns a where clause that matches the rows that come after
+    (or before, if `after` is False) the row with the given values,
+    in the order given by `columns`. This is written out as
+    (a > x) OR (a = x AND b > y) rather than as a row value
+    comparison, since not all databases support those. NULLs in
+    nullable columns are placed like the database sorts them: after
+    every other value in ascending order if `nulls_last` is True and
+    before them otherwise.
+    """
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        # == None compiles to IS NULL
+        equal = [prev_column == prev_value
+                 for prev_column, prev_value in zip(columns[:i], values[:i])]
+        # whether the NULLs are among the rows being sought
+        nulls_ahead = after == nulls_last
+        if value is None:
+            if nulls_ahead:
+                # only other NULLs lie ahead, and they are equal
+                continue
+            compare = column != None
+        else:
+            compare = column > value if after else column < value
+            if nulls_ahead and column.property.columns[0].nullable:
+                compare = sa.or_(compare, column == None)
+        clauses.append(sa.and_(*(equal + [compare])))
+    return sa.or_(*clauses)
+
+
+def _defer_columns(model_class, keep):
+    """Returns a list of query options that defer loading every
+    column attribute of a model class except for the primary key and
+    the attribute names in `keep`.
+    """
+    pk_names = _get_pk_names(model_class)
+    return [sa.orm.defer(prop.key)
+            for prop in sa.orm.class_mapper(model_class).iterate_properties
+            if isinstance(prop, sa.orm.properties.ColumnProperty)
+            and prop.key not in keep and prop.key not in pk_names]
+
+
+def _insert_row(mapper, form):
+    """Returns a dict of column values for inserting the data of a
+    validated form with a plain INSERT statement, or None if the form
+    has data that an INSERT statement can't hold: fields that aren't
+    mapped attributes, related collections or related instances that
+    haven't been saved yet. Empty values are left out so column
+    defaults apply.
+    """
+    row = {}
+    for name, field in form._fields.iteritems():
+        if not mapper.has_property(name):
+            return None
+        prop = mapper.get_property(name)
+        value = field.data
+        if isinstance(prop, sa.orm.properties.ColumnProperty):
+            if len(prop.columns) != 1:
+                return None
+            if value is not None:
+                row[prop.columns[0].key] = value
+        elif isinstance(prop, sa.orm.properties.RelationshipProperty):
+            if prop.direction is not sa.orm.interfaces.MANYTOONE:
+                if value:
+                    return None
+                continue
+            if value is None:
+                continue
+            related_mapper = sa.orm.object_mapper(value)
+            for local, remote in prop.local_remote_pairs:
+                remote_value = getattr(
+                    value, related_mapper.get_property_by_column(remote).key)
+                if remote_value is None:
+                    return None
+                row[local.key] = remote_value
+        else:
+            return None
+    return row
+
+
+def _escape_like(value):
+    """Escapes the LIKE wildcards in a value, using backslash as the
+    escape character.
+    """
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_')
+
+
+def _get_python_type(attribute):
+    """Returns the python type of the column behind a model
+    attribute, or None if it is not known.
+    """
+    try:
+        return attribute.property.columns[0].type.python_type
+    except (AttributeError, NotImplementedError):
+        return None
+
+
 def _query_factory_for(model_class, db_session):
     """Return a query factory for a given model_class. This gives us
     an all-purpose way of generating query factories for
@@ -217,6 +1154,170 @@ def _query_factory_for(model_class, db_session):
     return query_factory
 
 
+class AutocompleteSelectField(sa_fields.QuerySelectField):
+    """A QuerySelectField that never loads the whole related table.
+    Only the currently selected instance is rendered as an option;
+    the rest of the options are filled in by the browser from the
+    admin's autocomplete view. Submitted values are looked up by
+    primary key.
+    """
+    widget = AutocompleteSelectWidget()
+
+    def __init__(self, label=None, validators=None, model_class=None,
+                 model_name=None, db_session=None, pk_info=None, **kwargs):
+        super(AutocompleteSelectField, self).__init__(
+            label, validators, **kwargs)
+        self.model_class = model_class
+        self.model_name = model_name
+        self.db_session = db_session
+        self.pk_info = pk_info or _pk_info_for(model_class)
+
+    def _get_object_list(self):
+        if self._object_list is None:
+            if self._formdata is not None:
+                objs = self._find_objects(self._formdata_pks())
+            else:
+                objs = self._selected_objects()
+            # option values are the primary key values in the same
+            # order as the ids returned by the autocomplete view
+            self._object_list = [
+                (u':'.join(unicode(getattr(obj, name))
+                           for name in self.pk_info.names), obj)
+                for obj in objs]
+        return self._object_list
+
+    def _formdata_pks(self):
+        return [self._formdata]
+
+    def _selected_objects(self):
+        return [self._data] if self._data is not None else []
+
+    def _find_objects(self, pks):
+        """Looks up the instances for a list of option values."""
+        converters = self.pk_info.converters
+        query = self.db_session.query(self.model_class)
+        objs = []
+        for pk in pks:
+            values = pk.split(u':') if len(converters) > 1 else [pk]
+            if len(values) != len(converters):
+                continue
+            try:
+                ident = _to_ident(self.pk_info, [
+                    convert(value)
+                    for convert, value in zip(converters, values)])
+            except ValueError:
+                continue
+            obj = query.get(ident)
+            if obj is not None:
+                objs.append(obj)
+        return objs
+
+
+class AutocompleteSelectMultipleField(AutocompleteSelectField,
+                                      sa_fields.QuerySelectMultipleField):
+    """The multiple select version of AutocompleteSelectField."""
+    widget = AutocompleteSelectWidget(multiple=True)
+
+    def _formdata_pks(self):
+        return list(self._formdata)
+
+    def _selected_objects(self):
+        return list(self._data or [])
+
+    def pre_validate(self, form):
+        # QuerySelectMultipleField only notices submitted values that
+        # couldn't be found once its data has been looked up, so make
+        # sure that has happened before validating
+        self._get_data()
+        super(AutocompleteSelectMultipleField, self).pre_validate(form)
+
+
+class CachedQuerySelectField(AutocompleteSelectField):
+    """A select field whose options come from a :class:`ChoicesCache`
+    rather than from a query of the whole related table. Submitted
+    values are checked against the cached primary keys, and only the
+    selected instances are loaded.
+    """
+    widget = widgets.Select()
+
+    def __init__(self, label=None, validators=None, choices_cache=None,
+                 **kwargs):
+        super(CachedQuerySelectField, self).__init__(
+            label, validators, **kwargs)
+        self.choices_cache = choices_cache
+
+    def iter_choices(self):
+        if self.allow_blank and not self.widget.multiple:
+            yield (u'__None', self.blank_text, self.data is None)
+        selected = set(pk for pk, obj in self._get_object_list())
+        choices, pks = self.choices_cache.get_choices(self.model_class,
+                                                      self.db_session)
+        for pk, label in choices:
+            yield (pk, label, pk in selected)
+
+    def _find_objects(self, pks):
+        choices, valid_pks = self.choices_cache.get_choices(
+            self.model_class, self.db_session)
+        return super(CachedQuerySelectField, self)._find_objects(
+            [pk for pk in pks if pk in valid_pks])
+
+
+class CachedQuerySelectMultipleField(CachedQuerySelectField,
+                                     AutocompleteSelectMultipleField):
+    """The multiple select version of CachedQuerySelectField."""
+    widget = widgets.Select(multiple=True)
+
+
+class ChoicesCache(object):
+    """Caches the options of the relationship select fields of
+    generated forms for `ttl` seconds, as (primary key, label) tuples
+    for each related model class, so that the related table is only
+    loaded once per `ttl` rather than every time a form is created.
+    Call :meth:`invalidate` to drop the cached options of a model
+    class; the datastore does so whenever it writes instances of it.
+    """
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._versions = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_choices(self, model_class, db_session):
+        """Returns a list of (primary key, label) tuples of every
+        instance of `model_class`, sorted by label, and a frozenset of
+        the primary keys.
+        """
+        version = self._versions.get(model_class, 0)
+        entry = self._entries.get(model_class)
+        if entry is not None and entry[0] == version and \
+               entry[1] > time.time():
+            return entry[2], entry[3]
+
+        choices = sorted(
+            [(unicode(sa_fields.get_pk_from_identity(obj)), unicode(obj))
+             for obj in db_session.query(model_class)],
+            key=lambda choice: choice[1])
+        pks = frozenset(pk for pk, label in choices)
+        with self._lock:
+            # don't cache choices that were invalidated while loading
+            if self._versions.get(model_class, 0) == version:
+                self._entries[model_class] = (
+                    version, time.time() + self.ttl, choices, pks)
+        return choices, pks
+
+    def invalidate(self, model_class=None):
+        """Drops the cached options of `model_class`, or of every
+        model class if none is given.
+        """
+        with self._lock:
+            model_classes = [model_class] if model_class is not None \
+                            else self._entries.keys()
+            for model_class in model_classes:
+                self._versions[model_class] = \
+                    self._versions.get(model_class, 0) + 1
+                self._entries.pop(model_class, None)
+
+
 class AdminConverter(ModelConverter):
     """Subclass of the wtforms sqlalchemy Model Converter that handles
     relationship properties and uses custom widgets for date and
@@ -224,6 +1325,9 @@ class AdminConverter(ModelConverter):
     """
     def __init__(self, db_session, *args, **kwargs):
         self.db_session = db_session
+        self.autocomplete_models = kwargs.pop('autocomplete_models',
+                                              None) or {}
+        self.choices_cache = kwargs.pop('choices_cache', None)
         super(AdminConverter, self).__init__(*args, **kwargs)
 
     def convert(self, model, mapper, prop, field_args):
@@ -290,6 +1394,36 @@ class AdminConverter(ModelConverter):
             local_column = prop.local_remote_pairs[0][0]
             foreign_model = prop.mapper.class_
 
+            if foreign_model in self.autocomplete_models and \
+                   prop.direction in (sa.orm.properties.MANYTOONE,
+                                      sa.orm.properties.MANYTOMANY):
+                if prop.direction == sa.orm.properties.MANYTOONE:
+                    field_class = AutocompleteSelectField
+                else:
+                    field_class = AutocompleteSelectMultipleField
+                return field_class(
+                    foreign_model.__name__,
+                    model_class=foreign_model,
+                    model_name=self.autocomplete_models[foreign_model],
+                    db_session=self.db_session,
+                    pk_info=_pk_info_for(foreign_model),
+                    allow_blank=local_column.nullable)
+
+            if self.choices_cache is not None and \
+                   prop.direction in (sa.orm.properties.MANYTOONE,
+                                      sa.orm.properties.MANYTOMANY):
+                if prop.direction == sa.orm.properties.MANYTOONE:
+                    field_class = CachedQuerySelectField
+                else:
+                    field_class = CachedQuerySelectMultipleField
+                return field_class(
+                    foreign_model.__name__,
+                    model_class=foreign_model,
+                    db_session=self.db_session,
+                    pk_info=_pk_info_for(foreign_model),
+                    choices_cache=self.choices_cache,
+                    allow_blank=local_column.nullable)
+
             if prop.direction == sa.orm.properties.MANYTOONE:
                 return sa_fields.QuerySelectField(
                     foreign_model.__name__,
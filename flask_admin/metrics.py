@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.admin.metrics
+    ~~~~~~~~~~~~~~
+
+    Defines an in-process collector of counters and histograms that
+    can be exported in the Prometheus text exposition format.
+
+    :copyright: (c) 2011 by wilsaj.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+from bisect import bisect_left
+import threading
+
+
+#: The default upper bounds of the buckets of a latency histogram, in
+#: seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+#: The upper bounds of the buckets of the rows per list page histogram
+ROW_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+#: The content type of the text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics(object):
+    """Collects counters and histograms in-process. Each thread adds
+    to its own accumulator, so recording a value never waits for a
+    lock; the accumulators are only added up when the metrics are
+    rendered with :meth:`render`. The accumulators of threads that
+    have finished are folded into a single one at that point.
+
+    Counters are increased with :meth:`inc` and histograms are fed
+    with :meth:`observe`. Both take the labels of the series as
+    keyword arguments. A histogram's buckets (:data:`LATENCY_BUCKETS`
+    by default) and a metric's help text can be set with
+    :meth:`describe`. The metrics recorded by Flask-Admin itself are
+    described when a Metrics object is created.
+    """
+    def __init__(self):
+        self._descriptions = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._accumulators = []
+        self._retired = {}
+
+        self.describe('flask_admin_view_duration_seconds', 'histogram',
+                      'Time spent in each admin view.')
+        self.describe('flask_admin_datastore_call_duration_seconds',
+                      'histogram', 'Time spent in each datastore call.')
+        self.describe('flask_admin_form_validation_failures_total',
+                      'counter', 'Forms (or imported rows) that failed '
+                      'validation.')
+        self.describe('flask_admin_list_rows_rendered', 'histogram',
+                      'Rows rendered per list view page.',
+                      buckets=ROW_BUCKETS)
+        self.describe('flask_admin_cache_requests_total', 'counter',
+                      'Cache lookups, by result (hit or miss).')
+
+    def describe(self, name, type, help=None, buckets=None):
+        """Sets the `type` ('counter' or 'histogram') and the `help`
+        text of a metric, and the upper `buckets` bounds if it is a
+        histogram.
+        """
+        self._descriptions[name] = (type, help, tuple(
+            buckets if buckets is not None else LATENCY_BUCKETS))
+
+    def inc(self, name, value=1, **labels):
+        """Increases the counter `name` with `labels` by `value`."""
+        key = (name, tuple(sorted(labels.items())))
+        accumulator = self._get_accumulator()
+        accumulator[key] = accumulator.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Adds `value` to the histogram `name` with `labels`."""
+        buckets = self._get_buckets(name)
+        key = (name, tuple(sorted(labels.items())))
+        accumulator = self._get_accumulator()
+        counts = accumulator.get(key)
+        if counts is None:
+            # a count for each bucket and for +Inf, followed by the sum
+            counts = accumulator[key] = [0] * (len(buckets) + 1) + [0.0]
+        counts[bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self):
+        """Returns a dict of the totals of all the threads' series,
+        keyed by (name, labels). Counters map to their value, and
+        histograms to a list of the counts of each bucket (not
+        cumulative, with the +Inf bucket last) followed by the sum of
+        the observed values.
+        """
+        with self._lock:
+            alive = []
+            for thread, accumulator in self._accumulators:
+                if thread.is_alive():
+                    alive.append((thread, accumulator))
+                else:
+                    _merge(self._retired, accumulator)
+            self._accumulators = alive
+            totals = {}
+            _merge(totals, self._retired)
+            for thread, accumulator in alive:
+                _merge(totals, accumulator)
+        return totals
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition
+        format.
+        """
+        series = {}
+        for (name, labels), value in self.collect().items():
+            series.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(series):
+            # metrics that haven't been described are histograms if
+            # they were fed with observe(), and counters otherwise
+            type, help, buckets = self._descriptions.get(name, (
+                'histogram' if isinstance(series[name][0][1], list)
+                else 'counter', None, LATENCY_BUCKETS))
+            if help:
+                lines.append('# HELP %s %s' % (name, _escape(help, False)))
+            lines.append('# TYPE %s %s' % (name, type))
+            for labels, value in sorted(series[name]):
+                if type != 'histogram':
+                    lines.append('%s%s %s' % (name, _format_labels(labels),
+                                              _format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(
+                            labels + (('le', _format_value(bound)),)),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (
+                    name, _format_labels(labels), _format_value(value[-1])))
+                lines.append('%s_count%s %d' % (
+                    name, _format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def _get_accumulator(self):
+        """Returns the calling thread's accumulator."""
+        try:
+            return self._local.accumulator
+        except AttributeError:
+            accumulator = self._local.accumulator = {}
+            with self._lock:
+                self._accumulators.append(
+                    (threading.current_thread(), accumulator))
+            return accumulator
+
+    def _get_buckets(self, name):
+        try:
+            return self._descriptions[name][2]
+        except KeyError:
+            return LATENCY_BUCKETS
+
+
+def _merge(totals, accumulator):
+    """Adds the series of `accumulator` to `totals`."""
+    # items() makes a copy, so the accumulator's thread can keep
+    # adding series while this runs
+    for key, value in accumulator.items():
+        if isinstance(value, list):
+            current = totals.get(key)
+            if current is None:
+                totals[key] = list(value)
+            else:
+                totals[key] = [a + b for a, b in zip(current, value)]
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def _escape(value, quotes=True):
+    value = unicode(value).replace('\\', '\\\\').replace('\n', '\\n')
+    if quotes:
+        value = value.replace('"', '\\"')
+    return value
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, _escape(value))
+                              for name, value in labels])
+
+
+def _format_value(value):
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.admin.signals
+    ~~~~~~~~~~~~~~
+
+    Defines the signals sent by Flask-Admin. Like Flask's own signals,
+    they require the blinker library; without it, sending them does
+    nothing and connecting to them raises an error.
+
+    :copyright: (c) 2011 by wilsaj.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+from flask.signals import Namespace
+
+
+_signals = Namespace()
+
+#: Sent by an :class:`InstrumentedDatastore` after each datastore call
+#: made during a request, with the name of the `method`, its
+#: `duration` in seconds and the number of SQL `statements` it
+#: executed.
+datastore_called = _signals.signal('datastore-called')
+
+#: Sent by the admin blueprint at the end of each request that went
+#: through an :class:`InstrumentedDatastore`, with the application as
+#: the sender and a dict of the request's :class:`CallStats` for each
+#: datastore method as `stats`.
+datastore_request_finished = _signals.signal('datastore-request-finished')
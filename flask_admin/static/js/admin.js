@@ -24,10 +24,10 @@ $(function(){
         return $('label[for="'+id+'"]').text();
     };
 
-    $('.edit_form select:empty')
+    $('.edit_form select:empty:not([data-autocomplete-url])')
         .append('<option value="__None"></option>');
 
-    $('.edit_form select > option[value="__None"]:only-child').parent()
+    $('.edit_form select:not([data-autocomplete-url]) > option[value="__None"]:only-child').parent()
         .attr('disabled', 'disabled')
         .attr('data-placeholder', (
             function(index, attr){
@@ -45,4 +45,35 @@ $(function(){
             }))
         .chosen({no_results_text: "No results matched",
                  allow_single_deselect: true});
+
+    // autocomplete selects only render their selected options; fill
+    // in the rest from the autocomplete view as the user types
+    $('.edit_form select[data-autocomplete-url]').each(function(){
+        var select = $(this);
+        var search = $('#'+this.id+'_chzn').find('input');
+        var timeout = null;
+
+        search.keyup(function(){
+            var q = search.val();
+            clearTimeout(timeout);
+            timeout = setTimeout(function(){
+                $.getJSON(select.attr('data-autocomplete-url'), {q: q},
+                    function(data){
+                        select.find('option:not(:selected)')
+                            .not('[value="__None"]').remove();
+                        $.each(data.results, function(index, result){
+                            if (!select.find('option').filter(function(){
+                                    return this.value == result.id;
+                                }).length){
+                                select.append($('<option></option>')
+                                              .val(result.id)
+                                              .text(result.text));
+                            }
+                        });
+                        select.trigger('liszt:updated');
+                        search.val(q);
+                    });
+            }, 250);
+        });
+    });
 });
\ No newline at end of file
@@ -1,17 +1,81 @@
+import base64
+import codecs
+from collections import namedtuple
+from cStringIO import StringIO
+import csv
+import datetime
+import decimal
+import json
 import math
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+
+from flask import url_for
+from werkzeug.datastructures import MultiDict
+from werkzeug.urls import url_quote
+
+
+#: number of threads in the pool that is shared by the datastores for
+#: running queries concurrently
+THREAD_POOL_SIZE = 4
+
+#: number of rows (or documents) fetched at a time for a streamed list
+#: view or an export
+STREAM_BATCH_SIZE = 100
+
+#: approximate size in bytes of the chunks that exports are sent in
+EXPORT_CHUNK_SIZE = 16384
+
+#: the operations of list view filters: equal to, starts with, and
+#: less than (or equal to) and greater than (or equal to)
+FILTER_OPERATIONS = ('eq', 'startswith', 'lt', 'lte', 'gt', 'gte')
+
+#: A list view filter, which matches the rows whose `column` compares
+#: to `value` (a string from the url) with `operation`, one of
+#: FILTER_OPERATIONS.
+Filter = namedtuple('Filter', 'column operation value')
+
+_thread_pool = None
+_thread_pool_lock = threading.Lock()
 
 
 # original source:  http://flask.pocoo.org/snippets/44/
 class Pagination(object):
-    def __init__(self, page, per_page, total_count, items):
+    """A pagination object for numbered pages. If `estimated` is
+    True, `total_count` is only an estimate of the number of rows, so
+    the pagination won't offer a link to the last page and will rely
+    on the number of items on the current page to decide whether or
+    not there is a next page.
+    """
+    def __init__(self, page, per_page, total_count, items, estimated=False):
         self.page = page
         self.per_page = per_page
         self.total_count = total_count
         self.items = items
+        self.estimated = estimated
+
+    @property
+    def total(self):
+        return self.total_count
+
+    @property
+    def total_display(self):
+        """The total count formatted for display, e.g. 12.3M"""
+        return format_count(self.total_count)
 
     @property
     def pages(self):
-        return int(math.ceil(self.total_count / float(self.per_page)))
+        pages = int(math.ceil(self.total_count / float(self.per_page)))
+        if self.estimated:
+            if not self._has_more_items:
+                return self.page
+            pages = max(pages, self.page + 1)
+        return pages
+
+    @property
+    def _has_more_items(self):
+        return len(self.items) >= self.per_page
 
     @property
     def has_prev(self):
@@ -19,10 +83,23 @@ class Pagination(object):
 
     @property
     def has_next(self):
+        if self.estimated:
+            return self._has_more_items
         return self.page < self.pages
 
+    @property
+    def prev_num(self):
+        return self.page - 1
+
+    @property
+    def next_num(self):
+        return self.page + 1
+
     def iter_pages(self, left_edge=2, left_current=2,
                    right_current=5, right_edge=2):
+        if self.estimated:
+            # the last pages aren't known, so don't link to them
+            right_edge = 0
         last = 0
         for num in xrange(1, self.pages + 1):
             if num <= left_edge or \
@@ -33,3 +110,377 @@ class Pagination(object):
                     yield None
                 yield num
                 last = num
+        if self.estimated and last < self.pages:
+            yield None
+
+
+def format_count(count):
+    """Formats a (possibly large) number of rows for display,
+    e.g. 950, 12.3k or 12.3M.
+    """
+    for divisor, suffix in ((10 ** 9, 'G'), (10 ** 6, 'M'), (10 ** 3, 'k')):
+        if count >= divisor:
+            return '%.1f%s' % (count / float(divisor), suffix)
+    return str(count)
+
+
+class KeysetPagination(object):
+    """A pagination object for keyset (a.k.a. seek) pagination. Rather
+    than numbered pages, a keyset pagination knows only the cursors
+    for the pages immediately before and after it, so it never has to
+    count or skip over rows. Cursors are opaque strings produced by
+    :func:`encode_cursor` and are meant to be passed back to the
+    datastore through the `cursor` url argument.
+    """
+    keyset = True
+
+    def __init__(self, per_page, items, prev_cursor=None, next_cursor=None):
+        self.per_page = per_page
+        self.items = items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def last_cursor(self):
+        """A cursor that points at the last page."""
+        return encode_cursor('prev', [])
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def keyset_page(cursor, per_page, names, converters, fetch):
+    """Returns a KeysetPagination for the page at the position encoded
+    in `cursor` (or for the first page if there is no cursor or it is
+    malformed). `names` are the attribute names of the keyset values
+    of an item and `converters` are functions (one for each name) that
+    convert the values from a cursor, raising a ValueError if they
+    can't. `fetch(values, forward, limit)` is called to get at most
+    `limit` items from the position given by the list of `values`
+    (the start of the order if it is empty), in order if `forward` is
+    True and in reverse order otherwise.
+    """
+    direction, values = None, []
+    if cursor:
+        try:
+            direction, values = decode_cursor(cursor)
+            if len(values) not in (0, len(converters)):
+                raise ValueError('wrong number of values: %r' % cursor)
+            values = [convert(value)
+                      for convert, value in zip(converters, values)]
+        except ValueError:
+            direction, values = None, []
+
+    # fetch one extra item to find out if there is another page
+    if direction == 'prev':
+        rows = fetch(values, False, per_page + 1)
+        items = rows[:per_page]
+        items.reverse()
+        has_prev = len(rows) > per_page
+        has_next = bool(values)
+    else:
+        rows = fetch(values if direction == 'next' else [], True,
+                     per_page + 1)
+        items = rows[:per_page]
+        has_prev = direction == 'next' and bool(values)
+        has_next = len(rows) > per_page
+
+    def cursor_for(direction, item):
+        return encode_cursor(direction,
+                             [getattr(item, name) for name in names])
+
+    prev_cursor = next_cursor = None
+    if has_prev:
+        prev_cursor = cursor_for('prev', items[0]) if items else \
+                      encode_cursor('prev', values)
+    if has_next:
+        next_cursor = cursor_for('next', items[-1]) if items else \
+                      encode_cursor('next', values)
+    return KeysetPagination(per_page, items, prev_cursor, next_cursor)
+
+
+class URLTemplate(object):
+    """Builds the urls for an `endpoint` that differ only in the value
+    of a single url `argument`, e.g. the edit urls for the rows of the
+    list view. The url is built with :func:`flask.url_for` once, with
+    the rest of the url `values`; after that, each url is put together
+    by escaping the argument value and concatenating it with the parts
+    of the url around it, which is much cheaper than calling url_for
+    for every url. The argument should use the path (or the default
+    string) converter, since other converters won't escape values the
+    same way.
+    """
+    _placeholder = u'\x00'
+
+    def __init__(self, endpoint, argument, **values):
+        values[argument] = self._placeholder
+        url = url_for(endpoint, **values)
+        self.prefix, _, self.suffix = url.rpartition(
+            url_quote(self._placeholder))
+
+    def __call__(self, value):
+        return self.prefix + url_quote(value, 'utf-8') + self.suffix
+
+
+def encode_cursor(direction, values):
+    """Encodes a keyset pagination cursor into a url-safe string. The
+    `direction` should be either 'next' or 'prev' and `values` should
+    be the list of keyset values that the cursor seeks from.
+    """
+    values = [value if isinstance(value, (basestring, int, long, float))
+              or value is None else unicode(value)
+              for value in values]
+    encoded = base64.urlsafe_b64encode(json.dumps([direction] + values))
+    return encoded.rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor created by :func:`encode_cursor`, returning a
+    tuple of (direction, values). Raises a ValueError if the cursor
+    is malformed.
+    """
+    cursor = str(cursor)
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, UnicodeError):
+        raise ValueError('malformed cursor: %r' % cursor)
+    if not isinstance(decoded, list) or not decoded or \
+           decoded[0] not in ('next', 'prev'):
+        raise ValueError('malformed cursor: %r' % cursor)
+    return decoded[0], decoded[1:]
+
+
+def parse_sort(sort):
+    """Splits the value of a list view's `sort` argument, a column
+    name with a '-' in front of it for a descending sort, into a tuple
+    of (column name, descending). Returns (None, False) if `sort` is
+    empty.
+    """
+    if not sort:
+        return None, False
+    if sort.startswith('-'):
+        return sort[1:] or None, True
+    return sort, False
+
+
+def parse_filters(args, filterable_columns):
+    """Returns a list of :class:`Filter` for the list view arguments
+    in `args` that are named `f_<column>__<operation>`, or just
+    `f_<column>` for the 'eq' operation. Arguments with an empty
+    value, and the ones for columns that aren't in
+    `filterable_columns`, are left out. The filters are sorted, so the
+    same arguments always give the same list.
+    """
+    filters = set()
+    for name, value in args.items():
+        if not name.startswith('f_') or not value:
+            continue
+        column, operation = name[2:], 'eq'
+        if '__' in column:
+            prefix, suffix = column.rsplit('__', 1)
+            if suffix in FILTER_OPERATIONS:
+                column, operation = prefix, suffix
+        if column in filterable_columns:
+            filters.add(Filter(column, operation, value))
+    return sorted(filters)
+
+
+def filter_args(filters):
+    """Returns a dict of the list view arguments for a list of
+    :class:`Filter`, the reverse of :func:`parse_filters`.
+    """
+    return dict([('f_%s__%s' % (column, operation), value)
+                 for column, operation, value in filters])
+
+
+def coerce_value(python_type, value):
+    """Converts a string value (e.g. from a url or a cursor) into a
+    value of `python_type`. Values of types that can't be parsed from
+    a string are returned unchanged. Raises a ValueError if the value
+    can't be converted.
+    """
+    if value is None or python_type is None or \
+           isinstance(value, python_type):
+        return value
+    if python_type is datetime.datetime:
+        for format in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+            try:
+                return datetime.datetime.strptime(value, format)
+            except ValueError:
+                pass
+        raise ValueError('invalid datetime: %r' % value)
+    if python_type is datetime.date:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    if python_type is datetime.time:
+        for format in ('%H:%M:%S.%f', '%H:%M:%S'):
+            try:
+                return datetime.datetime.strptime(value, format).time()
+            except ValueError:
+                pass
+        raise ValueError('invalid time: %r' % value)
+    if python_type in (int, long, float, decimal.Decimal):
+        try:
+            return python_type(value)
+        except (decimal.InvalidOperation, TypeError):
+            raise ValueError('invalid %s: %r' % (python_type.__name__, value))
+    if python_type is bool and isinstance(value, basestring):
+        if value.lower() in ('1', 'true', 'yes', 'on'):
+            return True
+        if value.lower() in ('0', 'false', 'no', 'off'):
+            return False
+        raise ValueError('invalid boolean: %r' % value)
+    return value
+
+
+def has_changed(obj, name, value):
+    """Returns True unless `obj` has an attribute `name` that is
+    already equal to `value`, so forms can leave alone the attributes
+    that weren't changed.
+    """
+    try:
+        return getattr(obj, name) != value
+    except AttributeError:
+        return True
+
+
+def get_thread_pool():
+    """Returns the thread pool that is shared by the datastores for
+    running queries concurrently. The pool is created the first time
+    it is needed, and created again in a forked child process since
+    threads don't survive a fork.
+    """
+    global _thread_pool
+    with _thread_pool_lock:
+        if _thread_pool is None or _thread_pool[0] != os.getpid():
+            _thread_pool = (os.getpid(), ThreadPool(THREAD_POOL_SIZE))
+        return _thread_pool[1]
+
+
+def call_concurrently(background, foreground):
+    """Calls `background` on the shared thread pool while calling
+    `foreground` in the current thread, and returns a tuple of their
+    results once both are done. Exceptions raised by `background` are
+    re-raised in the current thread.
+    """
+    result = get_thread_pool().apply_async(background)
+    foreground_result = foreground()
+    return result.get(), foreground_result
+
+
+def iter_csv(column_names, rows):
+    """Returns an iterator over chunks of utf-8 encoded CSV for the
+    given column names and rows of values, for streaming an export.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([_csv_value(name) for name in column_names])
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        if buf.tell() >= EXPORT_CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def iter_ndjson(column_names, rows):
+    """Returns an iterator over chunks of newline delimited JSON, with
+    one object per row, for streaming an export.
+    """
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict(zip(column_names, row)),
+                          default=_json_value) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+    yield ''.join(lines)
+
+
+def read_csv(stream):
+    """Returns an iterator over (line number, row) tuples for a utf-8
+    encoded CSV file with a header line, where each row is a
+    MultiDict that can be passed to a form as form data, or a message
+    saying why the line can't be read. A byte order mark at the start
+    of the file is skipped.
+    """
+    reader = csv.reader(stream)
+    try:
+        header = reader.next()
+    except StopIteration:
+        return
+    if header and header[0].startswith(codecs.BOM_UTF8):
+        header[0] = header[0][len(codecs.BOM_UTF8):]
+    try:
+        header = [name.decode('utf-8') for name in header]
+    except UnicodeDecodeError:
+        yield reader.line_num, 'the header line is not utf-8 encoded'
+        return
+    for values in reader:
+        if not values:
+            continue
+        try:
+            values = [value.decode('utf-8') for value in values]
+        except UnicodeDecodeError:
+            yield reader.line_num, 'not utf-8 encoded'
+            continue
+        yield reader.line_num, MultiDict(zip(header, values))
+
+
+def read_ndjson(stream):
+    """Returns an iterator over (line number, row) tuples for a file
+    of newline delimited JSON objects, where each row is a MultiDict
+    that can be passed to a form as form data, or a message saying
+    why the line can't be read. Lists become multiple values and false
+    or null values are left out, as they would be from an HTML form.
+    """
+    for line_number, line in enumerate(stream, 1):
+        if line_number == 1 and line.startswith(codecs.BOM_UTF8):
+            line = line[len(codecs.BOM_UTF8):]
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except UnicodeDecodeError:
+            yield line_number, 'not utf-8 encoded'
+            continue
+        except ValueError:
+            obj = None
+        if not isinstance(obj, dict):
+            yield line_number, 'not a JSON object'
+            continue
+        row = MultiDict()
+        for key, value in obj.iteritems():
+            values = value if isinstance(value, list) else [value]
+            for value in values:
+                if value is True:
+                    row.add(key, u'y')
+                elif value is not None and value is not False:
+                    row.add(key, unicode(value))
+        yield line_number, row
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, str):
+        return value
+    return unicode(value).encode('utf-8')
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return unicode(value)
@@ -12,6 +12,7 @@ from __future__ import absolute_import
 import datetime
 import time
 
+from flask import url_for
 from wtforms import fields as wtf_fields
 from wtforms import widgets, validators
 
@@ -75,6 +76,19 @@ class TimePickerWidget(widgets.TextInput):
         return super(TimePickerWidget, self).__call__(field, **kwargs)
 
 
+class AutocompleteSelectWidget(widgets.Select):
+    """Select widget that adds a data-autocomplete-url attribute to
+    the html select element, pointing at the admin's autocomplete view
+    for the field's model. The admin javascript uses this to fill in
+    the select options as the user types. The field is expected to
+    have a `model_name` attribute.
+    """
+    def __call__(self, field, **kwargs):
+        kwargs.setdefault('data-autocomplete-url', url_for(
+            '.autocomplete', model_name=field.model_name))
+        return super(AutocompleteSelectWidget, self).__call__(field, **kwargs)
+
+
 def has_file_field(form):
     """Test whether or not a form has a FileField in it. This is used
     to know whether or not we need to set enctype to
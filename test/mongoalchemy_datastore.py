@@ -1,11 +1,20 @@
 #!/usr/bin/env python
 from __future__ import absolute_import
 
+from datetime import datetime
 from unittest import TestCase
+from bson.objectid import ObjectId
 from mongoalchemy import fields as ma_fields
-from mongoalchemy.document import Document
-from flask.ext.admin.datastore.mongoalchemy import model_form
+from mongoalchemy.document import Document, Index
+from mongoalchemy.query import Query
+from mongoalchemy.query_expression import flatten
+from pymongo.errors import OperationFailure
+from flask.ext.admin.datastore import BatchInsertError
+from flask.ext.admin.datastore.mongoalchemy import MongoAlchemyDatastore, \
+     model_form, _coerce_field_value, _seek_expression
+from flask.ext.admin.util import Filter
 from wtforms import fields as wtf_fields
+from werkzeug import MultiDict
 from wtforms.form import Form
 
 
@@ -121,6 +130,216 @@ class ConversionTest(TestCase):
         assert form.tuple_field.tuple_field_2.__class__ == wtf_fields.TextField
 
 
+class KeysetTest(TestCase):
+    def setUp(self):
+        class TestModel(Document):
+            name = ma_fields.StringField()
+            created = ma_fields.DateTimeField()
+            rank = ma_fields.IntField()
+        self.model = TestModel
+
+    def test_seek_on_mongo_id(self):
+        mongo_id = ObjectId()
+        expression = _seek_expression(self.model, ['mongo_id'], [mongo_id])
+        self.assertEqual(flatten(expression.obj),
+                         {'_id': {'$gt': mongo_id}})
+
+    def test_seek_on_field_breaks_ties_with_mongo_id(self):
+        mongo_id = ObjectId()
+        expression = _seek_expression(
+            self.model, ['name', 'mongo_id'], [u'Mike', mongo_id],
+            after=False)
+        self.assertEqual(flatten(expression.obj), {'$or': [
+            {'name': {'$lt': u'Mike'}},
+            {'name': u'Mike', '_id': {'$lt': mongo_id}}]})
+
+    def test_coerce_field_value(self):
+        fields = self.model.get_fields()
+        mongo_id = ObjectId()
+        self.assertEqual(
+            _coerce_field_value(fields['mongo_id'], unicode(mongo_id)),
+            mongo_id)
+        self.assertEqual(
+            _coerce_field_value(fields['created'], u'2012-03-04 05:06:07'),
+            datetime(2012, 3, 4, 5, 6, 7))
+        self.assertEqual(_coerce_field_value(fields['rank'], 5), 5)
+        self.assertRaises(ValueError, _coerce_field_value,
+                          fields['mongo_id'], u'garbage')
+
+
+class SortTest(TestCase):
+    def setUp(self):
+        class TestModel(Document):
+            name = ma_fields.StringField()
+            rank = ma_fields.IntField()
+        self.model = TestModel
+
+    def test_sort_fields(self):
+        datastore = MongoAlchemyDatastore(
+            (self.model,), None, sortable_columns={'TestModel': ['name']})
+        self.assertEqual(datastore._get_sort_fields('TestModel', u'-name'),
+                         (['name', 'mongo_id'], True))
+        self.assertEqual(datastore._get_sort_fields('TestModel', u'rank'),
+                         (None, False))
+
+    def test_every_field_is_sortable(self):
+        datastore = MongoAlchemyDatastore(
+            (self.model,), None, sortable_columns=True)
+        self.assertEqual(datastore.get_sortable_columns('TestModel'),
+                         ['mongo_id', 'name', 'rank'])
+        self.assertEqual(datastore._get_sort_fields('TestModel', u'mongo_id'),
+                         (['mongo_id'], False))
+
+
+class FilterFieldsTest(TestCase):
+    def setUp(self):
+        class TestModel(Document):
+            name = ma_fields.StringField()
+            rank = ma_fields.IntField()
+        self.model = TestModel
+
+    def test_filters(self):
+        datastore = MongoAlchemyDatastore(
+            (self.model,), None, filterable_columns={'TestModel': True})
+        query = datastore._filter_query(
+            'TestModel', Query(self.model, None),
+            [Filter('name', 'startswith', u'Mi.'), Filter('rank', 'gte', u'3'),
+             Filter('rank', 'lt', u'9')])
+        self.assertEqual(flatten(query.query), {
+            'name': {'$regex': u'^Mi\\.'},
+            'rank': {'$gte': 3, '$lt': 9}})
+        self.assertEqual(datastore.get_search_column('TestModel'), 'name')
+        self.assertRaises(ValueError, datastore._filter_query, 'TestModel',
+                          Query(self.model, None),
+                          [Filter('rank', 'startswith', u'3')])
+
+    def test_filters_on_db_field(self):
+        class TestModel(Document):
+            name = ma_fields.StringField(db_field='n')
+
+        datastore = MongoAlchemyDatastore(
+            (TestModel,), None, filterable_columns={'TestModel': True})
+        query = datastore._filter_query(
+            'TestModel', Query(TestModel, None),
+            [Filter('name', 'startswith', u'Mi'),
+             Filter('name', 'lt', u'Mz')])
+        self.assertEqual(flatten(query.query),
+                         {'n': {'$regex': u'^Mi', '$lt': u'Mz'}})
+
+    def test_search_on_db_field(self):
+        class TestModel(Document):
+            name = ma_fields.StringField(db_field='n')
+
+        class Session(object):
+            def query(self, model_class):
+                return UnexecutedQuery(model_class, self)
+
+        class UnexecutedQuery(Query):
+            def all(self):
+                return self
+
+        datastore = MongoAlchemyDatastore((TestModel,), Session())
+        query = datastore.search_model_instances('TestModel', u'Mi.')
+        self.assertEqual(flatten(query.query), {'n': {'$regex': u'^Mi\\.'}})
+
+
+class DirtyFieldsTest(TestCase):
+    def test_only_changed_fields_are_set(self):
+        class TestModel(Document):
+            name = ma_fields.StringField()
+            rank = ma_fields.IntField()
+
+        datastore = MongoAlchemyDatastore((TestModel,), None)
+        model_instance = TestModel.unwrap(
+            {'_id': ObjectId(), 'name': u'Mike', 'rank': 3})
+        form = datastore.get_model_form('TestModel')(
+            MultiDict([('name', u'Mike'), ('rank', u'4')]),
+            obj=model_instance)
+        datastore.update_from_form(model_instance, form)
+        self.assertEqual(model_instance.get_dirty_ops(),
+                         {'$set': {'rank': 4}})
+
+
+    def test_saved_fields_are_not_written_again(self):
+        class Session(object):
+            updates = []
+
+            def update(self, item, safe):
+                self.updates.append(item.get_dirty_ops())
+                return {'ok': 1.0, 'n': 1}
+
+        class TestModel(Document):
+            name = ma_fields.StringField()
+            rank = ma_fields.IntField()
+
+        datastore = MongoAlchemyDatastore((TestModel,), Session())
+        model_instance = TestModel.unwrap(
+            {'_id': ObjectId(), 'name': u'Mike', 'rank': 3})
+        model_instance.rank = 4
+        self.assertEqual(datastore.save_model(model_instance),
+                         {'ok': 1.0, 'n': 1})
+        self.assertEqual(datastore.save_model(model_instance), None)
+        self.assertEqual(Session.updates, [{'$set': {'rank': 4}}])
+
+class InsertFromFormsTest(TestCase):
+    def test_indexes_are_ensured_before_insert(self):
+        calls = []
+
+        class Collection(object):
+            def ensure_index(self, components, unique, drop_dups):
+                calls.append(('ensure_index', components, unique))
+
+            def insert(self, documents, safe):
+                calls.append(('insert', documents))
+
+        class Session(object):
+            db = {'TestModel': Collection()}
+
+        class TestModel(Document):
+            name = ma_fields.StringField()
+            name_index = Index().ascending('name').unique()
+
+        datastore = MongoAlchemyDatastore((TestModel,), Session())
+        form = datastore.get_model_form('TestModel')(
+            MultiDict([('name', u'Mike')]))
+        self.assertEqual(datastore.insert_from_forms('TestModel', [form]), 1)
+        self.assertEqual(calls, [('ensure_index', [('name', 1)], True),
+                                 ('insert', [{'name': u'Mike'}])])
+
+    def test_partially_inserted_batch(self):
+        class Collection(object):
+            def insert(self, documents, safe):
+                for document in documents:
+                    document['_id'] = ObjectId()
+                self.inserted = [documents[0]['_id']]
+                raise OperationFailure('E11000 duplicate key error')
+
+            def find(self, query):
+                self.query = query
+                return self
+
+            def count(self):
+                return len(self.inserted)
+
+        class Session(object):
+            db = {'TestModel': Collection()}
+
+        class TestModel(Document):
+            name = ma_fields.StringField()
+
+        datastore = MongoAlchemyDatastore((TestModel,), Session())
+        form_class = datastore.get_model_form('TestModel')
+        forms = [form_class(MultiDict([('name', name)]))
+                 for name in (u'Mike', u'Mike')]
+        try:
+            datastore.insert_from_forms('TestModel', forms)
+        except BatchInsertError, e:
+            self.assertEqual(e.inserted, 1)
+        else:
+            self.fail('BatchInsertError not raised')
+        self.assertEqual(len(Session.db['TestModel'].query['_id']['$in']), 2)
+
+
 if __name__ == '__main__':
     from unittest import main
     main()
@@ -1,17 +1,38 @@
-from datetime import datetime
+from datetime import datetime, time
+from decimal import Decimal
+from StringIO import StringIO
+import json
+import os
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
 
-from flask import Flask
+from flask import Flask, signals_available, url_for
 import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.ext.declarative import declarative_base
 
 from flask.ext import admin
+from flask.ext.admin.datastore import AdminDatastore, BatchInsertError, \
+     CachedCount, CachingDatastore, CallStats, InstrumentedDatastore, \
+     LRUCache
+from flask.ext.admin.datastore.sqlalchemy import ApproximateCount, \
+     AutocompleteSelectField, SQLAlchemyDatastore, _can_delete_directly, \
+     _seek_clause
+from flask.ext.admin.metrics import Metrics
+from flask.ext.admin.util import Filter, Pagination, URLTemplate, \
+     call_concurrently, coerce_value, encode_cursor, filter_args, \
+     format_count, keyset_page, parse_filters
 from flask.ext.testing import TestCase
+from werkzeug import MultiDict
 
 sys.path.append('./example/')
 
 from example.declarative import simple
 from example.declarative import multiple
+from example.declarative import composite_keys
 from example.declarative import custom_form
 from example.authentication import view_decorator
 from example.flask_sqlalchemy import flaskext_sa_simple
@@ -20,7 +41,8 @@ from example.flask_sqlalchemy import flaskext_sa_multi_pk
 from example.mongoalchemy import simple as ma_simple
 import test.deprecation
 import test.filefield
-from test.mongoalchemy_datastore import ConversionTest
+from test.mongoalchemy_datastore import ConversionTest, DirtyFieldsTest, \
+     FilterFieldsTest, InsertFromFormsTest, KeysetTest, SortTest
 
 
 class SimpleTest(TestCase):
@@ -340,6 +362,1652 @@ class LargePaginationTest(TestCase):
         assert '<a href="/admin/list/Student/?page=2">></a>' not in rv.data
 
 
+class KeysetPaginationTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session, keyset_pagination={'Student': 'name'})
+        admin_blueprint = admin.create_admin_blueprint(
+            datastore, list_view_pagination=10)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        for i in range(25):
+            app.db_session.add(simple.Student(name="Student%02d" % i))
+        app.db_session.commit()
+        self.datastore = datastore
+        return app
+
+    def test_first_page(self):
+        pagination = self.datastore.create_model_pagination('Student', 1, 10)
+        self.assertEqual([student.name for student in pagination.items],
+                         ["Student%02d" % i for i in range(10)])
+        assert not pagination.has_prev
+        assert pagination.has_next
+
+    def test_next_and_prev_pages(self):
+        first = self.datastore.create_model_pagination('Student', 1, 10)
+        second = self.datastore.create_model_pagination(
+            'Student', 1, 10, cursor=first.next_cursor)
+        self.assertEqual([student.name for student in second.items],
+                         ["Student%02d" % i for i in range(10, 20)])
+        back = self.datastore.create_model_pagination(
+            'Student', 1, 10, cursor=second.prev_cursor)
+        self.assertEqual([student.name for student in back.items],
+                         [student.name for student in first.items])
+        assert not back.has_prev
+
+    def test_last_page(self):
+        first = self.datastore.create_model_pagination('Student', 1, 10)
+        last = self.datastore.create_model_pagination(
+            'Student', 1, 10, cursor=first.last_cursor)
+        self.assertEqual([student.name for student in last.items],
+                         ["Student%02d" % i for i in range(15, 25)])
+        assert last.has_prev
+        assert not last.has_next
+
+    def test_malformed_cursor(self):
+        rv = self.client.get('/admin/list/Student/?cursor=garbage')
+        self.assert_200(rv)
+        assert "Student00" in rv.data
+
+    def test_list_view_renders_cursor_links(self):
+        rv = self.client.get('/admin/list/Student/')
+        first = self.datastore.create_model_pagination('Student', 1, 10)
+        assert '/admin/list/Student/?cursor=%s' % first.next_cursor in rv.data
+        assert '/admin/list/Student/?page=2' not in rv.data
+
+    def test_keyset_page(self):
+        students = [simple.Student(id=i) for i in range(7)]
+
+        def fetch(values, forward, limit):
+            rows = [student for student in students if not values
+                    or (student.id > values[0] if forward
+                        else student.id < values[0])]
+            if not forward:
+                rows.reverse()
+            return rows[:limit]
+
+        def ids(pagination):
+            return [student.id for student in pagination.items]
+
+        first = keyset_page(None, 3, ['id'], [int], fetch)
+        self.assertEqual(ids(first), [0, 1, 2])
+        assert not first.has_prev and first.has_next
+        second = keyset_page(first.next_cursor, 3, ['id'], [int], fetch)
+        self.assertEqual(ids(second), [3, 4, 5])
+        last = keyset_page(first.last_cursor, 3, ['id'], [int], fetch)
+        self.assertEqual(ids(last), [4, 5, 6])
+        assert last.has_prev and not last.has_next
+        back = keyset_page(last.prev_cursor, 3, ['id'], [int], fetch)
+        self.assertEqual(ids(back), [1, 2, 3])
+        for cursor in ('garbage', encode_cursor('next', [u'x']),
+                       encode_cursor('next', [1, 2])):
+            self.assertEqual(ids(keyset_page(cursor, 3, ['id'], [int], fetch)),
+                             [0, 1, 2])
+
+    def test_offset_pagination_for_other_models(self):
+        pagination = self.datastore.create_model_pagination('Teacher', 1, 10)
+        assert not getattr(pagination, 'keyset', False)
+
+
+class SortingTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session, keyset_pagination={'Teacher': True},
+            sortable_columns={'Course': ['subject']})
+        admin_blueprint = admin.create_admin_blueprint(
+            self.datastore, list_view_pagination=10)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        for i in range(25):
+            # insert them out of order, so the pk order differs
+            app.db_session.add(simple.Student(name="Student%02d" % (24 - i)))
+            app.db_session.add(simple.Teacher(name="Teacher%02d" % (24 - i)))
+        app.db_session.commit()
+        return app
+
+    def names(self, pagination):
+        return [model_instance.name for model_instance in pagination.items]
+
+    def test_sortable_columns(self):
+        self.assertEqual(
+            sorted(self.datastore.get_sortable_columns('Student')),
+            ['id', 'name'])
+        self.assertEqual(self.datastore.get_sortable_columns('Course'),
+                         ['subject'])
+        datastore = SQLAlchemyDatastore((simple.Course,), self.app.db_session)
+        self.assertEqual(datastore.get_sortable_columns('Course'), ['id'])
+
+    def test_sort(self):
+        pagination = self.datastore.create_model_pagination(
+            'Student', 1, 10, sort='name')
+        self.assertEqual(self.names(pagination),
+                         ["Student%02d" % i for i in range(10)])
+        pagination = self.datastore.create_model_pagination(
+            'Student', 2, 10, sort='-name')
+        self.assertEqual(self.names(pagination),
+                         ["Student%02d" % i for i in range(14, 4, -1)])
+
+    def test_unsortable_column_is_ignored(self):
+        pagination = self.datastore.create_model_pagination(
+            'Student', 1, 10, sort='-courses')
+        self.assertEqual(self.names(pagination),
+                         ["Student%02d" % i for i in range(24, 14, -1)])
+
+    def test_keyset_sort(self):
+        first = self.datastore.create_model_pagination(
+            'Teacher', 1, 10, sort='-name')
+        self.assertEqual(self.names(first),
+                         ["Teacher%02d" % i for i in range(24, 14, -1)])
+        second = self.datastore.create_model_pagination(
+            'Teacher', 1, 10, cursor=first.next_cursor, sort='-name')
+        self.assertEqual(self.names(second),
+                         ["Teacher%02d" % i for i in range(14, 4, -1)])
+        back = self.datastore.create_model_pagination(
+            'Teacher', 1, 10, cursor=second.prev_cursor, sort='-name')
+        self.assertEqual(self.names(back), self.names(first))
+        last = self.datastore.create_model_pagination(
+            'Teacher', 1, 10, cursor=first.last_cursor, sort='-name')
+        self.assertEqual(self.names(last),
+                         ["Teacher%02d" % i for i in range(9, -1, -1)])
+
+    def test_keyset_sort_on_nullable_column(self):
+        for i in range(3):
+            self.app.db_session.add(simple.Teacher(name=None))
+        self.app.db_session.commit()
+        # SQLite sorts NULLs first
+        names = [None] * 3 + ["Teacher%02d" % i for i in range(25)]
+        for sort, expected in (('name', names), ('-name', names[::-1])):
+            pages = [self.datastore.create_model_pagination(
+                'Teacher', 1, 4, sort=sort)]
+            while pages[-1].has_next:
+                pages.append(self.datastore.create_model_pagination(
+                    'Teacher', 1, 4, cursor=pages[-1].next_cursor, sort=sort))
+            self.assertEqual(sum([self.names(page) for page in pages], []),
+                             expected)
+            page = pages[-1]
+            while page.has_prev:
+                prev = self.datastore.create_model_pagination(
+                    'Teacher', 1, 4, cursor=page.prev_cursor, sort=sort)
+                self.assertEqual(self.names(prev),
+                                 self.names(pages[pages.index(page) - 1]))
+                page = pages[pages.index(page) - 1]
+
+    def test_seek_clause_nulls_last(self):
+        name, id = simple.Teacher.name, simple.Teacher.id
+        clause = _seek_clause([name, id], [u'Mike', 3], nulls_last=True)
+        self.assertEqual(
+            str(clause).replace('\n', ' '),
+            'teacher.name > :name_1 OR teacher.name IS NULL '
+            'OR teacher.name = :name_2 AND teacher.id > :id_1')
+        clause = _seek_clause([name, id], [None, 3], nulls_last=True)
+        self.assertEqual(str(clause),
+                         'teacher.name IS NULL AND teacher.id > :id_1')
+        clause = _seek_clause([name, id], [None, 3], after=False,
+                              nulls_last=True)
+        self.assertEqual(
+            str(clause).replace('\n', ' '),
+            'teacher.name IS NOT NULL '
+            'OR teacher.name IS NULL AND teacher.id < :id_1')
+
+    def test_list_view_links(self):
+        rv = self.client.get('/admin/list/Student/?sort=-name')
+        self.assert_200(rv)
+        assert rv.data.index('Student24') < rv.data.index('Student23')
+        assert '/admin/list/Student/?sort=name' in rv.data
+        assert 'page=2' in rv.data and 'sort=-name' in rv.data
+        rv = self.client.get('/admin/list/Student/?sort=courses')
+        self.assert_200(rv)
+        assert 'sort=courses' not in rv.data
+
+
+class FilterTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.cached_count = CachedCount()
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher, Item),
+            app.db_session, count_strategy={'Student': self.cached_count})
+        admin_blueprint = admin.create_admin_blueprint(
+            self.datastore, list_view_pagination=5)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        NumericBase.metadata.create_all(bind=engine)
+        for i in range(25):
+            app.db_session.add(simple.Student(name="Student%02d" % i))
+        app.db_session.commit()
+        return app
+
+    def names(self, pagination):
+        return [model_instance.name for model_instance in pagination.items]
+
+    def test_filterable_columns(self):
+        self.assertEqual(
+            sorted(self.datastore.get_filterable_columns('Student')),
+            ['id', 'name'])
+        self.assertEqual(self.datastore.get_filterable_columns('Course'),
+                         ['id'])
+        self.assertEqual(self.datastore.get_search_column('Student'), 'name')
+        # Course.subject isn't indexed
+        self.assertEqual(self.datastore.get_search_column('Course'), None)
+
+    def test_parse_filters(self):
+        args = MultiDict([('f_name__startswith', u'Stu'), ('f_id', u'3'),
+                          ('f_id__gte', u''), ('f_subject', u'maths'),
+                          ('page', u'2')])
+        filters = parse_filters(args, ['id', 'name'])
+        self.assertEqual(filters, [Filter('id', 'eq', u'3'),
+                                   Filter('name', 'startswith', u'Stu')])
+        self.assertEqual(filter_args(filters),
+                         {'f_id__eq': u'3', 'f_name__startswith': u'Stu'})
+
+    def test_filters(self):
+        pagination = self.datastore.create_model_pagination(
+            'Student', 1, 5, filters=[Filter('name', 'startswith', u'Student1')])
+        self.assertEqual(pagination.total_count, 10)
+        self.assertEqual(self.names(pagination),
+                         ["Student%02d" % i for i in range(10, 15)])
+        pagination = self.datastore.create_model_pagination(
+            'Student', 1, 5, filters=[Filter('id', 'gte', u'3'),
+                                      Filter('id', 'lt', u'6')])
+        self.assertEqual(self.names(pagination),
+                         ["Student%02d" % i for i in range(2, 5)])
+        pagination = self.datastore.create_model_pagination(
+            'Student', 1, 5, filters=[Filter('name', 'eq', u'Student07')])
+        self.assertEqual(self.names(pagination), ["Student07"])
+
+    def test_unfilterable_columns_are_ignored(self):
+        datastore = SQLAlchemyDatastore(
+            (simple.Course,), self.app.db_session,
+            filterable_columns={'Course': ['id']})
+        self.app.db_session.add(simple.Course(
+            subject=u"maths", teacher=simple.Teacher(name=u"Mr. Jones")))
+        self.app.db_session.commit()
+        pagination = datastore.create_model_pagination(
+            'Course', 1, 5, filters=[Filter('subject', 'eq', u'art')])
+        self.assertEqual(pagination.total_count, 1)
+
+    def test_invalid_filter_value(self):
+        self.assertRaises(ValueError, self.datastore.create_model_pagination,
+                          'Student', 1, 5, filters=[Filter('id', 'eq', u'x')])
+        self.assertRaises(ValueError, self.datastore.create_model_pagination,
+                          'Student', 1, 5,
+                          filters=[Filter('id', 'startswith', u'1')])
+
+    def test_invalid_numeric_filter_value(self):
+        self.assertRaises(ValueError, self.datastore.create_model_pagination,
+                          'Item', 1, 5, filters=[Filter('price', 'gt', u'abc')])
+        rv = self.client.get('/admin/list/Item/?f_price__gt=abc')
+        self.assert_200(rv)
+        assert 'Invalid filter' in rv.data
+        rv = self.client.get('/admin/export/Item.csv?f_price__gt=abc')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_counts_are_cached_per_filter(self):
+        self.datastore.create_model_pagination('Student', 1, 5)
+        pagination = self.datastore.create_model_pagination(
+            'Student', 1, 5, filters=[Filter('name', 'startswith', u'Student2')])
+        self.assertEqual(pagination.total_count, 5)
+        self.assertEqual(
+            self.datastore.create_model_pagination('Student', 1, 5).total_count,
+            25)
+        self.cached_count.invalidate('Student')
+        self.assertEqual(self.cached_count._cache, {})
+
+    def test_list_view_search(self):
+        rv = self.client.get('/admin/list/Student/?q=Student1&sort=-name')
+        self.assert_200(rv)
+        assert 'Student19' in rv.data
+        assert 'Student09' not in rv.data and 'Student20' not in rv.data
+        assert 'q=Student1' in rv.data and 'page=2' in rv.data
+        assert '/admin/export/Student.csv?q=Student1' in rv.data
+
+    def test_list_view_filter_form(self):
+        rv = self.client.get('/admin/list/Student/?filter_column=id&'
+                             'filter_operation=gt&filter_value=23')
+        self.assert_200(rv)
+        assert 'Student23' in rv.data and 'Student22' not in rv.data
+        assert 'name="f_id__gt" value="23"' in rv.data
+        rv = self.client.get('/admin/list/Student/?f_id=x')
+        self.assert_200(rv)
+        assert 'Invalid filter' in rv.data
+        assert 'Student04' in rv.data
+
+    def test_filtered_export(self):
+        rv = self.client.get('/admin/export/Student.csv?f_id__lte=2')
+        self.assertEqual(rv.data.splitlines(),
+                         ['id,name', '1,Student00', '2,Student01'])
+        rv = self.client.get('/admin/export/Student.csv?f_id__lte=x')
+        self.assertEqual(rv.status_code, 400)
+
+
+class EstimatedCount(object):
+    def count(self, datastore, model_name, query):
+        return 12345678, True
+
+
+class CountStrategyTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.cached_count = CachedCount(ttl=60)
+        datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session,
+            count_strategy={'Student': EstimatedCount(),
+                            'Teacher': self.cached_count})
+        admin_blueprint = admin.create_admin_blueprint(
+            datastore, list_view_pagination=10)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        for i in range(25):
+            app.db_session.add(simple.Student(name="Student%02d" % i))
+            app.db_session.add(simple.Teacher(name="Teacher%02d" % i))
+        app.db_session.commit()
+        self.datastore = datastore
+        return app
+
+    def test_exact_count(self):
+        pagination = self.datastore.create_model_pagination('Course', 1, 10)
+        self.assertEqual(pagination.total_count, 0)
+        assert not pagination.estimated
+
+    def test_cached_count(self):
+        pagination = self.datastore.create_model_pagination('Teacher', 1, 10)
+        self.assertEqual(pagination.total_count, 25)
+        self.app.db_session.add(simple.Teacher(name="Mr. Kohleffel"))
+        self.app.db_session.commit()
+        pagination = self.datastore.create_model_pagination('Teacher', 1, 10)
+        self.assertEqual(pagination.total_count, 25)
+        self.cached_count.invalidate('Teacher')
+        pagination = self.datastore.create_model_pagination('Teacher', 1, 10)
+        self.assertEqual(pagination.total_count, 26)
+
+    def test_estimated_count(self):
+        rv = self.client.get('/admin/list/Student/?page=3')
+        assert 'about 12.3M' in rv.data
+        assert '<a href="/admin/list/Student/?page=2">' in rv.data
+        assert '<a href="/admin/list/Student/?page=4">' not in rv.data
+        assert '?page=1234568' not in rv.data
+
+    def test_approximate_count_falls_back_to_exact(self):
+        # SQLite has no planner statistics, so rows get counted
+        total, estimated = ApproximateCount().count(
+            self.datastore, 'Teacher',
+            self.app.db_session.query(simple.Teacher))
+        self.assertEqual(total, 25)
+        assert not estimated
+
+    def test_approximate_count_explain_params(self):
+        statements = []
+
+        class Bind(object):
+            def __init__(self, dialect):
+                self.dialect = dialect
+
+            def execute(self, statement, params):
+                statements.append((statement, params))
+                return self
+
+            def fetchall(self):
+                return [{'rows': 7}] if self.dialect.name == 'mysql' else \
+                       [('Seq Scan on student  (rows=7 width=4)',)]
+
+        query = self.app.db_session.query(simple.Student).filter(
+            simple.Student.name.like(u'S%')).filter(simple.Student.id > 3)
+        for dialect in (mysql.dialect(), postgresql.dialect()):
+            datastore = SQLAlchemyDatastore(
+                (simple.Student,), sa.orm.scoped_session(
+                    sa.orm.sessionmaker(bind=Bind(dialect))))
+            self.assertEqual(ApproximateCount().estimate(
+                datastore, 'Student', query), 7)
+        assert 'student.name LIKE %s AND student.id > %s' in statements[0][0]
+        self.assertEqual(statements[0][1], (u'S%', 3))
+        self.assertEqual(statements[1][1], {'name_1': u'S%', 'id_1': 3})
+
+    def test_estimated_pagination_has_next(self):
+        pagination = Pagination(1, 10, 5, range(10), estimated=True)
+        assert pagination.has_next
+        pagination = Pagination(2, 10, 500, range(3), estimated=True)
+        assert not pagination.has_next
+
+    def test_format_count(self):
+        self.assertEqual(format_count(950), '950')
+        self.assertEqual(format_count(12345), '12.3k')
+        self.assertEqual(format_count(12345678), '12.3M')
+
+
+class ThreadRecordingCount(object):
+    def __init__(self):
+        self.threads = []
+
+    def count(self, datastore, model_name, query):
+        self.threads.append(threading.current_thread())
+        return query.count(), False
+
+
+class ConcurrentCountTest(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        engine = sa.create_engine(
+            'sqlite:///' + os.path.join(self.db_dir, 'test.db'))
+        self.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False, bind=engine))
+        simple.Base.metadata.create_all(bind=engine)
+        for i in range(25):
+            self.db_session.add(simple.Student(name="Student%02d" % i))
+        self.db_session.commit()
+        self.count_strategy = ThreadRecordingCount()
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            self.db_session, count_strategy=self.count_strategy,
+            concurrent_count=True)
+
+    def tearDown(self):
+        self.db_session.remove()
+        shutil.rmtree(self.db_dir)
+
+    def test_count_runs_on_thread_pool(self):
+        pagination = self.datastore.create_model_pagination('Student', 2, 10)
+        self.assertEqual(pagination.total_count, 25)
+        self.assertEqual([student.name for student in pagination.items],
+                         ["Student%02d" % i for i in range(10, 20)])
+        self.assertEqual(len(self.count_strategy.threads), 1)
+        assert self.count_strategy.threads[0] is not \
+               threading.current_thread()
+
+    def test_count_errors_are_raised(self):
+        def fail():
+            raise ValueError('no count')
+        self.assertRaises(ValueError, call_concurrently, fail, lambda: None)
+
+
+class InstrumentedDatastoreTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = InstrumentedDatastore(SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session), engine=engine)
+        admin_blueprint = admin.create_admin_blueprint(self.datastore)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        app.db_session.add(simple.Student(name=u"Stewart"))
+        app.db_session.commit()
+        return app
+
+    def test_call_stats(self):
+        with self.app.test_request_context():
+            student = self.datastore.find_model_instance('Student', [u'1'])
+            self.datastore.find_model_instance('Student', [u'1'])
+            self.datastore.get_model_keys(simple.Student(id=5))
+            stats = self.datastore.get_request_stats()
+        self.assertEqual(sorted(stats), ['find_model_instance',
+                                         'get_model_keys'])
+        self.assertEqual(stats['find_model_instance'].calls, 2)
+        # the second lookup comes from the identity map
+        self.assertEqual(stats['find_model_instance'].statements, 1)
+        self.assertEqual(stats['get_model_keys'],
+                         CallStats(1, stats['get_model_keys'].duration, 0))
+
+    def test_server_timing_header(self):
+        rv = self.client.get('/admin/list/Student/')
+        metrics = rv.headers['Server-Timing'].split(', ')
+        assert metrics[0].startswith('create_model_pagination;dur=')
+        assert metrics[0].endswith(';desc="calls=1 statements=2"')
+        assert metrics[-1].startswith('datastore;dur=')
+
+    def test_calls_outside_requests(self):
+        student = self.datastore.find_model_instance('Student', [u'1'])
+        self.assertEqual(student.name, u"Stewart")
+
+    @unittest.skipUnless(signals_available, 'requires blinker')
+    def test_signals(self):
+        from flask.ext.admin.signals import datastore_called, \
+             datastore_request_finished
+        calls, requests = [], []
+        with datastore_called.connected_to(
+                lambda sender, **kwargs: calls.append(kwargs['method'])):
+            with datastore_request_finished.connected_to(
+                    lambda sender, stats: requests.append(stats)):
+                self.client.get('/admin/list/Student/')
+        assert 'create_model_pagination' in calls
+        self.assertEqual(len(requests), 1)
+
+
+class MetricsTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.metrics = Metrics()
+        datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session,
+            count_strategy=CachedCount(metrics=self.metrics))
+        admin_blueprint = admin.create_admin_blueprint(
+            datastore, metrics=self.metrics)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        app.db_session.add(simple.Student(name=u"Stewart"))
+        app.db_session.add(simple.Student(name=u"Mike"))
+        app.db_session.commit()
+        return app
+
+    def get_metrics(self):
+        rv = self.client.get('/admin/metrics')
+        self.assert_200(rv)
+        self.assertEqual(rv.headers['Content-Type'],
+                         'text/plain; version=0.0.4; charset=utf-8')
+        return rv.data.splitlines()
+
+    def test_view_metrics(self):
+        self.client.get('/admin/list/Student/')
+        self.client.get('/admin/list/Student/')
+        self.client.get('/admin/list/Nonexistent/')
+        self.client.post('/admin/add/Course/', data={'subject': u'maths'})
+        lines = self.get_metrics()
+        assert '# TYPE flask_admin_view_duration_seconds histogram' in lines
+        assert 'flask_admin_view_duration_seconds_count' \
+               '{model="Student",view="list"} 2' in lines
+        assert 'flask_admin_view_duration_seconds_count' \
+               '{model="",view="list"} 1' in lines
+        assert 'flask_admin_view_duration_seconds_bucket' \
+               '{model="Student",view="list",le="+Inf"} 2' in lines
+        assert 'flask_admin_datastore_call_duration_seconds_count' \
+               '{method="create_model_pagination",model="Student"} 2' in lines
+        assert 'flask_admin_form_validation_failures_total' \
+               '{model="Course",view="add"} 1' in lines
+        assert 'flask_admin_list_rows_rendered_bucket' \
+               '{model="Student",le="1"} 0' in lines
+        assert 'flask_admin_list_rows_rendered_bucket' \
+               '{model="Student",le="5"} 2' in lines
+        assert 'flask_admin_list_rows_rendered_sum{model="Student"} 4.0' \
+               in lines
+        assert 'flask_admin_cache_requests_total' \
+               '{cache="count",model="Student",result="hit"} 1' in lines
+        assert 'flask_admin_cache_requests_total' \
+               '{cache="count",model="Student",result="miss"} 1' in lines
+
+    def test_threads_are_added_up(self):
+        metrics = Metrics()
+        metrics.inc('requests_total', view=u'say "hi"')
+
+        def work():
+            metrics.inc('requests_total', 2, view=u'say "hi"')
+            metrics.observe('latency_seconds', 0.2)
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        metrics.observe('latency_seconds', 20)
+        lines = metrics.render().splitlines()
+        assert 'requests_total{view="say \\"hi\\""} 3' in lines
+        assert 'latency_seconds_bucket{le="0.1"} 0' in lines
+        assert 'latency_seconds_bucket{le="0.25"} 1' in lines
+        assert 'latency_seconds_bucket{le="+Inf"} 2' in lines
+        assert 'latency_seconds_count 2' in lines
+        # the finished thread's accumulator has been folded
+        self.assertEqual(len(metrics._accumulators), 1)
+        self.assertEqual(metrics.render().splitlines(), lines)
+
+
+class CachingDatastoreTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = CachingDatastore(SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session))
+        admin_blueprint = admin.create_admin_blueprint(self.datastore)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        teacher = simple.Teacher(name="Mrs. Jones")
+        app.db_session.add(simple.Course(subject="maths", teacher=teacher))
+        app.db_session.add(simple.Student(name="Stewart"))
+        app.db_session.commit()
+        app.db_session.remove()
+
+        self.statements = []
+        sa.event.listen(engine, 'before_cursor_execute',
+                        lambda *args: self.statements.append(args[2]))
+        return app
+
+    def test_pagination_is_cached(self):
+        first = self.datastore.create_model_pagination('Student', 1)
+        self.app.db_session.remove()
+        del self.statements[:]
+        second = self.datastore.create_model_pagination('Student', 1)
+        self.assertEqual(self.statements, [])
+        self.assertEqual([student.name for student in second.items],
+                         [student.name for student in first.items])
+        assert second.items[0] in self.app.db_session
+
+    def test_save_invalidates_model(self):
+        self.datastore.create_model_pagination('Student', 1)
+        self.datastore.create_model_pagination('Teacher', 1)
+        self.datastore.save_model(simple.Student(name="Mike"))
+        del self.statements[:]
+        pagination = self.datastore.create_model_pagination('Student', 1)
+        self.assertEqual(pagination.total_count, 2)
+        assert self.statements
+        del self.statements[:]
+        self.datastore.create_model_pagination('Teacher', 1)
+        self.assertEqual(self.statements, [])
+
+    def test_cached_instance_can_be_edited(self):
+        self.datastore.find_model_instance('Course', ['1'])
+        self.app.db_session.remove()
+        rv = self.client.get('/admin/edit/Course/1/')
+        self.assert_200(rv)
+        assert 'Mrs. Jones' in rv.data
+        rv = self.client.post('/admin/edit/Course/1/',
+                              data=dict(subject="history", teacher=u'1'))
+        self.assert_redirects(rv, '/admin/list/Course/')
+        course = self.datastore.find_model_instance('Course', ['1'])
+        self.assertEqual(course.subject, "history")
+
+    def test_delete_invalidates_model(self):
+        self.datastore.find_model_instance('Student', ['1'])
+        self.assertTrue(self.datastore.delete_model_instance('Student', ['1']))
+        self.assertEqual(
+            self.datastore.find_model_instance('Student', ['1']), None)
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', [1])
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), [1])
+        assert cache.get('a') is not cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        cache.set('d', 4, timeout=-1)
+        self.assertEqual(cache.get('d'), None)
+
+
+class AutocompleteTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session, autocomplete=True)
+        admin_blueprint = admin.create_admin_blueprint(datastore)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        teacher = simple.Teacher(name="Mrs. Jones")
+        app.db_session.add(teacher)
+        app.db_session.add(simple.Teacher(name="Mr. Kohleffel"))
+        app.db_session.add(simple.Student(name="Stewart"))
+        app.db_session.add(simple.Student(name="Mike"))
+        app.db_session.add(simple.Student(name="Jason"))
+        app.db_session.add(simple.Student(name="Jas_on"))
+        app.db_session.add(simple.Course(subject="maths", teacher=teacher))
+        app.db_session.commit()
+        return app
+
+    def test_autocomplete(self):
+        rv = self.client.get('/admin/autocomplete/Student/?q=Jas')
+        data = json.loads(rv.data)
+        self.assertEqual([result['text'] for result in data['results']],
+                         ['Jas_on', 'Jason'])
+        assert not data['more']
+
+    def test_autocomplete_escapes_wildcards(self):
+        rv = self.client.get('/admin/autocomplete/Student/?q=Jas_')
+        data = json.loads(rv.data)
+        self.assertEqual([result['text'] for result in data['results']],
+                         ['Jas_on'])
+
+    def test_autocomplete_limit(self):
+        rv = self.client.get('/admin/autocomplete/Student/?limit=2')
+        data = json.loads(rv.data)
+        self.assertEqual(len(data['results']), 2)
+        assert data['more']
+        rv = self.client.get('/admin/autocomplete/Student/?limit=2&offset=2')
+        data = json.loads(rv.data)
+        self.assertEqual([result['text'] for result in data['results']],
+                         ['Mike', 'Stewart'])
+
+    def test_autocomplete_invalid_limit(self):
+        rv = self.client.get('/admin/autocomplete/Student/?limit=-1')
+        self.assertEqual(len(json.loads(rv.data)['results']), 1)
+        rv = self.client.get('/admin/autocomplete/Student/?offset=-2')
+        self.assertEqual(len(json.loads(rv.data)['results']), 4)
+        rv = self.client.get('/admin/autocomplete/Student/?limit=all')
+        self.assertEqual(rv.status_code, 400)
+        rv = self.client.get('/admin/autocomplete/Student/?offset=x')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_edit_renders_only_selected_options(self):
+        rv = self.client.get('/admin/edit/Course/1/')
+        assert 'data-autocomplete-url="/admin/autocomplete/Teacher/"' in \
+               rv.data
+        assert 'Mrs. Jones' in rv.data
+        assert 'Mr. Kohleffel' not in rv.data
+        assert 'Stewart' not in rv.data
+
+    def test_edit(self):
+        rv = self.client.post('/admin/edit/Course/1/',
+                              data=dict(subject='maths', teacher=2,
+                                        students=[1, 3]))
+        self.assert_redirects(rv, '/admin/list/Course/')
+        course = self.app.db_session.query(simple.Course).get(1)
+        self.assertEqual(course.teacher.name, 'Mr. Kohleffel')
+        self.assertEqual(sorted(student.name for student in course.students),
+                         ['Jason', 'Stewart'])
+
+    def test_edit_invalid_choice(self):
+        rv = self.client.post('/admin/edit/Course/1/',
+                              data=dict(subject='maths', teacher=1,
+                                        students=[1, 42]))
+        assert 'Not a valid choice' in rv.data
+        rv = self.client.post('/admin/edit/Course/1/',
+                              data=dict(subject='maths', teacher='x'))
+        assert 'Not a valid choice' in rv.data
+
+
+class DirtyUpdateTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = simple.create_app('sqlite://')
+        teacher = simple.Teacher(name=u"Mrs. Jones")
+        app.db_session.add(simple.Course(subject=u"maths", teacher=teacher,
+                                         start_time=time(9)))
+        app.db_session.commit()
+        self.statements = []
+        engine = app.db_session.get_bind()
+        sa.event.listen(engine, 'before_cursor_execute',
+                        lambda *args: self.statements.append(args[2]))
+        sa.event.listen(engine, 'commit',
+                        lambda *args: self.statements.append('COMMIT'))
+        return app
+
+    def edit_course(self, **data):
+        form_data = {'subject': u'maths', 'teacher': u'1',
+                     'start_time': u'09:00:00', 'end_time': u''}
+        form_data.update(data)
+        return self.client.post('/admin/edit/Course/1/', data=form_data)
+
+    def test_only_changed_columns_are_updated(self):
+        self.edit_course(subject=u'history')
+        updates = [statement for statement in self.statements
+                   if statement.startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        assert 'SET subject=?' in updates[0]
+        assert 'start_time' not in updates[0]
+        self.assertEqual(
+            self.app.db_session.query(simple.Course).one().subject,
+            u"history")
+
+    def test_unchanged_form_is_not_written(self):
+        rv = self.edit_course()
+        self.assertRedirects(rv, '/admin/list/Course/')
+        self.assertEqual([statement for statement in self.statements
+                          if not statement.startswith('SELECT')], [])
+
+
+class EagerLoadTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session, eager_load=True,
+            list_columns={'Course': ['subject', 'teacher']})
+        admin_blueprint = admin.create_admin_blueprint(self.datastore)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        student = simple.Student(name=u"Stewart")
+        for i in range(5):
+            app.db_session.add(simple.Course(
+                subject=u"course %d" % i, students=[student],
+                teacher=simple.Teacher(name=u"teacher %d" % i)))
+        app.db_session.commit()
+        app.db_session.remove()
+
+        self.statements = []
+        sa.event.listen(engine, 'before_cursor_execute',
+                        lambda *args: self.statements.append(args[2]))
+        return app
+
+    def test_list_view_is_not_n_plus_1(self):
+        rv = self.client.get('/admin/list/Course/')
+        for i in range(5):
+            assert 'teacher %d' % i in rv.data
+        # the page (with its teachers) and the count
+        self.assertEqual(len(self.statements), 2)
+        assert 'JOIN teacher' in self.statements[0]
+
+    def test_only_list_column_relationships_are_loaded(self):
+        get_eager_options = self.datastore._get_eager_options
+        self.assertEqual(len(get_eager_options('Course', list_view=True)), 1)
+        self.assertEqual(len(get_eager_options('Course')), 2)
+        # the courses backref of Student is a collection
+        self.assertEqual(len(get_eager_options('Student', list_view=True)), 1)
+        self.assertEqual(get_eager_options(
+            'Student', list_view=True, collections=False), [])
+
+    def test_edit_view_prefetches_relationships(self):
+        course = self.datastore.find_model_instance('Course', [u'1'])
+        self.assertEqual(len(self.statements), 2)
+        self.assertEqual(course.teacher.name, u"teacher 0")
+        self.assertEqual([student.name for student in course.students],
+                         [u"Stewart"])
+        self.assertEqual(len(self.statements), 2)
+
+
+class ChoicesCacheTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session, choices_cache=True)
+        admin_blueprint = admin.create_admin_blueprint(self.datastore)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        app.db_session.add(simple.Course(
+            subject=u"maths", students=[simple.Student(name=u"Stewart")],
+            teacher=simple.Teacher(name=u"Mr. Jones")))
+        app.db_session.add(simple.Teacher(name=u"Mrs. Smith"))
+        app.db_session.commit()
+        app.db_session.remove()
+
+        self.statements = []
+        sa.event.listen(engine, 'before_cursor_execute',
+                        lambda *args: self.statements.append(args[2]))
+        return app
+
+    def teacher_queries(self):
+        # queries of the whole teacher table, not of a single teacher
+        return [statement for statement in self.statements
+                if statement.startswith('SELECT teacher.') and
+                'WHERE' not in statement]
+
+    def test_choices_are_rendered_from_the_cache(self):
+        rv = self.client.get('/admin/edit/Course/1/')
+        assert '<option selected="selected" value="1">' in rv.data
+        assert 'Mrs. Smith' in rv.data
+        self.assertEqual(len(self.teacher_queries()), 1)
+        rv = self.client.get('/admin/edit/Course/1/')
+        assert 'Mrs. Smith' in rv.data
+        self.assertEqual(len(self.teacher_queries()), 1)
+
+    def test_saving_invalidates_choices(self):
+        self.client.get('/admin/add/Course/')
+        rv = self.client.post('/admin/add/Teacher/',
+                              data=dict(name=u'Dr. Who'))
+        self.assertEqual(rv.status_code, 302)
+        rv = self.client.get('/admin/add/Course/')
+        assert 'Dr. Who' in rv.data
+        self.assertEqual(len(self.teacher_queries()), 2)
+
+    def test_deleting_invalidates_choices(self):
+        self.client.get('/admin/add/Course/')
+        self.client.get('/admin/delete/Teacher/2/')
+        rv = self.client.get('/admin/add/Course/')
+        assert 'Mrs. Smith' not in rv.data
+
+    def test_submitted_choices_are_checked(self):
+        rv = self.client.post('/admin/edit/Course/1/',
+                              data=dict(subject=u'maths', teacher=u'2',
+                                        students=[u'1']))
+        self.assertEqual(rv.status_code, 302)
+        course = self.app.db_session.query(simple.Course).get(1)
+        self.assertEqual(course.teacher.name, u"Mrs. Smith")
+        rv = self.client.post('/admin/edit/Course/1/',
+                              data=dict(subject=u'maths', teacher=u'42',
+                                        students=[u'1']))
+        self.assertEqual(rv.status_code, 200)
+        assert 'Not a valid choice' in rv.data
+
+
+class FindModelInstanceTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = simple.create_app('sqlite://')
+        app.db_session.add(simple.Student(name="Stewart"))
+        app.db_session.commit()
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher), app.db_session)
+        self.statements = []
+        sa.event.listen(app.db_session.get_bind(), 'before_cursor_execute',
+                        lambda *args: self.statements.append(args[2]))
+        return app
+
+    def test_find_uses_identity_map(self):
+        student = self.datastore.find_model_instance('Student', [u'1'])
+        self.assertEqual(student.name, 'Stewart')
+        self.statements[:] = []
+        self.assertTrue(
+            self.datastore.find_model_instance('Student', [u'1']) is student)
+        self.assertEqual(self.statements, [])
+
+    def test_find_missing_or_malformed_keys(self):
+        self.assertEqual(
+            self.datastore.find_model_instance('Student', [u'2']), None)
+        self.assertEqual(
+            self.datastore.find_model_instance('Student', [u'x']), None)
+        self.assertEqual(
+            self.datastore.find_model_instance('Student', [u'1', u'2']), None)
+
+
+NumericBase = declarative_base()
+
+
+class Item(NumericBase):
+    __tablename__ = 'item'
+    id = sa.Column(sa.Numeric(10, 2), primary_key=True)
+    name = sa.Column(sa.String(50))
+    price = sa.Column(sa.Numeric(10, 2), index=True)
+
+    def __repr__(self):
+        return self.name
+
+
+class NumericKeyTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = SQLAlchemyDatastore(
+            (Item,), app.db_session, exclude_pks=False,
+            keyset_pagination=True)
+        admin_blueprint = admin.create_admin_blueprint(self.datastore)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        NumericBase.metadata.create_all(bind=engine)
+        app.db_session.add(Item(id=Decimal('1.50'), name="Widget"))
+        app.db_session.commit()
+        return app
+
+    def test_coerce_value(self):
+        self.assertEqual(coerce_value(Decimal, u'1.50'), Decimal('1.50'))
+        self.assertRaises(ValueError, coerce_value, Decimal, u'abc')
+        self.assertRaises(ValueError, coerce_value, int, [1])
+
+    def test_malformed_keys(self):
+        self.assertEqual(
+            self.datastore.find_model_instance('Item', [u'1.50']).name,
+            "Widget")
+        self.assertEqual(
+            self.datastore.find_model_instance('Item', [u'abc']), None)
+        rv = self.client.get('/admin/edit/Item/abc/')
+        self.assert_200(rv)
+        assert "Item not found" in rv.data
+        rv = self.client.get('/admin/delete/Item/abc/')
+        self.assert_200(rv)
+        assert "Item not found" in rv.data
+
+    def test_malformed_cursor(self):
+        cursor = encode_cursor('next', [u'abc'])
+        rv = self.client.get('/admin/list/Item/?cursor=%s' % cursor)
+        self.assert_200(rv)
+        assert "Widget" in rv.data
+
+
+class ReorderedPrimaryKeyTest(unittest.TestCase):
+    def setUp(self):
+        Base = declarative_base()
+
+        class Pair(Base):
+            __tablename__ = 'pair'
+            __table_args__ = (sa.PrimaryKeyConstraint('b', 'a'),)
+            a = sa.Column(sa.Integer)
+            b = sa.Column(sa.String(10))
+
+        engine = sa.create_engine('sqlite://')
+        Base.metadata.create_all(bind=engine)
+        self.db_session = sa.orm.scoped_session(
+            sa.orm.sessionmaker(bind=engine))
+        self.db_session.add(Pair(a=1, b=u'x'))
+        self.db_session.commit()
+        self.model = Pair
+        self.datastore = SQLAlchemyDatastore(
+            (Pair,), self.db_session, exclude_pks=False)
+
+    def test_find_model_instance(self):
+        pair = self.datastore.find_model_instance('Pair', [u'1', u'x'])
+        self.assertEqual((pair.a, pair.b), (1, u'x'))
+        self.assertEqual(self.datastore.get_model_keys(pair), [1, u'x'])
+
+    def test_delete_model_instance(self):
+        pair = self.datastore.find_model_instance('Pair', [u'1', u'x'])
+        self.assertTrue(
+            self.datastore.delete_model_instance('Pair', [u'1', u'x']))
+        self.assertTrue(pair not in self.db_session)
+        self.assertEqual(self.db_session.query(self.model).count(), 0)
+
+    def test_autocomplete_field(self):
+        field = AutocompleteSelectField(
+            model_class=self.model, db_session=self.db_session,
+            _form=None, _name='pair')
+        pair = field._find_objects([u'1:x'])[0]
+        self.assertEqual((pair.a, pair.b), (1, u'x'))
+        field.data = pair
+        self.assertEqual([pk for pk, obj in field._get_object_list()],
+                         [u'1:x'])
+
+
+class LazyFormTest(unittest.TestCase):
+    def setUp(self):
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            sa.orm.scoped_session(sa.orm.sessionmaker()),
+            model_forms={'Teacher': custom_form.UserForm})
+
+    def test_forms_are_built_on_demand(self):
+        self.assertEqual(self.datastore.form_dict.keys(), ['Teacher'])
+        form = self.datastore.get_model_form('Student')
+        self.assertTrue(self.datastore.get_model_form('Student') is form)
+        self.assertTrue(
+            self.datastore.get_model_form('Teacher') is custom_form.UserForm)
+
+    def test_forms_are_built_once_across_threads(self):
+        forms = []
+        threads = [threading.Thread(
+            target=lambda: forms.append(
+                self.datastore.get_model_form('Course')))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(forms)), 1)
+
+    def test_warm_up_forms(self):
+        thread = self.datastore.warm_up_forms(['Course', 'Student'])
+        thread.join()
+        self.assertEqual(sorted(self.datastore.form_dict.keys()),
+                         ['Course', 'Student', 'Teacher'])
+
+
+class StreamingListTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session, count_strategy={'Teacher': EstimatedCount()})
+        admin_blueprint = admin.create_admin_blueprint(
+            self.datastore, list_view_pagination=200, stream_list_view=True)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        for i in range(250):
+            app.db_session.add(simple.Student(name="Student%03d" % i))
+        app.db_session.commit()
+        return app
+
+    def test_list_view_is_streamed(self):
+        rv = self.client.get('/admin/list/Student/')
+        self.assert_200(rv)
+        assert rv.is_streamed
+        assert 'Student000' in rv.data
+        assert 'Student199' in rv.data
+        assert 'Student200' not in rv.data
+        assert '/admin/list/Student/?page=2' in rv.data
+        assert '/admin/edit/Student/200/' in rv.data
+
+    def test_items_are_fetched_lazily(self):
+        pagination = self.datastore.create_model_pagination(
+            'Student', 2, 200, stream=True)
+        assert not isinstance(pagination.items, list)
+        self.assertEqual(pagination.total_count, 250)
+        self.assertEqual([student.name for student in pagination.items],
+                         ["Student%03d" % i for i in range(200, 250)])
+
+    def test_estimated_count_is_not_streamed(self):
+        pagination = self.datastore.create_model_pagination(
+            'Teacher', 1, 200, stream=True)
+        self.assertEqual(pagination.items, [])
+
+
+class ExportTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session)
+        admin_blueprint = admin.create_admin_blueprint(self.datastore)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        teacher = simple.Teacher(name=u"Mrs. J\xf6nes")
+        app.db_session.add(simple.Course(
+            subject="maths", teacher=teacher,
+            start_time=time(9, 30), end_time=None))
+        for i in range(250):
+            app.db_session.add(simple.Student(name="Student%03d" % i))
+        app.db_session.commit()
+        return app
+
+    def test_csv_export(self):
+        rv = self.client.get('/admin/export/Student.csv')
+        self.assert_200(rv)
+        assert rv.is_streamed
+        self.assertEqual(rv.mimetype, 'text/csv')
+        lines = rv.data.splitlines()
+        self.assertEqual(lines[:2], ['id,name', '1,Student000'])
+        self.assertEqual(len(lines), 251)
+
+    def test_csv_values(self):
+        rv = self.client.get('/admin/export/Course.csv')
+        self.assertEqual(rv.data.splitlines(), [
+            'id,subject,teacher_id,start_time,end_time',
+            '1,maths,1,09:30:00,'])
+        rv = self.client.get('/admin/export/Teacher.csv')
+        self.assertEqual(rv.data.decode('utf-8').splitlines()[1],
+                         u'1,Mrs. J\xf6nes')
+
+    def test_ndjson_export(self):
+        rv = self.client.get('/admin/export/Course.ndjson')
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in rv.data.splitlines()],
+                         [{'id': 1, 'subject': 'maths', 'teacher_id': 1,
+                           'start_time': '09:30:00', 'end_time': None}])
+
+    def test_rows_are_fetched_lazily(self):
+        column_names, rows = self.datastore.iter_model_rows('Student')
+        self.assertEqual(column_names, ['id', 'name'])
+        assert not isinstance(rows, list)
+        self.assertEqual(rows.next(), (1, 'Student000'))
+
+    def test_unknown_format(self):
+        self.assert_404(self.client.get('/admin/export/Student.xml'))
+
+
+class ImportTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session)
+        admin_blueprint = admin.create_admin_blueprint(
+            self.datastore, import_batch_size=2)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        app.db_session.add(simple.Teacher(name=u"Mrs. Jones"))
+        app.db_session.add(simple.Student(name=u"Stewart"))
+        app.db_session.commit()
+
+        self.statements = []
+        sa.event.listen(engine, 'before_cursor_execute',
+                        lambda *args: self.statements.append(args[2]))
+        return app
+
+    def upload(self, model_name, filename, data):
+        return self.client.post(
+            '/admin/import/%s/' % model_name,
+            data={'file': (StringIO(data), filename)})
+
+    def test_import_form(self):
+        rv = self.client.get('/admin/import/Student/')
+        self.assert_200(rv)
+        assert 'type="file"' in rv.data
+
+    def test_csv_import(self):
+        rv = self.upload('Student', 'students.csv',
+                         'name\nMike\nJason\n\nEve\n\xc3\x85sa\n')
+        self.assertEqual(rv.data.splitlines(),
+                         ['done: 4 rows imported, 0 rows rejected'])
+        self.assertEqual(
+            sorted(student.name for student in
+                   self.app.db_session.query(simple.Student)),
+            [u'Eve', u'Jason', u'Mike', u'Stewart', u'\xc5sa'])
+
+    def test_csv_encoding_errors(self):
+        rv = self.upload('Student', 'students.csv',
+                         '\xef\xbb\xbfname\nMike\n\xc5sa\nEve\n')
+        self.assertEqual(rv.data.splitlines(),
+                         ['line 3: not utf-8 encoded',
+                          'done: 2 rows imported, 1 rows rejected'])
+        rv = self.upload('Student', 'students.csv', 'n\xe4me\nMike\n')
+        self.assertEqual(rv.data.splitlines()[0],
+                         'line 1: the header line is not utf-8 encoded')
+
+    def test_rows_are_inserted_in_batches(self):
+        rv = self.upload('Student', 'students.csv',
+                         'name\nMike\nJason\nEve\n')
+        self.assertEqual(rv.data.splitlines(),
+                         ['done: 3 rows imported, 0 rows rejected'])
+        inserts = [statement for statement in self.statements
+                   if statement.startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+
+    def test_ndjson_import_with_relationships(self):
+        rv = self.upload('Course', 'courses.ndjson', '\n'.join([
+            '{"subject": "maths", "teacher": 1, "start_time": "09:30:00"}',
+            '{"subject": "history", "teacher": 1, "students": [1]}',
+            '{"subject": "art", "teacher": 5}',
+            'garbage',
+            '{"subject": "\xe4rt", "teacher": 1}']))
+        lines = rv.data.splitlines()
+        self.assertEqual(lines[0], 'line 3: teacher: Not a valid choice')
+        self.assertEqual(lines[1], 'line 4: not a JSON object')
+        self.assertEqual(lines[2], 'line 5: not utf-8 encoded')
+        self.assertEqual(lines[-1], 'done: 2 rows imported, 3 rows rejected')
+        maths, history = self.app.db_session.query(simple.Course).order_by(
+            simple.Course.id).all()
+        self.assertEqual(maths.teacher.name, u"Mrs. Jones")
+        self.assertEqual(maths.start_time, time(9, 30))
+        self.assertEqual([student.name for student in history.students],
+                         [u"Stewart"])
+
+    def test_related_tables_are_loaded_once_per_import(self):
+        rv = self.upload('Course', 'courses.ndjson', '\n'.join(
+            '{"subject": "course %d", "teacher": 1, "students": [1]}' % i
+            for i in range(6)))
+        self.assertEqual(rv.data.splitlines(),
+                         ['done: 6 rows imported, 0 rows rejected'])
+        for table in ('teacher', 'student'):
+            loads = [statement for statement in self.statements
+                     if statement.startswith('SELECT')
+                     and statement.split('FROM')[-1].split() == [table]]
+            self.assertEqual(len(loads), 1)
+
+    def test_failed_batches_are_reported(self):
+        rv = self.upload('Teacher', 'teachers.csv',
+                         'name\nMr. Kohleffel\nMr. Kohleffel\n')
+        lines = rv.data.splitlines()
+        assert lines[0].startswith('lines 2-3: could not be imported')
+        self.assertEqual(lines[-1], 'done: 0 rows imported, 0 rows rejected')
+
+    def test_partially_inserted_batches(self):
+        class SavingDatastore(SQLAlchemyDatastore):
+            insert_from_forms = AdminDatastore.insert_from_forms.im_func
+
+        datastore = SavingDatastore((simple.Teacher,), self.app.db_session)
+        form_class = datastore.get_model_form('Teacher')
+        forms = [form_class(MultiDict([('name', name)]))
+                 for name in (u'Mr. Kohleffel', u'Mr. Kohleffel')]
+        try:
+            datastore.insert_from_forms('Teacher', forms)
+        except BatchInsertError, e:
+            self.assertEqual(e.inserted, 1)
+        else:
+            self.fail('BatchInsertError not raised')
+        self.app.db_session.rollback()
+        self.assertEqual(
+            self.app.db_session.query(simple.Teacher).count(), 2)
+
+
+class FastDeleteTest(unittest.TestCase):
+    def create_session(self, base, *model_instances):
+        engine = sa.create_engine('sqlite://')
+        db_session = sa.orm.sessionmaker(bind=engine)()
+        base.metadata.create_all(bind=engine)
+        db_session.add_all(model_instances)
+        db_session.commit()
+        self.statements = []
+        sa.event.listen(engine, 'before_cursor_execute',
+                        lambda *args: self.statements.append(args[2]))
+        return db_session
+
+    def test_delete_without_loading(self):
+        db_session = self.create_session(
+            composite_keys.Base,
+            composite_keys.Student(student_id=1, name=u"Stewart"))
+        datastore = SQLAlchemyDatastore((composite_keys.Student,), db_session)
+        student = db_session.query(composite_keys.Student).one()
+        del self.statements[:]
+        assert datastore.delete_model_instance('Student', ['1', u'Stewart'])
+        self.assertEqual([statement.split()[0]
+                          for statement in self.statements], ['DELETE'])
+        assert student not in db_session
+        assert not datastore.delete_model_instance('Student',
+                                                   ['1', u'Stewart'])
+        assert not datastore.delete_model_instance('Student', ['x', u'y'])
+
+    def test_delete_with_relationships(self):
+        db_session = self.create_session(
+            simple.Base,
+            simple.Course(subject=u"maths",
+                          teacher=simple.Teacher(name=u"Mrs. Jones")))
+        datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Teacher), db_session)
+        assert datastore.delete_model_instance('Course', ['1'])
+        self.assertEqual([statement.split()[0]
+                          for statement in self.statements],
+                         ['SELECT', 'SELECT', 'DELETE'])
+
+    def test_can_delete_directly(self):
+        mapper = sa.orm.class_mapper
+        assert _can_delete_directly(mapper(composite_keys.Student))
+        # the courses backref would have its teacher_id set to NULL
+        assert not _can_delete_directly(mapper(simple.Teacher))
+        # the association rows have to be deleted
+        assert not _can_delete_directly(mapper(simple.Student))
+
+        Base = declarative_base()
+
+        class Parent(Base):
+            __tablename__ = 'parent'
+            id = sa.Column(sa.Integer, primary_key=True)
+
+        class Child(Base):
+            __tablename__ = 'child'
+            id = sa.Column(sa.Integer, primary_key=True)
+            parent_id = sa.Column(sa.Integer, sa.ForeignKey(
+                'parent.id', ondelete='CASCADE'))
+            parent = sa.orm.relationship(
+                Parent, backref=sa.orm.backref(
+                    'children', cascade='all, delete-orphan',
+                    passive_deletes=True))
+
+        assert _can_delete_directly(mapper(Parent))
+        assert _can_delete_directly(mapper(Child))
+        sa.event.listen(Child, 'before_delete', lambda *args: None)
+        assert not _can_delete_directly(mapper(Child))
+
+    def test_delete_with_flush_listeners(self):
+        engine = sa.create_engine('sqlite://')
+        composite_keys.Base.metadata.create_all(bind=engine)
+        db_session = sa.orm.scoped_session(sa.orm.sessionmaker(bind=engine))
+        db_session.add(composite_keys.Student(student_id=1, name=u"Stewart"))
+        db_session.commit()
+        flushed = []
+        sa.event.listen(db_session, 'before_flush',
+                        lambda session, *args: flushed.extend(
+                            session.deleted))
+        datastore = SQLAlchemyDatastore((composite_keys.Student,), db_session)
+        assert not _can_delete_directly(
+            sa.orm.class_mapper(composite_keys.Student), db_session)
+        assert datastore.delete_model_instance('Student', ['1', u'Stewart'])
+        self.assertEqual([student.name for student in flushed], [u"Stewart"])
+
+
+class BulkActionTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session)
+        admin_blueprint = admin.create_admin_blueprint(
+            self.datastore,
+            bulk_actions={'Course': {'reschedule': {'start_time': time(8)}}})
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        teacher = simple.Teacher(name=u"Mrs. Jones")
+        students = [simple.Student(name=name)
+                    for name in (u"Stewart", u"Mike", u"Jason")]
+        for subject in (u"maths", u"history", u"art"):
+            app.db_session.add(simple.Course(
+                subject=subject, teacher=teacher, students=students))
+        app.db_session.commit()
+
+        self.statements = []
+        sa.event.listen(engine, 'before_cursor_execute',
+                        lambda *args: self.statements.append(args[2]))
+        sa.event.listen(engine, 'commit',
+                        lambda *args: self.statements.append('COMMIT'))
+        return app
+
+    def test_list_view_has_selection(self):
+        rv = self.client.get('/admin/list/Course/')
+        assert 'name="keys" value="1"' in rv.data
+        assert '<option value="reschedule">' in rv.data
+        rv = self.client.get('/admin/list/Student/')
+        assert '<option value="reschedule">' not in rv.data
+
+    def test_bulk_delete_through_session(self):
+        rv = self.client.post('/admin/bulk/Student/',
+                              data={'action': 'delete',
+                                    'keys': ['1', '3', '42', 'junk']})
+        self.assertRedirects(rv, '/admin/list/Student/')
+        self.assertEqual(
+            [student.name for student in
+             self.app.db_session.query(simple.Student)], [u"Mike"])
+        # the association rows go along with the students
+        self.assertEqual(self.app.db_session.execute(
+            simple.course_student_association_table.count()).scalar(), 3)
+        self.assertEqual(self.statements.count('COMMIT'), 1)
+
+    def test_bulk_delete_with_delete_statement(self):
+        engine = sa.create_engine('sqlite://')
+        db_session = sa.orm.sessionmaker(bind=engine)()
+        composite_keys.Base.metadata.create_all(bind=engine)
+        db_session.add_all([composite_keys.Student(student_id=i, name=name)
+                            for i, name in enumerate([u"Stewart", u"Mike",
+                                                      u"Jason"])])
+        db_session.commit()
+        datastore = SQLAlchemyDatastore(
+            (composite_keys.Student,), db_session)
+        statements = []
+        sa.event.listen(engine, 'before_cursor_execute',
+                        lambda *args: statements.append(args[2]))
+
+        deleted = datastore.delete_model_instances(
+            'Student', [['0', u'Stewart'], ['2', u'Jason'], ['1', u'Nobody']])
+        self.assertEqual(deleted, 2)
+        self.assertEqual([statement.split()[0] for statement in statements],
+                         ['DELETE'])
+        self.assertEqual([student.name for student in
+                          db_session.query(composite_keys.Student)],
+                         [u"Mike"])
+
+    def test_bulk_action_updates_selection(self):
+        rv = self.client.post('/admin/bulk/Course/',
+                              data={'action': 'reschedule',
+                                    'keys': ['1', '2']})
+        self.assertRedirects(rv, '/admin/list/Course/')
+        self.assertEqual(
+            [statement.split()[0] for statement in self.statements
+             if not statement.startswith('SELECT')],
+            ['UPDATE', 'COMMIT'])
+        self.assertEqual(
+            [course.start_time for course in
+             self.app.db_session.query(simple.Course).order_by(
+                 simple.Course.id)],
+            [time(8), time(8), None])
+
+    def test_unknown_action(self):
+        self.client.post('/admin/bulk/Student/',
+                         data={'action': 'reschedule', 'keys': ['1']})
+        self.assertEqual(self.app.db_session.query(simple.Student).count(), 3)
+
+
+class ListColumnsTest(TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'not secure'
+        engine = sa.create_engine('sqlite://', convert_unicode=True)
+        app.db_session = sa.orm.scoped_session(sa.orm.sessionmaker(
+            autocommit=False, autoflush=False,
+            bind=engine))
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Course, simple.Student, simple.Teacher),
+            app.db_session, list_columns={'Course': ['id', 'subject']})
+        admin_blueprint = admin.create_admin_blueprint(self.datastore)
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
+        simple.Base.metadata.create_all(bind=engine)
+        teacher = simple.Teacher(name="Mrs. Jones")
+        app.db_session.add(simple.Course(subject="maths", teacher=teacher))
+        app.db_session.commit()
+        app.db_session.expunge_all()
+        return app
+
+    def test_list_view_shows_columns(self):
+        rv = self.client.get('/admin/list/Course/')
+        self.assertIn('<th scope="col">subject</th>', rv.data)
+        self.assertIn('<td><a href="/admin/edit/Course/1/">maths</a></td>',
+                      rv.data)
+
+    def test_unlisted_columns_are_deferred(self):
+        pagination = self.datastore.create_model_pagination('Course', 1)
+        course = pagination.items[0]
+        self.assertIn('subject', course.__dict__)
+        self.assertNotIn('start_time', course.__dict__)
+        self.assertEqual(course.start_time, None)
+
+    def test_other_models_are_not_deferred(self):
+        self.assertEqual(self.datastore.get_list_columns('Student'), None)
+        rv = self.client.get('/admin/list/Student/')
+        self.assertNotIn('<table', rv.data)
+
+
+class ModelRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.datastore = SQLAlchemyDatastore(
+            (simple.Teacher, simple.Course, simple.Student),
+            sa.orm.scoped_session(sa.orm.sessionmaker()))
+
+    def test_registry(self):
+        registry = self.datastore.get_model_registry()
+        self.assertEqual(registry.names,
+                         frozenset(['Course', 'Student', 'Teacher']))
+        self.assertEqual(registry.sorted_names,
+                         ('Course', 'Student', 'Teacher'))
+        self.assertEqual(list(registry), ['Course', 'Student', 'Teacher'])
+        assert 'Student' in registry
+        assert 'Base' not in registry
+        self.assertEqual(registry.descriptors['Course'].model_class,
+                         simple.Course)
+        self.assertEqual(registry.get_model_name(simple.Teacher), 'Teacher')
+        self.assertEqual(registry.get_model_name(object), None)
+
+    def test_registry_is_built_once(self):
+        registry = self.datastore.get_model_registry()
+        assert self.datastore.get_model_registry() is registry
+        assert CachingDatastore(self.datastore).get_model_registry() \
+               is registry
+
+
+class URLTemplateTest(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.add_url_rule('/edit/<model_name>/<path:model_url_key>/',
+                              'edit', lambda model_name, model_url_key: '')
+
+    def test_urls_match_url_for(self):
+        with self.app.test_request_context():
+            url_template = URLTemplate('edit', 'model_url_key',
+                                       model_name='Student')
+            for key in [u'1', u'5/Mike', u'a b?c#d', u'\x1a/2',
+                        u'J\xfcrgen%20']:
+                self.assertEqual(
+                    url_template(key),
+                    url_for('edit', model_name='Student', model_url_key=key))
+
+
+class PrimaryKeyInfoTest(unittest.TestCase):
+    def setUp(self):
+        self.datastore = SQLAlchemyDatastore(
+            (composite_keys.Student, composite_keys.Teacher),
+            sa.orm.scoped_session(sa.orm.sessionmaker()), exclude_pks=False)
+
+    def test_pk_info(self):
+        pk_info = self.datastore.pk_info[composite_keys.Student]
+        self.assertEqual(pk_info.names, ['student_id', 'name'])
+        self.assertEqual([convert(value) for convert, value
+                          in zip(pk_info.converters, [u'5', u'Mike'])],
+                         [5, u'Mike'])
+        self.assertRaises(ValueError, pk_info.converters[0], u'five')
+
+    def test_get_model_keys(self):
+        student = composite_keys.Student(student_id=5, name=u'Mike')
+        self.assertEqual(self.datastore.get_model_keys(student),
+                         [5, u'Mike'])
+
+
 class FileFieldTest(TestCase):
     TESTING = True
 
@@ -451,9 +2119,39 @@ def suite():
     suite.addTest(unittest.makeSuite(ExcludePKsFalseTest))
     suite.addTest(unittest.makeSuite(SmallPaginationTest))
     suite.addTest(unittest.makeSuite(LargePaginationTest))
+    suite.addTest(unittest.makeSuite(KeysetPaginationTest))
+    suite.addTest(unittest.makeSuite(SortingTest))
+    suite.addTest(unittest.makeSuite(FilterTest))
+    suite.addTest(unittest.makeSuite(CountStrategyTest))
+    suite.addTest(unittest.makeSuite(ConcurrentCountTest))
+    suite.addTest(unittest.makeSuite(CachingDatastoreTest))
+    suite.addTest(unittest.makeSuite(InstrumentedDatastoreTest))
+    suite.addTest(unittest.makeSuite(MetricsTest))
+    suite.addTest(unittest.makeSuite(AutocompleteTest))
+    suite.addTest(unittest.makeSuite(ModelRegistryTest))
+    suite.addTest(unittest.makeSuite(URLTemplateTest))
+    suite.addTest(unittest.makeSuite(PrimaryKeyInfoTest))
+    suite.addTest(unittest.makeSuite(FindModelInstanceTest))
+    suite.addTest(unittest.makeSuite(NumericKeyTest))
+    suite.addTest(unittest.makeSuite(ReorderedPrimaryKeyTest))
+    suite.addTest(unittest.makeSuite(DirtyUpdateTest))
+    suite.addTest(unittest.makeSuite(EagerLoadTest))
+    suite.addTest(unittest.makeSuite(ChoicesCacheTest))
+    suite.addTest(unittest.makeSuite(LazyFormTest))
+    suite.addTest(unittest.makeSuite(ListColumnsTest))
+    suite.addTest(unittest.makeSuite(ExportTest))
+    suite.addTest(unittest.makeSuite(ImportTest))
+    suite.addTest(unittest.makeSuite(BulkActionTest))
+    suite.addTest(unittest.makeSuite(FastDeleteTest))
+    suite.addTest(unittest.makeSuite(StreamingListTest))
     suite.addTest(unittest.makeSuite(FileFieldTest))
     suite.addTest(unittest.makeSuite(DeprecationTest))
     suite.addTest(unittest.makeSuite(ConversionTest))
+    suite.addTest(unittest.makeSuite(KeysetTest))
+    suite.addTest(unittest.makeSuite(DirtyFieldsTest))
+    suite.addTest(unittest.makeSuite(SortTest))
+    suite.addTest(unittest.makeSuite(FilterFieldsTest))
+    suite.addTest(unittest.makeSuite(InsertFromFormsTest))
     suite.addTest(unittest.makeSuite(MASimpleTest))
     return suite
 